@@ -0,0 +1,210 @@
+from __future__ import (print_function, unicode_literals, division,
+                        absolute_import)
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+import common
+from common import vprint, get_config, reset_checks, strip_invisible
+from common import AGENT_SOCKET
+
+# Re-authenticate with the cluster if the cached config is older than this
+CONFIG_TTL = 60 * 30
+
+
+class AgentState(object):
+    """
+    Everything kept warm between runs.  Check runs share the global report
+    in common so they are serialized with run_lock
+    """
+
+    def __init__(self):
+        self.config = None
+        self.config_time = 0
+        self.run_lock = threading.Lock()
+
+    def get_config(self, refresh=False):
+        if (refresh or self.config is None or
+                time.time() - self.config_time > CONFIG_TTL):
+            vprint("Agent authenticating with cluster")
+            self.config = get_config()
+            self.config_time = time.time()
+        return self.config
+
+    def reload(self):
+        common.reset_facts()
+        self.get_config(refresh=True)
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+
+    def send(self, **event):
+        self.wfile.write((json.dumps(event) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            req = json.loads(line.decode("utf-8"))
+            cmd = req.get("cmd")
+            if cmd == "ping":
+                self.send(event="pong", pid=os.getpid())
+            elif cmd == "reload":
+                with self.server.state.run_lock:
+                    self.server.state.reload()
+                self.send(event="done")
+            elif cmd == "check":
+                self.run_check(req)
+            elif cmd == "stop":
+                self.send(event="done")
+                threading.Thread(target=self.server.shutdown).start()
+            else:
+                self.send(event="error",
+                          error="Unknown command: {}".format(cmd))
+        except Exception as e:
+            self.send(event="error", error=str(e))
+
+    def run_check(self, req):
+        # Imported here so the agent module can be loaded by the thin client
+        # without pulling in every check module
+        from checkers import run_checks, validate_plugins
+        # Raises before anything is run, handle() sends it as an error event
+        validate_plugins(req.get("plugins"))
+        state = self.server.state
+        send_lock = threading.Lock()
+
+        def _callback(ck):
+            status = common.report.get_status(ck._name)
+            with send_lock:
+                self.send(event="result",
+                          name=ck._name,
+                          status=strip_invisible(status or ""))
+
+        with state.run_lock:
+            config = state.get_config()
+            common.WARNINGS = req.get("warnings", True)
+            common.HOST_STATE = req.get("host_state", False)
+            common.CHECK_CACHE = req.get("cache", True)
+            common.WRAPTXT = req.get("wrap", True)
+            common.REPORT_MODE = req.get("report_mode", common.REPORT_FULL)
+            # The client's terminal, not the agent's
+            common.REPORT_WIDTH = req.get("width")
+            reset_checks()
+            start = time.time()
+            run_checks(config, plugins=req.get("plugins"),
+                       tags=req.get("tags"), not_tags=req.get("not_tags"),
+                       callback=_callback)
+            if req.get("host_state"):
+                from state import get_host_state
+                get_host_state(config)
+            self.send(event="report",
+                      duration=round(time.time() - start, 3),
+                      report=common.report.gen_json(),
+                      text=common.report.generate())
+
+
+class AgentServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, state):
+        self.state = state
+        socketserver.UnixStreamServer.__init__(self, path, AgentHandler)
+
+
+def serve(path=AGENT_SOCKET):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    if os.path.exists(path):
+        if ping(path):
+            print("An agent is already listening on", path)
+            sys.exit(1)
+        os.unlink(path)
+    state = AgentState()
+    # Warm everything up front so the first client request is fast
+    from checkers import check_list  # noqa
+    state.get_config()
+    server = AgentServer(path, state)
+    os.chmod(path, 0o600)
+    print("DDCT agent listening on", path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def request(path, **req):
+    """
+    Sends a single request to the agent and yields each event it sends
+    back as it arrives
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    try:
+        sock.sendall((json.dumps(req) + "\n").encode("utf-8"))
+        f = sock.makefile("rb")
+        for line in f:
+            yield json.loads(line.decode("utf-8"))
+    finally:
+        sock.close()
+
+
+def ping(path=AGENT_SOCKET):
+    try:
+        for event in request(path, cmd="ping"):
+            return event.get("event") == "pong"
+    except socket.error:
+        return False
+
+
+def agent_check(path, args):
+    """
+    Thin client for 'ddct check --agent'.  Prints each check result as it
+    streams in, then the final report.  Exits 1 if the agent reports an
+    error or hangs up without a report
+    """
+    events = request(path,
+                     cmd="check",
+                     plugins=args.use_plugins,
+                     tags=args.tags,
+                     not_tags=args.not_tags,
+                     host_state=args.host_state,
+                     warnings=not args.disable_warnings,
+                     cache=not args.no_cache,
+                     wrap=not args.no_wrap,
+                     report_mode=common.REPORT_MODE,
+                     width=common.report_width())
+    for event in events:
+        if event["event"] == "result":
+            if not args.quiet:
+                print("{}: {}".format(event["name"], event["status"]))
+                sys.stdout.flush()
+        elif event["event"] == "report":
+            if args.json:
+                results = json.dumps(event["report"], indent=4)
+            else:
+                results = event["text"]
+            if args.out:
+                with open(args.out, 'w+') as f:
+                    f.write(results)
+                    f.write("\n")
+            if not args.quiet:
+                print(results)
+            return
+        elif event["event"] == "error":
+            print("Agent error:", event["error"])
+            sys.exit(1)
+    print("Agent closed the connection without a report")
+    sys.exit(1)
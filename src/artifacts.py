@@ -0,0 +1,291 @@
+from __future__ import (print_function, unicode_literals, division,
+                        absolute_import)
+
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+
+from common import vprint
+
+# Outside of TMP_DIR so the cache survives reboots.  DDCT_CACHE points it
+# somewhere else, e.g. a shared mount
+CACHE_DIR = os.environ.get("DDCT_CACHE", "/var/cache/ddct")
+CHUNK = 1024 * 1024
+DOWNLOAD_TIMEOUT = 60
+
+_index_lock = threading.Lock()
+
+
+class ArtifactError(EnvironmentError):
+    pass
+
+
+def _objects():
+    return os.path.join(CACHE_DIR, "objects")
+
+
+def _index_path():
+    return os.path.join(CACHE_DIR, "index.json")
+
+
+def artifact_key(name, version):
+    return "{}@{}".format(name, version)
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with io.open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_index():
+    """
+    Returns {"name@version": {"name", "version", "sha256", "size", "source",
+    "added"}}
+    """
+    try:
+        with io.open(_index_path(), 'r') as f:
+            return json.loads(f.read())
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _write_index(index):
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    tmp = _index_path() + ".tmp"
+    with io.open(tmp, 'w') as f:
+        f.write(json.dumps(index, indent=4, sort_keys=True))
+    os.rename(tmp, _index_path())
+
+
+def verify(entry):
+    """
+    True if the object for an index entry exists and hashes to its key
+    """
+    path = os.path.join(_objects(), entry["sha256"])
+    return os.path.exists(path) and sha256_file(path) == entry["sha256"]
+
+
+def lookup(name, version):
+    """
+    Returns the path of the cached artifact after verifying its checksum,
+    or None.  Corrupt objects are evicted
+    """
+    with _index_lock:
+        index = read_index()
+        entry = index.get(artifact_key(name, version))
+        if not entry:
+            return None
+        if not verify(entry):
+            vprint("Cached {} failed verification, evicting".format(
+                artifact_key(name, version)))
+            del index[artifact_key(name, version)]
+            _write_index(index)
+            try:
+                os.remove(os.path.join(_objects(), entry["sha256"]))
+            except OSError:
+                pass
+            return None
+    return os.path.join(_objects(), entry["sha256"])
+
+
+def version_key(version):
+    """
+    Sort key for release versions, "v2.9.3" < "v2.10.0" < "2018.4.5.0".
+    Versions without numbers (branches) sort first
+    """
+    return tuple(int(n) for n in re.findall(r"\d+", version))
+
+
+def versions(name):
+    """
+    Cached versions of name, oldest release first
+    """
+    entries = [e for e in read_index().values() if e["name"] == name]
+    return [e["version"] for e in sorted(
+        entries, key=lambda e: (version_key(e["version"]), e["added"]))]
+
+
+def put(name, version, path, source=None, sha256=None):
+    """
+    Adds the file at path to the cache and returns the cached path.  If
+    sha256 is given the file must match it
+    """
+    digest = sha256_file(path)
+    if sha256 and digest != sha256.lower():
+        raise ArtifactError("{} has sha256 {}, expected {}".format(
+            artifact_key(name, version), digest, sha256))
+    if not os.path.isdir(_objects()):
+        os.makedirs(_objects())
+    target = os.path.join(_objects(), digest)
+    if not os.path.exists(target):
+        tmp = "{}.{}.tmp".format(target, os.getpid())
+        shutil.copyfile(path, tmp)
+        os.rename(tmp, target)
+    with _index_lock:
+        index = read_index()
+        index[artifact_key(name, version)] = {
+            "name": name, "version": version, "sha256": digest,
+            "size": os.path.getsize(target), "source": source,
+            "added": time.time()}
+        _write_index(index)
+    return target
+
+
+def _download(url, dest):
+    vprint("Downloading {}".format(url))
+    resp = None
+    try:
+        import requests
+        resp = requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        resp.raise_for_status()
+        with io.open(dest, 'wb') as f:
+            for chunk in resp.iter_content(CHUNK):
+                f.write(chunk)
+    except Exception as e:
+        raise ArtifactError("Downloading {} failed: {}".format(url, e))
+    finally:
+        if resp is not None:
+            resp.close()
+
+
+def fetch_url(name, version, url, sha256=None, refresh=False):
+    """
+    Returns the cached path of name@version, downloading url into the cache
+    on a miss.  A cached object that doesn't match sha256 is a miss, and
+    refresh downloads again (for mutable versions like branches).  If that
+    download fails the verified cached copy is used, e.g. on hosts without
+    network access that were seeded with 'ddct cache --seed'
+    """
+    path = lookup(name, version)
+    if path and sha256 and os.path.basename(path) != sha256.lower():
+        path = None
+    if path and not refresh:
+        vprint("Using cached {}".format(artifact_key(name, version)))
+        return path
+    tmpdir = tempfile.mkdtemp(prefix="ddct-")
+    try:
+        dest = os.path.join(tmpdir, "download")
+        _download(url, dest)
+        return put(name, version, dest, source=url, sha256=sha256)
+    except ArtifactError as e:
+        if not path:
+            raise
+        print("Warning: {}, using the cached {}".format(
+            e, artifact_key(name, version)))
+        return path
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def fetch_repo(name, version, repo_url, refresh=False):
+    """
+    Caches a GitHub repository at a tag or branch as its source tarball.
+    This replaces a full clone plus 'git fetch --all'
+    """
+    return fetch_url(name, version, "{}/archive/{}.tar.gz".format(
+        repo_url.rstrip("/"), version), refresh=refresh)
+
+
+def extract(path, dest):
+    """
+    Extracts a cached tarball into dest (replacing it) and returns the
+    single top level directory of the archive if it has one, else dest
+    """
+    if os.path.isdir(dest):
+        shutil.rmtree(dest)
+    os.makedirs(dest)
+    with tarfile.open(path) as tar:
+        for member in tar.getmembers():
+            mpath = os.path.normpath(member.name)
+            if mpath.startswith("..") or os.path.isabs(mpath):
+                raise ArtifactError("Unsafe path {} in {}".format(
+                    member.name, path))
+        tar.extractall(dest)
+    entries = os.listdir(dest)
+    if len(entries) == 1 and os.path.isdir(os.path.join(dest, entries[0])):
+        return os.path.join(dest, entries[0])
+    return dest
+
+
+def export_bundle(bundle, keys=None):
+    """
+    Writes the cache (or only keys) to a tarball that seed_bundle() can
+    load on a host without network access
+    """
+    index = read_index()
+    selected = {key: entry for key, entry in index.items()
+                if keys is None or key in keys}
+    data = json.dumps(selected, indent=4, sort_keys=True).encode("utf-8")
+    with tarfile.open(bundle, "w:gz") as tar:
+        info = tarfile.TarInfo("index.json")
+        info.size = len(data)
+        info.mtime = time.time()
+        tar.addfile(info, io.BytesIO(data))
+        for entry in selected.values():
+            tar.add(os.path.join(_objects(), entry["sha256"]),
+                    "objects/{}".format(entry["sha256"]))
+    return sorted(selected)
+
+
+def seed_bundle(bundle):
+    """
+    Loads the artifacts in an export_bundle() tarball into the cache.
+    Every object is verified against its sha256 before it is added.
+    Returns the keys that were added
+    """
+    tmpdir = tempfile.mkdtemp(prefix="ddct-")
+    added = []
+    try:
+        with tarfile.open(bundle) as tar:
+            index = json.loads(tar.extractfile("index.json").read().decode(
+                "utf-8"))
+            for key, entry in sorted(index.items()):
+                member = tar.extractfile("objects/{}".format(entry["sha256"]))
+                dest = os.path.join(tmpdir, entry["sha256"])
+                with io.open(dest, 'wb') as f:
+                    shutil.copyfileobj(member, f)
+                put(entry["name"], entry["version"], dest,
+                    source=entry.get("source"), sha256=entry["sha256"])
+                added.append(key)
+    except (KeyError, tarfile.TarError) as e:
+        raise ArtifactError("Invalid artifact bundle {}: {}".format(
+            bundle, e))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return added
+
+
+def print_cache():
+    from tabulate import tabulate
+    rows = []
+    for key, entry in sorted(read_index().items()):
+        rows.append([key, entry["sha256"][:16], entry["size"],
+                     "OK" if verify(entry) else "CORRUPT",
+                     entry.get("source") or ""])
+    print(tabulate(rows, headers=["Artifact", "SHA256", "Size", "Integrity",
+                                  "Source"], tablefmt="grid"))
+
+
+def cache(args):
+    """
+    'ddct cache' entry point
+    """
+    if args.seed:
+        for key in seed_bundle(args.seed):
+            print("Seeded", key)
+    if args.export:
+        keys = export_bundle(args.export)
+        print("Exported {} artifacts to {}".format(len(keys), args.export))
+    if args.list or not (args.seed or args.export):
+        print_cache()
@@ -0,0 +1,109 @@
+from __future__ import (print_function, unicode_literals, division,
+                        absolute_import)
+
+import re
+
+from common import vprint, check, ff, wf, hs, read_sysfs, list_sysfs
+from common import one_of, at_least, at_most
+
+SYS_BLOCK = "/sys/block"
+DATERA_VENDORS = ("DATERA",)
+DATERA_MODELS = ("IBLOCK",)
+QUEUE_ATTRS = ("scheduler", "nr_requests", "read_ahead_kb",
+               "max_sectors_kb", "rq_affinity", "nomerges")
+SCHEDULER_RE = re.compile(r"\[(\S+)\]")
+# Number of example device names shown per deviation in the report
+SAMPLE = 5
+
+
+# attribute: ((validator, description), code, failure?)
+# blk-mq kernels ignore 'elevator=' on the kernel command line, so the
+# scheduler has to be checked per device
+PROFILE = {
+    "scheduler": (one_of("none", "noop"), "0912A26B", True),
+    "rq_affinity": (one_of("2"), "5407F8FA", False),
+    "nr_requests": (at_least(128), "801F04A0", False),
+    "max_sectors_kb": (at_least(512), "98464E5F", False),
+    "read_ahead_kb": (at_most(128), "17CE2EEF", False),
+}
+
+
+def is_datera_device(dev):
+    vendor = read_sysfs("{}/{}/device/vendor".format(SYS_BLOCK, dev), "")
+    model = read_sysfs("{}/{}/device/model".format(SYS_BLOCK, dev), "")
+    # Any LIO target reports IBLOCK, so the vendor has to match as well
+    return (vendor.strip() in DATERA_VENDORS and
+            model.strip().startswith(DATERA_MODELS))
+
+
+def read_queue(dev):
+    queue = {}
+    for attr in QUEUE_ATTRS:
+        value = read_sysfs("{}/{}/queue/{}".format(SYS_BLOCK, dev, attr))
+        if attr == "scheduler" and value:
+            # "mq-deadline kyber [none]" -> "none"
+            match = SCHEDULER_RE.search(value)
+            value = match.group(1) if match else value
+        queue[attr] = value
+    return queue
+
+
+def get_datera_queues():
+    """
+    Returns {device: {queue attribute: value}} for every Datera SCSI disk
+    in a single pass over /sys/block
+    """
+    return {dev: read_queue(dev) for dev in list_sysfs(SYS_BLOCK)
+            if dev.startswith("sd") and is_datera_device(dev)}
+
+
+def find_deviations(queues):
+    """
+    Returns {attribute: {value: [devices]}} for every attribute that
+    doesn't match PROFILE
+    """
+    deviations = {}
+    for dev, queue in sorted(queues.items()):
+        for attr, ((valid, _), _, _) in PROFILE.items():
+            value = queue.get(attr)
+            if value is None or valid(value):
+                continue
+            deviations.setdefault(attr, {}).setdefault(value, []).append(dev)
+    return deviations
+
+
+def summarize(queues):
+    summary = {}
+    for queue in queues.values():
+        for attr, value in queue.items():
+            counts = summary.setdefault(attr, {})
+            counts[value] = counts.get(value, 0) + 1
+    return summary
+
+
+@check("Block Queues", "basic", "block_device", "local")
+def check_block_queues(config):
+    vprint("Checking Datera block device queue settings")
+    queues = get_datera_queues()
+    if not queues:
+        return wf("No Datera block devices attached, queue settings could "
+                  "not be checked", "69B6B4B1")
+    hs("datera_block_queues", summarize(queues))
+    total = len(queues)
+    for attr, values in sorted(find_deviations(queues).items()):
+        (_, expected), code, fail = PROFILE[attr]
+        for value, devs in sorted(values.items()):
+            msg = ("{} is '{}' on {}/{} Datera devices, expected {} "
+                   "[{}]".format(attr, value, len(devs), total, expected,
+                                 ", ".join(devs[:SAMPLE]) +
+                                 (", ..." if len(devs) > SAMPLE else "")))
+            fix = ("echo <value> > /sys/block/<dev>/queue/{} or add a udev "
+                   "rule for vendor DATERA".format(attr))
+            if fail:
+                ff(msg, code, fix=fix)
+            else:
+                wf(msg, code, fix=fix)
+
+
+def load_checks():
+    return [check_block_queues]
@@ -7,22 +7,35 @@ import sys
 import time
 import threading
 
-from common import vprint, exe_check, ff, get_os, check_load, exe
-from common import check, wf
+from common import vprint, exe_check, ff, get_os, check_load, exe, which
+from common import plugin_manifest, PLUGIN_CHECK
+from common import check, wf, save_check_cache, host_path
 from common import ASSETS, SUPPORTED_OS_TYPES
-from common import UBUNTU
-from common import get_pkg_manager, APT, YUM
+from packages import install_command
 from mtu import load_checks as mtu_checks
 from multipath import load_checks as multipath_checks
-
-try:
-    from tabulate import tabulate
-except ImportError:
-    tabulate = None
+from block import load_checks as block_checks
+from irq import load_checks as irq_checks
+from nic import load_checks as nic_checks
+from cpu import load_checks as cpu_checks
+from iscsi import load_checks as iscsi_checks
+from netbench import load_checks as netbench_checks
+from memory import load_checks as memory_checks
+from sysctl import parse_rules, read_value, CODES
+from netmon import load_checks as netmon_checks
+from cluster import load_checks as cluster_checks
 
 FETCH_SO_URL = os.path.join(ASSETS, "fetch_device_serial_no.sh")
 UDEV_URL = os.path.join(ASSETS, "99-iscsi-luns.rules")
 
+# ARP and vm settings from sysctl_rules.txt are covered by the ARP and
+# Memory checks
+SYSCTL_PREFIXES = ("net.core.", "net.ipv4.tcp_")
+
+# open-iscsi reads the noop settings per connection, older Datera docs use
+# the node.session form
+ISCSID_PREFIXES = ("node.conn[0].", "node.session.")
+
 NET_FIX = ("Check the network connection.  If this failure is intermittent "
            "check for duplicate ips.  This can also be due to MTU "
            "fragmentation")
@@ -39,47 +52,37 @@ def check_os(config):
 @check("SYSCTL", "basic", "sysctl", "misc", "local")
 def check_sysctl(config):
     vprint("Checking various sysctl settings")
-    settings = sorted([
-        ("net.ipv4.tcp_timestamps", "0", "F0D7A1AD"),
-        ("net.ipv4.tcp_sack", "1", "7A9AB850"),
-        ("net.core.netdev_max_backlog", "250000", "7656C46C"),
-        ("net.core.somaxconn", "1024", "34A7B822"),
-        ("net.core.rmem_max", "16777216", "4C4B3F0B"),
-        ("net.core.wmem_max", "16777216", "7F8479C2"),
-        ("net.core.rmem_default", "8388608", "FBCA17D5"),
-        ("net.core.wmem_default", "8388608", "68191DE5"),
-        ("net.core.optmem_max", "8388608", "8FA26A66"),
-        ("net.ipv4.tcp_rmem", "\"4096 87380 16777216\"", "2A6057BD"),
-        ("net.ipv4.tcp_wmem", "\"4096 65536 16777216\"", "CD37F436"),
-        ("net.ipv4.tcp_low_latency", "1", "6BE2899E"),
-        ("net.ipv4.tcp_fin_timeout", "15", "59FD5DF7"),
-        ("net.ipv4.tcp_syncookies", "1", "01C594E7"),
-        ("net.ipv4.tcp_adv_win_scale", "1", "1F523B04"),
-        ("net.ipv4.tcp_window_scaling", "1", "A8A6F381"),
-        ("net.ipv4.tcp_max_syn_backlog", "8192", "2862CB28"),
-        ("net.ipv4.tcp_tw_reuse", "1", "989229FC"),
-        ("net.ipv4.tcp_synack_retries", "2", "55EF997B")])
-    for setting, value, code in settings:
-        found = exe("sysctl --values {}".format(setting)).strip()
-        found = found.strip().strip("\"").split()
-        value = value.strip().strip("\"").split()
-        if len(found) == 1:
-            found = found[0]
-        if len(value) == 1:
-            value = value[0]
-        if found != value:
+    rules = parse_rules()
+    for setting, code in CODES.items():
+        if not setting.startswith(SYSCTL_PREFIXES) or setting not in rules:
+            continue
+        value = rules[setting]
+        found = read_value(setting)
+        if found is not None and found != value:
             ff("{}={} is not set. Found: {}".format(
                 setting, value, found), code)
 
 
+def parse_iscsid_conf(lines):
+    """
+    Returns {setting: [(line number, value)]} for every uncommented
+    'key = value' line
+    """
+    settings = {}
+    for index, line in enumerate(lines, 1):
+        line = line.split("#", 1)[0].strip()
+        if "=" not in line:
+            continue
+        key, value = line.split("=", 1)
+        settings.setdefault(key.strip(), []).append((index, value.strip()))
+    return settings
+
+
 @check("ISCSI", "basic", "iscsi", "local")
 def check_iscsi(config):
     vprint("Checking ISCSI settings")
-    if not exe_check("which iscsiadm"):
-        if get_pkg_manager() == APT:
-            fix = "apt-get install open-iscsi"
-        elif get_pkg_manager() == YUM:
-            fix = "yum install iscsi-initiator-utils"
+    if not which("iscsiadm"):
+        fix = install_command(["iscsi"])
         ff("iscsiadm is not available, has open-iscsi been installed?",
            "EFBB085C", fix=fix)
     if not exe_check("ps -ef | grep iscsid | grep -v grep"):
@@ -87,48 +90,43 @@ def check_iscsi(config):
         ff("iscsid is not running.  Is the iscsid service running?",
            "EB22737E", fix=fix)
     ifile = "/etc/iscsi/iscsid.conf"
-    if not os.path.exists(ifile):
+    if not os.path.exists(host_path(ifile)):
         ff("iscsid configuration file does not exist", "C6F2B356")
         return
-    with io.open(ifile, 'r') as f:
-        iconf = f.readlines()
-    noopt = "node.session.timeo.noop_out_timeout"
-    noopt_found = False
-    noopi = "node.session.timeo.noop_out_interval"
-    noopi_found = False
-    for index, line in enumerate(iconf):
-        if not noopt_found and noopt in line:
-            noopt_found = True
-            if "2" not in line:
-                ff("{} is not set to '2' in iscsid.conf".format(noopt),
-                   "F6A49337")
-        elif noopt_found and noopt in line:
+    with io.open(host_path(ifile), 'r') as f:
+        settings = parse_iscsid_conf(f.readlines())
+    for setting, code, dup_code, missing_code in (
+            ("timeo.noop_out_timeout", "F6A49337", "D3E55910", "E29BF18A"),
+            ("timeo.noop_out_interval", "E48C1907", "CA9AA865",
+             "A2EED511")):
+        found = []
+        for prefix in ISCSID_PREFIXES:
+            found.extend(settings.get(prefix + setting, []))
+        name = ISCSID_PREFIXES[0] + setting
+        if not found:
+            ff("'{} = 2' is not present in iscsid.conf".format(name),
+               missing_code)
+            continue
+        for index, _ in sorted(found)[1:]:
             wf("{} duplicate found in iscsid.conf, line {}".format(
-                noopt, index), "D3E55910")
-        if noopi in line:
-            noopi_found = True
-            if "2" not in line:
-                ff("{} is not set to '2' in iscsid.conf".format(noopi),
-                   "E48C1907")
-        elif noopi_found and noopi in line:
-            wf("{} duplicate found in iscsid.conf, line {}".format(
-                noopi, index), "CA9AA865")
-    if not noopt_found:
-        ff("'{} = 2' is not present in iscsid.conf".format(noopt), "E29BF18A")
-    if not noopi_found:
-        ff("'{} = 2' is not present in iscsid.conf".format(noopi), "A2EED511")
+                setting, index), dup_code)
+        # iscsid uses the last occurrence
+        value = sorted(found)[-1][1]
+        if value != "2":
+            ff("{} is set to '{}' in iscsid.conf, not '2'".format(
+                setting, value), code)
 
 
 @check("UDEV", "basic", "udev", "local")
 def check_udev(config):
     vprint("Checking udev rules config")
     frules = "/etc/udev/rules.d/99-iscsi-luns.rules"
-    if not os.path.exists(frules):
+    if not os.path.exists(host_path(frules)):
         fix = "A copy of the udev rules are available from: {}".format(
             UDEV_URL)
         ff("Datera udev rules are not installed", "1C8F2E07", fix=fix)
     snum = "/sbin/fetch_device_serial_no.sh"
-    if not os.path.exists(snum):
+    if not os.path.exists(host_path(snum)):
         fix = ("A copy of fetch_device_serial_no.sh is available at: "
                "{}".format(FETCH_SO_URL))
         ff("fetch_device_serial_no.sh is missing from /sbin", "6D03F50B",
@@ -138,20 +136,16 @@ def check_udev(config):
 @check("ARP", "basic", "arp", "local")
 def check_arp(config):
     vprint("Checking ARP settings")
-    if not exe_check("sysctl --all 2>/dev/null | "
-                     "grep 'net.ipv4.conf.all.arp_announce = 2'",
-                     err=False):
+    if read_value("net.ipv4.conf.all.arp_announce") != "2":
         fix = "sysctl net.ipv4.conf.all.arp_announce=2"
         ff("net.ipv4.conf.all.arp_announce != 2 in sysctl", "9000C3B6",
            fix=fix)
-    if not exe_check("sysctl --all 2>/dev/null | "
-                     "grep 'net.ipv4.conf.all.arp_ignore = 1'",
-                     err=False):
+    if read_value("net.ipv4.conf.all.arp_ignore") != "1":
         fix = "sysctl net.ipv4.conf.all.arp_ignore=1"
         ff("net.ipv4.conf.all.arp_ignore != 1 in sysctl", "BDB4D5D8", fix=fix)
     gcf = "/proc/sys/net/ipv4/route/gc_interval"
-    gc = int(exe("cat {}".format(gcf)))
-    if gc != 5:
+    gc = read_value("net.ipv4.route.gc_interval")
+    if gc != "5":
         fix = "echo 5 > {}".format(gcf)
         ff("{} is currently set to {}".format(gcf, gc), "A06CD19F", fix=fix)
 
@@ -159,7 +153,7 @@ def check_arp(config):
 @check("IRQ", "basic", "irq", "local")
 def check_irq(config):
     vprint("Checking irqbalance settings, (should be turned off)")
-    if not exe_check("which systemctl"):
+    if not which("systemctl"):
         if not exe_check("service irqbalance status | "
                          "grep 'Active: active'",
                          err=True):
@@ -173,48 +167,6 @@ def check_irq(config):
             return ff("irqbalance is active", "B19D9FF1", fix=fix)
 
 
-@check("CPUFREQ", "basic", "cpufreq", "local")
-def check_cpufreq(config):
-    vprint("Checking cpufreq settings")
-    if not exe_check("which cpupower"):
-        if get_os() == UBUNTU:
-            version = exe("uname -r").strip()
-            fix = "apt-get install linux-tools-{}".format(version)
-        else:
-            # RHEL puts this stuff in kernel-tools
-            fix = "yum install kernel-tools"
-        return ff("cpupower is not installed", "20CEE732", fix=fix)
-    if not exe_check("cpupower frequency-info --governors | "
-                     "grep performance",
-                     err=False):
-        fix = ("No-fix -- if this system is a VM governors might not be "
-               "available and this check can be ignored")
-        return ff("No 'performance' governor found for system", "333FBD45",
-                  fix=fix)
-
-
-@check("Block Devices", "basic", "block_device", "local")
-def check_block_devices(config):
-    vprint("Checking block device settings")
-    grub = "/etc/default/grub"
-    if not os.path.exists(grub):
-        return ff("Could not find default grub file at {}".format(grub),
-                  "6F7B6A25")
-    with io.open(grub, "r") as f:
-        data = f.readlines()
-        line = filter(lambda x: x.startswith("GRUB_CMDLINE_LINUX_DEFAULT="),
-                      data)
-        line2 = filter(lambda x: x.startswith("GRUB_CMDLINE_LINUX="), data)
-        if len(line) != 1 and len(line2) != 1:
-            return ff("GRUB_CMDLINE_LINUX_DEFAULT and GRUB_CMDLINE_LINUX are"
-                      " missing from GRUB file", "A65B6D97")
-        if ((len(line) > 0 and "elevator=noop" not in line[0]) and
-                (len(line2) > 0 and "elevator=noop" not in line2[0])):
-            fix = ("Add 'elevator=noop' to /etc/default/grub in the "
-                   "'GRUB_CMDLINE_LINUX_DEFAULT' line")
-            return ff("Scheduler is not set to noop", "47BB5083", fix=fix)
-
-
 @check("MGMT", "basic", "connection", "local")
 def mgmt_check(config):
     mgmt = config["mgmt_ip"]
@@ -281,57 +233,112 @@ check_list = [check_os,
               check_udev,
               check_arp,
               check_irq,
-              check_cpufreq,
-              check_block_devices,
               mgmt_check,
               vip1_check,
               vip2_check,
               callhome_check]
 check_list.extend(mtu_checks())
 check_list.extend(multipath_checks())
+check_list.extend(block_checks())
+check_list.extend(irq_checks())
+check_list.extend(nic_checks())
+check_list.extend(cpu_checks())
+check_list.extend(iscsi_checks())
+check_list.extend(netbench_checks())
+check_list.extend(memory_checks())
+check_list.extend(netmon_checks())
+check_list.extend(cluster_checks())
+
+
+def validate_plugins(plugins):
+    """
+    Returns the manifest entries of the check plugins.  Raises ValueError
+    if any of plugins isn't one of them
+    """
+    available = plugin_manifest(PLUGIN_CHECK)
+    for plugin in plugins or []:
+        if plugin not in available:
+            raise ValueError(
+                "Unrecognized check plugin requested: {}.  Available check "
+                "plugins: {}".format(plugin, ", ".join(sorted(available))))
+    return available
 
 
 def load_plugin_checks(plugins):
-    plugs = check_load()
+    """
+    Returns the checks of the named plugins.  They are not added to
+    check_list, so a long running process (agent, daemon) only runs them
+    for the requests that ask for them
+    """
+    validate_plugins(plugins)
+    plugs = check_load(plugins)
+    checks = []
     for plugin in plugins:
-        if plugin not in plugs:
-            print("Unrecognized check plugin requested:", plugin)
-            print("Available check plugins:", ", ".join(plugs.keys()))
-            sys.exit(1)
-        check_list.extend(plugs[plugin].load_checks())
+        for ck in plugs[plugin].load_checks():
+            if ck not in check_list and ck not in checks:
+                checks.append(ck)
+    return checks
 
 
-def run_checks(config, plugins=None, tags=None, not_tags=None):
-    if plugins:
-        load_plugin_checks(plugins)
-    threads = []
-
-    # Filter checks to be executed based on tags passed in
+def select_checks(tags=None, not_tags=None, plugins=None):
+    """
+    Returns the built-in checks plus the checks of plugins, matching any of
+    tags and none of not_tags
+    """
     checks = check_list
+    if plugins:
+        checks = check_list + load_plugin_checks(plugins)
     if tags:
         checks = filter(lambda x: any([t in x._tags for t in tags]),
                         checks)
     if not_tags:
         checks = filter(lambda x: not any([t in x._tags for t in not_tags]),
                         checks)
-    for ck in checks:
-        thread = threading.Thread(target=ck, args=(config,))
+    return list(checks)
+
+
+def run_checks(config, plugins=None, tags=None, not_tags=None,
+               callback=None):
+    """
+    Runs the selected checks in parallel.  If callback is provided it is
+    called with each check function as soon as that check finishes
+    """
+    threads = []
+
+    def _run(ck):
+        try:
+            ck(config)
+        finally:
+            if callback:
+                callback(ck)
+
+    for ck in select_checks(tags, not_tags, plugins):
+        # Named after the check so profile traces show one row per check
+        thread = threading.Thread(target=_run, args=(ck,), name=ck._name)
         threads.append(thread)
         thread.start()
     for thread in threads:
         thread.join()
+    try:
+        save_check_cache()
+    except (IOError, OSError) as e:
+        vprint("Could not save check cache: {}".format(e))
 
 
 def print_tags(config, plugins=None):
-    if plugins:
-        load_plugin_checks(plugins)
+    from tabulate import tabulate
     tags = set()
     for ck in check_list:
         for tag in ck._tags:
             tags.add(tag)
+    # Plugin tags come from the manifest so no plugin has to be imported
+    try:
+        available = validate_plugins(plugins)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    for plugin in plugins or []:
+        for ck in available[plugin]["checks"]:
+            tags.update(ck["tags"])
     print(tabulate(sorted(map(lambda x: [x], tags)), headers=["Tags"],
                    tablefmt="grid"))
-
-# Possible additional checks
-# ethtool -S
-# netstat -F (retrans)
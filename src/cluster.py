@@ -0,0 +1,406 @@
+from __future__ import (print_function, unicode_literals, division,
+                        absolute_import)
+
+import io
+import json
+import re
+import subprocess
+
+import ipaddress
+
+from common import vprint, check, exe, ff, wf, hs, host_path
+from common import read_sysfs, cluster_ssh, ssh_exe
+from iscsi import get_sessions, DATERA_IQN, SAMPLE
+from mtu import iface_dict
+from spans import span
+
+# Python 2/3 compatibility
+try:
+    str = unicode
+except NameError:
+    pass
+
+# The cluster side of the connection checks.  Everything is collected by one
+# script run over a single (pooled) SSH connection to the storage node at the
+# mgmt_ip, which prints one JSON document.  The output is parsed and compared
+# with the client here, so adding a section costs no extra round trip
+
+PROBE_TIMEOUT = 30
+LIO_TARGETS = "/sys/kernel/config/target/iscsi"
+INITIATOR_FILE = "/etc/iscsi/initiatorname.iscsi"
+
+# (section, command run on the storage node)
+PROBE_SECTIONS = (
+    ("hostname", "hostname"),
+    ("links", "ip -o link show"),
+    ("addrs", "ip -o addr show"),
+    ("neigh", "ip neigh show"),
+    # One line per session naming its initiator (LIO targets)
+    ("sessions", "cd {} && for f in */tpgt_*/dynamic_sessions; do "
+                 "echo \"== $f\"; cat \"$f\"; done".format(LIO_TARGETS)))
+# Without these nothing can be compared
+REQUIRED_SECTIONS = ("hostname", "links", "addrs")
+
+# Prints '"name": {"rc": N, "out": "..."}' for a command, escaping the
+# output with sed and awk so the node needs nothing beyond a POSIX shell
+PROBE_FUNC = r"""
+section() {
+    out=$(sh -c "$2" 2>&1)
+    rc=$?
+    printf '"%s": {"rc": %d, "out": "' "$1" "$rc"
+    printf '%s' "$out" | sed -e 's/\\/\\\\/g' -e 's/"/\\"/g' |
+        awk 'NR > 1 {printf "\\n"} {printf "%s", $0}'
+    printf '"}'
+}
+"""
+
+LINK_RE = re.compile(r"^\d+:\s+(?P<name>[^:@\s]+)(?:@\S+)?:\s+"
+                     r"<(?P<flags>[^>]*)>(?P<rest>.*)$")
+LINK_MTU_RE = re.compile(r"\bmtu (\d+)")
+LINK_STATE_RE = re.compile(r"\bstate (\S+)")
+LINK_MAC_RE = re.compile(r"link/\S+ ([0-9a-fA-F:]{17})")
+ADDR_RE = re.compile(r"^\d+:\s+(?P<name>[^\s@]+)\S*\s+inet6?\s+"
+                     r"(?P<cidr>\S+)")
+# ip neigh states the kernel gave up on
+NEIGH_FAILED = ("FAILED", "INCOMPLETE")
+
+
+class ProbeError(EnvironmentError):
+    pass
+
+
+def _quote(s):
+    return "'" + s.replace("'", "'\"'\"'") + "'"
+
+
+def probe_script(sections=PROBE_SECTIONS):
+    calls = "\nprintf ', '\n".join(
+        "section {} {}".format(name, _quote(cmd)) for name, cmd in sections)
+    return (PROBE_FUNC + "printf '{\"sections\": {'\n" + calls +
+            "\nprintf '}}\\n'\n")
+
+
+def run_probe(config, sections=PROBE_SECTIONS):
+    """
+    Runs every section on the cluster in a single SSH command and returns
+    {section: (exit code, output)}
+    """
+    ssh = cluster_ssh(config, timeout=PROBE_TIMEOUT)
+    vprint("Probing cluster: {}".format(", ".join(n for n, _ in sections)))
+    with span("cluster_cmd", "cluster probe") as attrs:
+        status, out, err = ssh_exe(ssh, probe_script(sections),
+                                   timeout=PROBE_TIMEOUT)
+        attrs.update(exit_code=status, bytes=len(out))
+    if status != 0:
+        raise ProbeError("Nonzero return code: {} stderr: {}".format(
+            status, err.strip()))
+    try:
+        # Skip anything a login script printed before the document
+        data = json.loads(out[out.index("{"):], strict=False)
+        return {name: (int(s["rc"]), s["out"])
+                for name, s in data["sections"].items()}
+    except (ValueError, KeyError, TypeError) as e:
+        raise ProbeError("Unreadable cluster probe output: {}".format(e))
+
+
+def parse_links(out):
+    """
+    'ip -o link show' -> {interface: {"mtu", "state", "up", "mac"}}
+    """
+    links = {}
+    for line in out.splitlines():
+        match = LINK_RE.match(line)
+        if not match:
+            continue
+        rest = match.group("rest")
+        mtu = LINK_MTU_RE.search(rest)
+        state = LINK_STATE_RE.search(rest)
+        mac = LINK_MAC_RE.search(rest)
+        links[match.group("name")] = {
+            "mtu": int(mtu.group(1)) if mtu else None,
+            "state": state.group(1) if state else None,
+            # Administratively up and with a carrier
+            "up": "LOWER_UP" in match.group("flags").split(","),
+            "mac": mac.group(1).lower() if mac else None}
+    return links
+
+
+def parse_addrs(out):
+    """
+    'ip -o addr show' -> {interface: [address/prefix]}
+    """
+    addrs = {}
+    for line in out.splitlines():
+        match = ADDR_RE.match(line)
+        if match:
+            addrs.setdefault(match.group("name"), []).append(
+                match.group("cidr"))
+    return addrs
+
+
+def parse_neigh(out):
+    """
+    'ip neigh show' -> [{"ip", "dev", "lladdr", "state"}]
+    """
+    entries = []
+    for line in out.splitlines():
+        parts = line.split()
+        if len(parts) < 2:
+            continue
+        entry = {"ip": parts[0], "dev": None, "lladdr": None,
+                 "state": parts[-1]}
+        for key in ("dev", "lladdr"):
+            if key in parts[:-1]:
+                entry[key] = parts[parts.index(key) + 1]
+        if entry["lladdr"]:
+            entry["lladdr"] = entry["lladdr"].lower()
+        entries.append(entry)
+    return entries
+
+
+def parse_target_sessions(out):
+    """
+    The dynamic_sessions dump -> {target iqn: [initiator per session]}
+    """
+    sessions = {}
+    target = None
+    for line in out.splitlines():
+        line = line.strip()
+        if line.startswith("== "):
+            # == <target iqn>/tpgt_N/dynamic_sessions
+            target = line[3:].split("/")[0]
+            sessions.setdefault(target, [])
+        elif line and target:
+            sessions[target].append(line)
+    return sessions
+
+
+def parse_probe(sections):
+    """
+    Turns run_probe() output into {"node", "links", "addrs", "neigh",
+    "sessions", "errors"}.  neigh and sessions are None when their command
+    failed, sessions also when the node has no LIO target
+    """
+    errors = {name: out.strip() for name, (rc, out) in sections.items()
+              if rc != 0}
+    missing = [name for name in REQUIRED_SECTIONS
+               if name not in sections or name in errors]
+    if missing:
+        raise ProbeError("Cluster probe could not collect {}: {}".format(
+            ", ".join(missing), "; ".join(errors.get(name, "missing")
+                                          for name in missing)))
+
+    def _parsed(name, parser):
+        if name not in sections or name in errors:
+            return None
+        return parser(sections[name][1])
+
+    return {"node": sections["hostname"][1].strip(),
+            "links": _parsed("links", parse_links),
+            "addrs": _parsed("addrs", parse_addrs),
+            "neigh": _parsed("neigh", parse_neigh),
+            "sessions": _parsed("sessions", parse_target_sessions),
+            "errors": errors}
+
+
+def route_get(ip):
+    """
+    Returns (interface, source address) the client uses to reach ip
+    """
+    try:
+        parts = exe("ip route get {}".format(ip)).split()
+    except subprocess.CalledProcessError:
+        return None, None
+    found = {}
+    for key in ("dev", "src"):
+        if key in parts[:-1]:
+            found[key] = parts[parts.index(key) + 1]
+    return found.get("dev"), found.get("src")
+
+
+def client_paths(config):
+    """
+    Returns {name: {"ip", "iface", "src", "mtu", "mac"}} for the MGMT/VIP1/
+    VIP2 ips in config, describing the local end of each path
+    """
+    keys = {"MGMT": "mgmt_ip", "VIP1": "vip1_ip", "VIP2": "vip2_ip"}
+    paths = {}
+    for name, key in keys.items():
+        ip = config.get(key)
+        if not ip:
+            continue
+        iface, src = route_get(ip)
+        if not iface:
+            continue
+        mtu = read_sysfs("/sys/class/net/{}/mtu".format(iface), "")
+        mac = read_sysfs("/sys/class/net/{}/address".format(iface))
+        paths[name] = {"ip": ip, "iface": iface, "src": src,
+                       "mtu": int(mtu) if mtu.isdigit() else None,
+                       "mac": mac.lower() if mac else None}
+    return paths
+
+
+def initiator_name():
+    try:
+        with io.open(host_path(INITIATOR_FILE), 'r') as f:
+            for line in f:
+                if line.startswith("InitiatorName="):
+                    return line.split("=", 1)[1].strip()
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def on_link(probe, iface, src):
+    """
+    True if src is in one of the subnets on a cluster interface, ie. the
+    node reaches the client without a router in between
+    """
+    if not src:
+        return False
+    try:
+        address = ipaddress.ip_address(str(src))
+    except ValueError:
+        return False
+    for cidr in probe["addrs"].get(iface, []):
+        try:
+            if address in ipaddress.ip_interface(str(cidr)).network:
+                return True
+        except ValueError:
+            continue
+    return False
+
+
+def node_ips(probe):
+    return set(cidr.split("/")[0] for cidrs in probe["addrs"].values()
+               for cidr in cidrs)
+
+
+def compare_interfaces(probe, paths):
+    node = probe["node"]
+    for name, path in sorted(paths.items()):
+        cname = iface_dict[name]
+        link = probe["links"].get(cname)
+        if not link:
+            wf("Cluster node {} has no {} interface, {} could not be "
+               "compared".format(node, cname, name), "90DADFEA")
+            continue
+        if not link["up"]:
+            ff("Cluster node {} interface {} is down [state {}]".format(
+                node, cname, link["state"]), "FFBAB0AE")
+        # Routed paths fragment anyway, see check_mtu_l3
+        if not on_link(probe, cname, path["src"]):
+            vprint("{} is routed to cluster {}, skipping MTU".format(
+                path["iface"], cname))
+            continue
+        if path["mtu"] and link["mtu"] and path["mtu"] != link["mtu"]:
+            ff("Local interface {} MTU does not match cluster node {} "
+               "interface {} MTU [{} != {}]".format(
+                   path["iface"], node, cname, path["mtu"], link["mtu"]),
+               "E0505F7A")
+
+
+def compare_neighbours(probe, paths):
+    """
+    Looks the client up in the node's ARP table.  A different MAC means
+    the node sends to another host (duplicate ip or stale entry)
+    """
+    if probe["neigh"] is None:
+        return vprint("Cluster ARP table unavailable: {}".format(
+            probe["errors"].get("neigh")))
+    node = probe["node"]
+    seen = set()
+    for name, path in sorted(paths.items()):
+        cname = iface_dict[name]
+        src = path["src"]
+        if src in seen or not on_link(probe, cname, src):
+            continue
+        seen.add(src)
+        for entry in probe["neigh"]:
+            if entry["ip"] != src:
+                continue
+            if entry["state"] in NEIGH_FAILED:
+                wf("Cluster node {} can't resolve client address {} on {} "
+                   "[{}]".format(node, src, entry["dev"], entry["state"]),
+                   "300F72CD")
+            elif (entry["lladdr"] and path["mac"] and
+                  entry["lladdr"] != path["mac"]):
+                ff("Cluster node {} has {} at {} on {} but local interface "
+                   "{} is {}.  Another host may be using this ip".format(
+                       node, src, entry["lladdr"], entry["dev"],
+                       path["iface"], path["mac"]), "93DF124C",
+                   fix="Remove the duplicate ip, then run 'ip neigh del {} "
+                       "dev {}' on the cluster node".format(
+                           src, entry["dev"]))
+
+
+def compare_sessions(probe):
+    """
+    Compares the client's sessions to portals on the probed node with the
+    sessions the node's target has for this initiator, per target
+    """
+    if probe["sessions"] is None:
+        return vprint("Cluster target sessions unavailable: {}".format(
+            probe["errors"].get("sessions")))
+    initiator = initiator_name()
+    if not initiator:
+        return vprint("No local initiator name, skipping session counts")
+    portals = node_ips(probe)
+    local = {}
+    for session in get_sessions().values():
+        target = session.get("targetname") or ""
+        if DATERA_IQN in target and session.get("portal") in portals:
+            local[target] = local.get(target, 0) + 1
+    remote = {target: initiators.count(initiator)
+              for target, initiators in probe["sessions"].items()}
+    diffs = sorted("{} ({} local, {} on target)".format(
+        target, local.get(target, 0), remote.get(target, 0))
+        for target in set(local) | set(remote)
+        if local.get(target, 0) != remote.get(target, 0))
+    if diffs:
+        wf("{}/{} targets on cluster node {} disagree with the client about "
+           "the number of sessions for {} [{}]".format(
+               len(diffs), len(set(local) | set(remote)), probe["node"],
+               initiator, ", ".join(diffs[:SAMPLE]) +
+               (", ..." if len(diffs) > SAMPLE else "")), "DAFE6AD4",
+           fix="Log out and back in to the affected targets.  Sessions only "
+               "the target knows about expire after the replacement timeout")
+
+
+def probe_state(probe):
+    """
+    The part of the probe shown under host state
+    """
+    names = set(iface_dict.values())
+    return {"node": probe["node"],
+            "interfaces": {
+                name: {"mtu": link["mtu"], "state": link["state"],
+                       "addrs": probe["addrs"].get(name, [])}
+                for name, link in probe["links"].items() if name in names},
+            "target_sessions": (sum(len(s) for s in
+                                    probe["sessions"].values())
+                                if probe["sessions"] is not None else None),
+            "errors": probe["errors"]}
+
+
+@check("Cluster Probe", "cluster", "connection")
+def check_cluster(config):
+    vprint("Probing the cluster over SSH")
+    try:
+        probe = parse_probe(run_probe(config))
+    except ProbeError as e:
+        return ff(str(e), "DE2B8446")
+    except ValueError as e:
+        return ff(str(e), "01190E66")
+    except Exception as e:
+        return ff("Could not run the cluster probe: {}".format(e),
+                  "F3531E07")
+    hs("cluster", probe_state(probe))
+    paths = client_paths(config)
+    compare_interfaces(probe, paths)
+    compare_neighbours(probe, paths)
+    compare_sessions(probe)
+
+
+def load_checks():
+    return [check_cluster]
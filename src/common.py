@@ -1,8 +1,10 @@
 from __future__ import (print_function, unicode_literals, division,
                         absolute_import)
 
+import ast
 import functools
 import glob
+import hashlib
 import importlib
 import inspect
 import io
@@ -11,27 +13,27 @@ import os
 import re
 import subprocess
 import socket
-import textwrap
+import sys
+import threading
+import time
 try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
+try:
+    from shutil import which as _which
+except ImportError:
+    from distutils.spawn import find_executable as _which
 
 from contextlib import contextmanager
 
-try:
-    from dfs_sdk import scaffold, ApiError
-    import distro
-    import ipaddress
-    import paramiko
-    import requests
-    from tabulate import tabulate
-except ImportError:
-    distro = None
-    ipaddress = None
-    tabulate = None
-    paramiko = None
-    scaffold = None
+from render import Grid, terminal_width, truncate
+from spans import span, ApiProxy
+import spans
+
+# Heavy third-party modules (dfs_sdk, paramiko, requests, tabulate, distro)
+# are imported inside the functions that use them so that lightweight
+# subcommands like 'version' and '--list-plugins' start instantly
 
 # Python 2/3 compatibility
 try:
@@ -45,9 +47,20 @@ TAG_RE = re.compile(r"\d+\.\d+\.\d+")
 UUID4_STR_RE = re.compile(r"[a-f0-9]{8}-?[a-f0-9]{4}-?4[a-f0-9]{3}-?[89ab]"
                           r"[a-f0-9]{3}-?[a-f0-9]{12}")
 
+# Prefix for the /proc, /sys and /etc reads done by the sysfs based checks.
+# Pointing this at a copied or synthetic tree lets those checks run against
+# another host's state
+HOST_ROOT = os.environ.get("DDCT_HOST_ROOT", "")
+
 INVISIBLE = re.compile(r"\x1b\[\d+[;\d]*m|\x1b\[\d*\;\d*\;\d*m")
 TMP_DIR = '/tmp/.ddct/'
 FIXES_FILE = os.path.join(TMP_DIR, 'fixes_run')
+AGENT_SOCKET = os.path.join(TMP_DIR, "agent.sock")
+MANIFEST_FILE = os.path.join(TMP_DIR, "plugin_manifest.json")
+CHECK_CACHE_FILE = os.path.join(TMP_DIR, "check_cache.json")
+SSH_CHUNK = 32768
+# Seconds between polls of a running SSH command
+SSH_POLL = 0.05
 
 UBUNTU = "ubuntu"
 DEBIAN = "debian"
@@ -63,7 +76,10 @@ SUPPORTED_OS_TYPES = {UBUNTU, DEBIAN, CENTOS7, CENTOS6, RHEL}
 
 
 def get_config():
+    from dfs_sdk import scaffold
     api = scaffold.get_api(strict=False)
+    if spans.ENABLED:
+        api = ApiProxy(api)
     config = scaffold.get_config()
     config['api'] = api
     access_paths = api.system.network.access_vip.get()['network_paths']
@@ -76,6 +92,7 @@ def get_config():
 def get_latest_driver_version(tag_url):
     found = []
     weighted_found = []
+    import requests
     tags = requests.get(tag_url).json()
     for tag in tags:
         tag = tag['name'].strip("v")
@@ -114,10 +131,32 @@ def strip_invisible(s):
     return re.sub(INVISIBLE, "", s)
 
 
+def report_width():
+    """
+    Columns the report is fit into, None when wrapping is turned off
+    """
+    if not WRAPTXT:
+        return None
+    return REPORT_WIDTH or terminal_width()
+
+
 PLUGIN_LOC = os.path.join(os.path.dirname(__file__), "plugins")
 VERBOSE = False
 WARNINGS = True
+# Add host state to the report, -k/--host-state
+HOST_STATE = False
+# Replay results of checks declaring inputs when the inputs are unchanged,
+# --no-cache turns this off
+CHECK_CACHE = True
 WRAPTXT = True
+# Report layout: every reason and fix, one line per check, or only counts
+# and the checks that didn't pass
+REPORT_FULL = "full"
+REPORT_COMPACT = "compact"
+REPORT_SUMMARY = "summary"
+REPORT_MODE = REPORT_FULL
+# Report width in columns, None to use the terminal width
+REPORT_WIDTH = None
 
 
 SUCCESS = apply_color("Success", color="green")
@@ -138,14 +177,16 @@ FIX_GLOB = "fix_*.py"
 INSTALL_RE = re.compile(r".*install_(.*)\.py")
 INSTALL_GLOB = "install_*.py"
 
-IP_ROUTE_RE = re.compile(
-    r"^(?P<net>[\w|\.|:|/]+).*dev\s(?P<iface>[\w|\.|:]+).*?$")
+PLUGIN_CHECK = "check"
+PLUGIN_FIX = "fix"
+PLUGIN_INSTALL = "install"
 
+PLUGIN_KINDS = {PLUGIN_CHECK: (CHECK_RE, CHECK_GLOB),
+                PLUGIN_FIX: (FIX_RE, FIX_GLOB),
+                PLUGIN_INSTALL: (INSTALL_RE, INSTALL_GLOB)}
 
-def _wraptxt(txt, fill):
-    if WRAPTXT:
-        return textwrap.fill(txt, fill)
-    return txt
+IP_ROUTE_RE = re.compile(
+    r"^(?P<net>[\w|\.|:|/]+).*dev\s(?P<iface>[\w|\.|:]+).*?$")
 
 
 class Report(object):
@@ -156,10 +197,15 @@ class Report(object):
         self.warning = {}
         self.warning_id = {}
         self.warning_by_id = {}
+        # {name: [fix or None]}, one entry per reason.  A code reported once
+        # per NIC, LUN, ... can have a different fix each time while
+        # fix_by_id only keeps the last one
+        self.warning_fix = {}
         self.fix_by_id = {}
         self.failure = {}
         self.failure_id = {}
         self.failure_by_id = {}
+        self.failure_fix = {}
         self.tags = {}
         self.host_state = {}
 
@@ -186,9 +232,12 @@ class Report(object):
             if name not in self.warning:
                 self.warning[name] = []
                 self.warning_id[name] = []
+                self.warning_fix[name] = []
             self.warning[name].append(reason)
             self.warning_id[name].append(uid)
             self.warning_by_id[uid] = (name, reason)
+            self.warning_fix[name].append(
+                self.format_fix(fix, uid) if fix else None)
             if fix:
                 self.fix_by_id[uid] = self.format_fix(fix, uid)
             if name not in tags:
@@ -201,9 +250,12 @@ class Report(object):
         if name not in self.failure:
             self.failure[name] = []
             self.failure_id[name] = []
+            self.failure_fix[name] = []
         self.failure[name].append(reason)
         self.failure_id[name].append(uid)
         self.failure_by_id[uid] = (name, reason)
+        self.failure_fix[name].append(
+            self.format_fix(fix, uid) if fix else None)
         if fix:
             self.fix_by_id[uid] = self.format_fix(fix, uid)
         if name not in tags:
@@ -218,84 +270,82 @@ class Report(object):
             self.host_state = self.hostname
         self.host_state[key] = value
 
-    def generate(self):
+    def generate(self, mode=None, width=None):
+        s = StringIO()
+        self.write(s, mode=mode, width=width)
+        return s.getvalue()[:-1]
+
+    def write(self, out, mode=None, width=None):
+        """
+        Streams the report to the file object out.  mode is REPORT_FULL
+        (every reason and fix), REPORT_COMPACT (one line per check) or
+        REPORT_SUMMARY (counts and the checks that didn't pass).  Reasons
+        are wrapped to fit width, which defaults to REPORT_WIDTH or the
+        terminal width.  --no-wrap turns wrapping off
+        """
+        mode = mode or REPORT_MODE
+        width = width or report_width()
         if not self.hostname:
             self.hostname = socket.gethostname()
-        # try:
-        #     longest = max(map(
-        #         lambda x: len(x),
-        #         [val for sublist in
-        #             list(self.failure.values()) + list(self.warning.values())
-        #             for val in sublist]))
-        # except ValueError:
-        #     longest = 30
-        wrap = 60
-        s = list(map(lambda x: (
-            x,
-            SUCCESS,
-            "",
-            "",
-            "\n".join(sorted(self.tags[x]))),
-            sorted(self.success)))
-
-        w = []
-        for name, wids in sorted(self.warning_id.items()):
-            warnings = []
-            for wid in wids:
-                warnings.append(self.warning_by_id[wid][1])
-                fix = self.fix_by_id.get(wid)
-                if fix:
-                    warnings.append(fix)
-            for index, warning in enumerate(warnings):
-                warnings[index] = _wraptxt(warning, wrap) + "\n"
-            w.append([name,
-                      WARNING,
-                      "\n".join(warnings),
-                      "\n".join(sorted(self.tags[name]))])
-        f = []
-        for name, fids in sorted(self.failure_id.items()):
-            failures = []
-            for fid in fids:
-                failures.append(self.failure_by_id[fid][1])
-                fix = self.fix_by_id.get(fid)
-                if fix:
-                    failures.append(fix)
-            for index, failure in enumerate(failures):
-                failures[index] = _wraptxt(failure, wrap)
-            f.append([name,
-                      FAILURE,
-                      "\n".join(failures),
-                      "\n".join(sorted(self.tags[name]))])
-
-        r1 = tabulate(
-            f + w + s,
-            headers=["Test", "Status", "Reasons", "Tags"],
-            tablefmt="grid")
-
+        out.write("HOST: {}\n".format(self.hostname))
+        if mode == REPORT_SUMMARY:
+            self._write_summary(out, width)
+            return
+        compact = mode == REPORT_COMPACT
+        grid = Grid(["Test", "Status", "Reasons", "Tags"], wrap=(2,),
+                    max_width=width, compact=compact)
+        for issues, fixes, status in ((self.failure, self.failure_fix,
+                                       FAILURE),
+                                      (self.warning, self.warning_fix,
+                                       WARNING)):
+            for name in sorted(issues):
+                reasons = []
+                for issue, fix in zip(issues[name], fixes[name]):
+                    reasons.append(issue)
+                    if fix and not compact:
+                        reasons.append(fix)
+                grid.add_row([name, status, reasons,
+                              sorted(self.tags[name])])
+        for name in sorted(self.success):
+            grid.add_row([name, SUCCESS, "", sorted(self.tags[name])])
+        grid.write(out)
         if self.host_state:
-            s = []
-            for k, v in self.host_state.items():
-                if type(v) == dict:
-                    acc1 = []
-                    for a, b in sorted(v.items()):
-                        if type(b) == dict:
-                            acc2 = []
-                            for c, d in sorted(b.items()):
-                                acc2.append("  {}: {}".format(c, d))
-                            b = "\n".join(acc2)
-                            acc1.append("{}:\n{}".format(a, b))
-                        else:
-                            acc1.append("{}: {}".format(a, b))
-                    v = "\n".join(acc1)
-                s.append((k, v))
-            r2 = tabulate(
-                sorted(s),
-                headers=["State", "Value"],
-                tablefmt="grid")
-            result = "\n".join(("HOST: {}".format(self.hostname), r1, r2))
-        else:
-            result = r1
-        return result
+            grid = Grid(["State", "Value"], wrap=(1,), max_width=width,
+                        compact=compact)
+            for key, value in sorted(self.host_state.items()):
+                grid.add_row([key, self.state_lines(value, compact)])
+            grid.write(out)
+
+    @staticmethod
+    def state_lines(value, compact=False):
+        """
+        Lines for one host state value, shared by the report and the daemon
+        view.  compact puts each nested dict on a single line
+        """
+        if not isinstance(value, dict):
+            return ["{}".format(value)]
+        lines = []
+        for a, b in sorted(value.items()):
+            if not isinstance(b, dict):
+                lines.append("{}: {}".format(a, b))
+            elif compact:
+                lines.append("{}: {}".format(a, ", ".join(
+                    "{}={}".format(c, d) for c, d in sorted(b.items()))))
+            else:
+                lines.append("{}:".format(a))
+                lines.extend("  {}: {}".format(c, d)
+                             for c, d in sorted(b.items()))
+        return lines
+
+    def _write_summary(self, out, width):
+        out.write("{} checks: {} passed, {} warnings, {} failed\n".format(
+            len(set(self.success) | set(self.warning) | set(self.failure)),
+            len(self.success), len(self.warning), len(self.failure)))
+        for ids, status in ((self.failure_id, FAILURE),
+                            (self.warning_id, WARNING)):
+            for name in sorted(ids):
+                out.write(truncate("{} {}: {}".format(
+                    status, name, ", ".join(ids[name])), width) + "\n")
 
     def gen_json(self):
         if not self.hostname:
@@ -307,6 +357,15 @@ class Report(object):
                 "tags": {k: list(v) for k, v in self.tags.items()},
                 "host_state": self.host_state}
 
+    def get_status(self, name):
+        if name in self.failure:
+            return FAILURE
+        if name in self.warning:
+            return WARNING
+        if name in self.success:
+            return SUCCESS
+        return None
+
     def code_list(self):
         result = []
         if WARNINGS:
@@ -318,25 +377,41 @@ class Report(object):
 
 report = Report()
 fixes_run = set()
+_ssh_pool = {}
+_ssh_lock = threading.Lock()
+_facts = {}
+_run_facts = {}
+_manifest = None
+_manifest_lock = threading.Lock()
+_check_cache = None
+_check_cache_lock = threading.Lock()
+# Per check thread list of the ff/wf/hs calls made by a cacheable check
+_recorder = threading.local()
 
 
 def reset_checks():
     global report
     report = Report()
+    _run_facts.clear()
 
 
 def idempotent(fix):
     @functools.wraps(fix)
-    def _wrapper():
+    def _wrapper(*args):
         if fix.__name__ in fixes_run:
             return
-        fix()
+        fix(*args)
         fixes_run.add(fix.__name__)
 
+    # Python 2's functools.wraps doesn't set this, the fix planner uses it
+    # to inspect the wrapped signature
+    _wrapper.__wrapped__ = fix
     return _wrapper
 
 
 def load_run_fixes():
+    if not os.path.exists(FIXES_FILE):
+        return
     with io.open(FIXES_FILE, 'r') as f:
         for fix in json.loads(f.read()):
             fixes_run.add(fix)
@@ -344,11 +419,13 @@ def load_run_fixes():
 
 def save_run_fixes():
     j = json.dumps(list(fixes_run))
+    if not os.path.isdir(TMP_DIR):
+        os.makedirs(TMP_DIR)
     with io.open(FIXES_FILE, 'w+') as f:
         f.write(j)
 
 
-def check(test_name, *tags):
+def check(test_name, *tags, **kwargs):
     """
     Decorator to be used for checks that automatically calls sf() at the
     end of the check.
@@ -369,55 +446,347 @@ def check(test_name, *tags):
             if not some_condition:
                 ff(name, "We Failed!")
             sf(name)
+
+    Checks that only depend on the config and a few files, sysctl values or
+    command outputs can list them as inputs, see input_fingerprint():
+
+        @check("Test Name", "tag", inputs=["file:/etc/some.conf"])
+
+    When the inputs are unchanged since the last run the recorded ff/wf/hs
+    calls are replayed instead of running the check.
     """
+    # Python 2 has no keyword-only arguments
+    inputs = kwargs.pop("inputs", None)
+    if kwargs:
+        raise TypeError("Unexpected check arguments: {}".format(
+            ", ".join(kwargs)))
+
     def _outer(func):
         @functools.wraps(func)
         def _inner_check_func(*args, **kwargs):
             tname = test_name  # noqa
             ttags = tags  # noqa
-            result = func(*args, **kwargs)
+            with span("check", test_name):
+                if inputs is None or not CHECK_CACHE:
+                    result = func(*args, **kwargs)
+                else:
+                    result = _cached_check(test_name, inputs, func, args,
+                                           kwargs)
             sf()
             return result
         _inner_check_func._tags = tags
+        _inner_check_func._name = test_name
+        _inner_check_func._inputs = inputs
         return _inner_check_func
     return _outer
 
 
-def load_plugins(regex, globx):
+def input_fingerprint(spec):
+    """
+    Fingerprints one check input:
+
+        file:<path>    mtime, size and inode (for regular files)
+        hash:<path>    SHA-256 of the contents (for /proc and /sys files)
+        sysctl:<key>   the current value
+        cmd:<command>  SHA-256 of the command output
+
+    Paths are resolved under HOST_ROOT.  Missing inputs fingerprint as None
+    """
+    kind, _, arg = spec.partition(":")
+    if kind == "file":
+        try:
+            st = os.stat(host_path(arg))
+        except OSError:
+            return None
+        return [st.st_mtime, st.st_size, st.st_ino]
+    if kind == "hash":
+        try:
+            with io.open(host_path(arg), 'rb') as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except (IOError, OSError):
+            return None
+    if kind == "sysctl":
+        return read_sysfs("/proc/sys/" + arg.replace(".", "/"))
+    if kind == "cmd":
+        try:
+            out = exe(arg)
+        except subprocess.CalledProcessError as e:
+            return e.returncode
+        return hashlib.sha256(out.encode("utf-8")).hexdigest()
+    raise ValueError("Unknown check input: {}".format(spec))
+
+
+def check_fingerprint(inputs, args):
+    """
+    Combines the fingerprints of inputs with the plain config values
+    """
+    config = args[0] if args and isinstance(args[0], dict) else {}
+    plain = {k: v for k, v in config.items()
+             if isinstance(v, (str, bytes, int, float, bool, type(None)))}
+    data = json.dumps([plain, [input_fingerprint(spec) for spec in inputs]],
+                      sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def _load_check_cache():
+    global _check_cache
+    with _check_cache_lock:
+        if _check_cache is None:
+            try:
+                with io.open(CHECK_CACHE_FILE, 'r') as f:
+                    _check_cache = json.loads(f.read())
+            except (IOError, OSError, ValueError):
+                _check_cache = {}
+        return _check_cache
+
+
+def save_check_cache():
+    """
+    Persists the recorded check results so the next ddct process can
+    replay them.  Entries that aren't JSON serializable are dropped
+    """
+    if not _check_cache:
+        return
+    with _check_cache_lock:
+        entries = {}
+        for name, entry in _check_cache.items():
+            try:
+                json.dumps(entry)
+            except (TypeError, ValueError):
+                continue
+            entries[name] = entry
+    if not os.path.isdir(TMP_DIR):
+        os.makedirs(TMP_DIR)
+    tmp = CHECK_CACHE_FILE + ".tmp"
+    with io.open(tmp, 'w') as f:
+        f.write(json.dumps(entries))
+    os.rename(tmp, CHECK_CACHE_FILE)
+
+
+def clear_check_cache():
+    global _check_cache
+    with _check_cache_lock:
+        _check_cache = {}
+    if os.path.exists(CHECK_CACHE_FILE):
+        os.remove(CHECK_CACHE_FILE)
+
+
+def _record(*call):
+    calls = getattr(_recorder, "calls", None)
+    if calls is not None:
+        calls.append(list(call))
+
+
+def _cached_check(name, inputs, func, args, kwargs):
+    fingerprint = check_fingerprint(inputs, args)
+    cache = _load_check_cache()
+    entry = cache.get(name)
+    if entry and entry["fingerprint"] == fingerprint:
+        vprint("Inputs unchanged, replaying cached result for", name)
+        replay = {"ff": ff, "wf": wf, "hs": hs}
+        for call in entry["calls"]:
+            replay[call[0]](*call[1:])
+        return None
+    _recorder.calls = []
+    try:
+        result = func(*args, **kwargs)
+        # Only completed checks are cached, an exception propagates as-is
+        with _check_cache_lock:
+            cache[name] = {"fingerprint": fingerprint,
+                           "calls": _recorder.calls}
+    finally:
+        _recorder.calls = None
+    return result
+
+
+def _literal(node):
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        return None
+
+
+def scan_plugin(path):
+    """
+    Statically reads a plugin file without importing it.  Returns the
+    checks declared with @check (function, test name and tags) and the
+    codes returned by load_fixes
+    """
+    with io.open(path, 'rb') as f:
+        tree = ast.parse(f.read(), path)
+    checks = []
+    declared = None
+    codes = []
+    for node in tree.body:
+        if not isinstance(node, ast.FunctionDef):
+            continue
+        for dec in node.decorator_list:
+            if (isinstance(dec, ast.Call) and
+                    getattr(dec.func, "id", None) == "check" and dec.args):
+                args = [_literal(arg) for arg in dec.args]
+                checks.append({"func": node.name,
+                               "name": args[0],
+                               "tags": [a for a in args[1:] if a]})
+        for sub in ast.walk(node):
+            if not isinstance(sub, ast.Return) or sub.value is None:
+                continue
+            if node.name == "load_checks" and isinstance(
+                    sub.value, (ast.List, ast.Tuple)):
+                declared = [getattr(e, "id", None) for e in sub.value.elts]
+            elif node.name == "load_fixes" and isinstance(
+                    sub.value, ast.Dict):
+                codes = [_literal(k) for k in sub.value.keys]
+    if declared is not None:
+        checks = [c for c in checks if c["func"] in declared]
+    return {"checks": checks, "codes": sorted(c for c in codes if c)}
+
+
+def _entry_point_plugins(kind):
+    """
+    Returns [(name, module_name)] for third-party plugins registered under
+    the 'ddct.<kind>_plugins' entry point group
+    """
+    group = "ddct.{}_plugins".format(kind)
+    try:
+        from importlib import metadata
+        eps = metadata.entry_points()
+        if hasattr(eps, "select"):
+            eps = eps.select(group=group)
+        else:
+            eps = eps.get(group, [])
+        return [(ep.name, ep.value.split(":")[0]) for ep in eps]
+    except ImportError:
+        pass
+    try:
+        import pkg_resources
+    except ImportError:
+        return []
+    return [(ep.name, ep.module_name)
+            for ep in pkg_resources.iter_entry_points(group)]
+
+
+def _module_path(module):
+    try:
+        from importlib.util import find_spec
+        spec = find_spec(module)
+        return spec.origin if spec else None
+    except ImportError:
+        import pkgutil
+        loader = pkgutil.get_loader(module)
+        return loader.get_filename() if loader else None
+
+
+def _plugin_files():
+    """
+    Yields (kind, name, module, path) for every builtin and entry point
+    plugin
+    """
+    for kind, (regex, globx) in PLUGIN_KINDS.items():
+        for path in glob.glob(os.path.join(PLUGIN_LOC, globx)):
+            name = regex.match(path).groups(1)[0]
+            yield kind, name, "plugins." + os.path.basename(path)[:-3], path
+        for name, module in _entry_point_plugins(kind):
+            yield kind, name, module, _module_path(module)
+
+
+def plugin_manifest(kind=None):
+    """
+    Returns the cached plugin manifest, rescanning only the plugin files
+    whose mtime or size changed since the manifest was written.  If kind is
+    given only plugins of that kind are returned as {name: entry}
+    """
+    global _manifest
+    with _manifest_lock:
+        if _manifest is None:
+            cached = {}
+            try:
+                with io.open(MANIFEST_FILE, 'r') as f:
+                    cached = json.loads(f.read())
+            except (IOError, OSError, ValueError):
+                pass
+            manifest = {}
+            changed = False
+            for pkind, name, module, path in _plugin_files():
+                key = "{}:{}".format(pkind, name)
+                try:
+                    st = os.stat(path)
+                    mtime, size = st.st_mtime, st.st_size
+                except (OSError, TypeError):
+                    mtime, size = None, None
+                entry = cached.get(key)
+                if (not entry or entry["path"] != path or
+                        entry["mtime"] != mtime or entry["size"] != size):
+                    vprint("Scanning plugin", path)
+                    entry = {"name": name,
+                             "kind": pkind,
+                             "module": module,
+                             "path": path,
+                             "mtime": mtime,
+                             "size": size,
+                             "checks": [],
+                             "codes": []}
+                    if mtime is not None:
+                        entry.update(scan_plugin(path))
+                    changed = True
+                manifest[key] = entry
+            if changed or set(manifest) != set(cached):
+                try:
+                    if not os.path.isdir(TMP_DIR):
+                        os.makedirs(TMP_DIR)
+                    with io.open(MANIFEST_FILE, 'w') as f:
+                        f.write(str(json.dumps(manifest)))
+                except (IOError, OSError):
+                    vprint("Could not write plugin manifest", MANIFEST_FILE)
+            _manifest = manifest
+    if kind is None:
+        return _manifest
+    return {entry["name"]: entry for entry in _manifest.values()
+            if entry["kind"] == kind}
+
+
+def load_plugins(kind, names=None):
+    """
+    Imports and returns {name: module} for the requested plugins of the
+    given kind.  Only the named plugins are imported, names=None imports
+    all of them
+    """
     found = {}
-    RE = re.compile(regex)
-    path = glob.glob(os.path.join(PLUGIN_LOC, globx))
-    for file in path:
-        name = RE.match(file).groups(1)[0]
-        mod = importlib.import_module("plugins." + os.path.basename(file)[:-3])
-        found[name] = mod
+    for name, entry in plugin_manifest(kind).items():
+        if names is not None and name not in names:
+            continue
+        found[name] = importlib.import_module(entry["module"])
     return found
 
 
-def check_load():
-    return load_plugins(CHECK_RE, CHECK_GLOB)
+def check_load(names=None):
+    return load_plugins(PLUGIN_CHECK, names)
 
 
-def fix_load():
-    return load_plugins(FIX_RE, FIX_GLOB)
+def fix_load(names=None):
+    return load_plugins(PLUGIN_FIX, names)
 
 
-def install_load():
-    return load_plugins(INSTALL_RE, INSTALL_GLOB)
+def install_load(names=None):
+    return load_plugins(PLUGIN_INSTALL, names)
 
 
 def check_plugin_table():
-    checks = map(lambda x: [x], check_load())
+    from tabulate import tabulate
+    checks = map(lambda x: [x],
+                 sorted(plugin_manifest(PLUGIN_CHECK)))
     print(tabulate(checks, headers=["Check Plugins"], tablefmt="grid"))
 
 
 def fix_plugin_table():
-    fixes = map(lambda x: [x], fix_load())
+    from tabulate import tabulate
+    fixes = map(lambda x: [x], sorted(plugin_manifest(PLUGIN_FIX)))
     print(tabulate(fixes, headers=["Fix Plugins"], tablefmt="grid"))
 
 
 def install_plugin_table():
-    installs = map(lambda x: [x], install_load())
+    from tabulate import tabulate
+    installs = map(lambda x: [x],
+                   sorted(plugin_manifest(PLUGIN_INSTALL)))
     print(tabulate(installs, headers=["Install Plugins"], tablefmt="grid"))
 
 
@@ -441,14 +810,50 @@ def parse_mconf(data):
     return _helper(iter(data.splitlines()))
 
 
+def host_fact(func):
+    """
+    Caches the result of a host fact lookup (OS, package manager, etc) so
+    it is only computed once per process.  reset_facts() clears the cache
+    """
+    @functools.wraps(func)
+    def _wrapper():
+        if func.__name__ not in _facts:
+            _facts[func.__name__] = func()
+        return _facts[func.__name__]
+    return _wrapper
+
+
+def reset_facts():
+    _facts.clear()
+
+
+def run_fact(func):
+    """
+    Like host_fact, but for values that change over time (memory usage,
+    counters).  The result is shared by every check in a run and cleared
+    by reset_checks()
+    """
+    key = "{}.{}".format(func.__module__, func.__name__)
+
+    @functools.wraps(func)
+    def _wrapper():
+        if key not in _run_facts:
+            _run_facts[key] = func()
+        return _run_facts[key]
+    return _wrapper
+
+
+@host_fact
 def get_pkg_manager():
-    if exe_check("which apt-get > /dev/null 2>&1", err=False):
+    if which("apt-get"):
         return APT
-    if exe_check("which yum > /dev/null 2>&1", err=False):
+    if which("yum"):
         return YUM
 
 
+@host_fact
 def get_os():
+    import distro
     did = distro.id()
     if did == CENTOS:
         version = distro.version()
@@ -479,6 +884,7 @@ def sf():
 
 # Fail Func
 def ff(reasons, uid, fix=None):
+    _record("ff", reasons, uid, fix)
     name, tags = _lookup_vars()
     if type(reasons) not in (list, tuple):
         report.add_failure(name, reasons, uid, tags, fix=fix)
@@ -488,6 +894,7 @@ def ff(reasons, uid, fix=None):
 
 # Warn Func
 def wf(reasons, uid, fix=None):
+    _record("wf", reasons, uid, fix)
     name, tags = _lookup_vars()
     if type(reasons) not in (list, tuple):
         report.add_warning(name, reasons, uid, tags, fix=fix)
@@ -496,7 +903,10 @@ def wf(reasons, uid, fix=None):
 
 
 def hs(k, v):
-    report.add_host_state(k, v)
+    # Recorded either way so a cached result replays it for a -k run
+    _record("hs", k, v)
+    if HOST_STATE:
+        report.add_host_state(k, v)
 
 
 def gen_report(outfile=None, quiet=False, ojson=False, push_data=False):
@@ -512,10 +922,14 @@ def gen_report(outfile=None, quiet=False, ojson=False, push_data=False):
 
     if ojson:
         results = report.gen_json()
-    else:
+    elif outfile:
         results = report.generate()
+    else:
+        # Only stdout needs the text, it is streamed there below
+        results = None
 
     if push_data:
+        from dfs_sdk import ApiError
         print("Pushing results to cluster")
         config = get_config()
         api = config['api']
@@ -532,6 +946,8 @@ def gen_report(outfile=None, quiet=False, ojson=False, push_data=False):
         _writer(results, outfile)
     if ojson and not quiet:
         print(json.dumps(results, indent=4))
+    elif not quiet and results is None:
+        report.write(sys.stdout)
     elif not quiet:
         print(results)
 
@@ -581,54 +997,201 @@ def verbose():
         VERBOSE = old
 
 
+def host_path(path):
+    return HOST_ROOT + path
+
+
+def read_sysfs(path, default=None):
+    """
+    Returns the stripped contents of a /sys or /proc file (relative to
+    HOST_ROOT) or default if it can't be read
+    """
+    try:
+        with io.open(host_path(path), 'r') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return default
+
+
+def list_sysfs(path):
+    try:
+        return sorted(os.listdir(host_path(path)))
+    except (IOError, OSError):
+        return []
+
+
+def one_of(*values):
+    """
+    Validators return (predicate, description) for sysfs string values
+    """
+    return (lambda v: v in values, "one of {}".format("/".join(values)))
+
+
+def at_least(minimum):
+    return (lambda v: v.isdigit() and int(v) >= minimum,
+            ">= {}".format(minimum))
+
+
+def at_most(maximum):
+    return (lambda v: v.isdigit() and int(v) <= maximum,
+            "<= {}".format(maximum))
+
+
+def parse_cpulist(cpulist):
+    """
+    Parses a kernel cpu list like "0-3,8,10-11" into a sorted list of ints
+    """
+    cpus = set()
+    for part in (cpulist or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
 def exe(cmd):
     vprint("Running cmd:", cmd)
-    return subprocess.check_output(cmd, shell=True).decode("utf-8")
+    with span("exe", cmd) as attrs:
+        try:
+            out = subprocess.check_output(cmd, shell=True).decode("utf-8")
+        except subprocess.CalledProcessError as e:
+            attrs["exit_code"] = e.returncode
+            raise
+        attrs.update(exit_code=0, bytes=len(out))
+    return out
+
+
+def which(binary):
+    """
+    Returns the path of binary on PATH or None.  Use this instead of
+    exe_check("which ...") to avoid forking a shell per lookup
+    """
+    return _which(binary)
 
 
 def exe_check(cmd, err=False):
-    try:
-        vprint(exe(cmd))
-        if err:
-            return False
-        return True
-    except subprocess.CalledProcessError:
-        if not err:
-            return False
-        return True
+    with span("exe_check", cmd) as attrs:
+        try:
+            vprint(exe(cmd))
+            attrs["result"] = not err
+        except subprocess.CalledProcessError:
+            attrs["result"] = err
+    return attrs["result"]
 
 
-def cluster_cmd(cmd, config, fail_ok=False):
+def get_ssh(hostname, username="root", password=None, keyfile=None,
+            port=22, timeout=None):
+    """
+    Returns a connected SSHClient for the given host, reusing an already
+    open connection from the pool when its transport is still active.
+    """
+    key = (hostname, int(port), username)
+    with _ssh_lock:
+        ssh = _ssh_pool.get(key)
+    if ssh is not None:
+        transport = ssh.get_transport()
+        if transport and transport.is_active():
+            return ssh
+    import paramiko
     ssh = paramiko.SSHClient()
     ssh.set_missing_host_key_policy(
         paramiko.AutoAddPolicy())
+    vprint("Opening SSH connection to {}@{}:{}".format(
+        username, hostname, port))
+    ssh.connect(hostname=hostname,
+                port=int(port),
+                username=username,
+                password=password,
+                key_filename=keyfile,
+                timeout=timeout,
+                banner_timeout=60)
+    with _ssh_lock:
+        old = _ssh_pool.get(key)
+        _ssh_pool[key] = ssh
+    if old is not None:
+        old.close()
+    return ssh
+
+
+def close_ssh():
+    with _ssh_lock:
+        clients = list(_ssh_pool.values())
+        _ssh_pool.clear()
+    for ssh in clients:
+        ssh.close()
+
+
+def ssh_exe(ssh, cmd, timeout=None):
+    """
+    Runs cmd over an open SSHClient and returns (exit_status, stdout, stderr)
+    with the output decoded.  Raises socket.timeout and closes the channel
+    if the command does not finish within timeout seconds in total.
+    """
+    _, stdout, stderr = ssh.exec_command(cmd, timeout=timeout)
+    chan = stdout.channel
+    deadline = None if timeout is None else time.time() + timeout
+    out, err = [], []
+    # exec_command's timeout only bounds each read, so a command that keeps
+    # printing would never time out.  Drain both streams until it exits
+    while not chan.exit_status_ready():
+        if deadline is not None and time.time() > deadline:
+            chan.close()
+            raise socket.timeout("'{}' did not finish within {}s".format(
+                cmd, timeout))
+        if chan.recv_ready():
+            out.append(chan.recv(SSH_CHUNK))
+        elif chan.recv_stderr_ready():
+            err.append(chan.recv_stderr(SSH_CHUNK))
+        else:
+            time.sleep(SSH_POLL)
+    out.append(stdout.read())
+    err.append(stderr.read())
+    exit_status = chan.recv_exit_status()
+    return (int(exit_status), b"".join(out).decode("utf-8", "replace"),
+            b"".join(err).decode("utf-8", "replace"))
+
+
+def cluster_ssh(config, timeout=None):
+    """
+    Returns a pooled SSH connection to the cluster.  cluster_ssh_host,
+    cluster_ssh_port and cluster_ssh_user default to the mgmt_ip, 22 and
+    root and can point at a local sshd for testing
+    """
     if config.get('cluster_root_keyfile'):
-        ssh.connect(hostname=config['mgmt_ip'],
-                    username='root',
-                    banner_timeout=60,
-                    pkey=config.get('cluster_root_keyfile'))
+        creds = {"keyfile": config.get('cluster_root_keyfile')}
     elif config.get('cluster_root_password'):
-        ssh.connect(hostname=config['mgmt_ip'],
-                    username='root',
-                    password=config.get('cluster_root_password'),
-                    banner_timeout=60)
+        creds = {"password": config.get('cluster_root_password')}
     else:
         raise ValueError("Missing cluster_root_keyfile or "
                          "cluster_root_password for this test")
+    return get_ssh(config.get('cluster_ssh_host') or config['mgmt_ip'],
+                   username=config.get('cluster_ssh_user') or "root",
+                   port=config.get('cluster_ssh_port') or 22,
+                   timeout=timeout, **creds)
+
+
+def cluster_cmd(cmd, config, fail_ok=False):
+    ssh = cluster_ssh(config)
     msg = "Executing command: {} on Cluster".format(cmd)
     vprint(msg)
-    _, stdout, stderr = ssh.exec_command(cmd)
-    exit_status = stdout.channel.recv_exit_status()
+    with span("cluster_cmd", cmd) as attrs:
+        exit_status, stdout, stderr = ssh_exe(ssh, cmd)
+        attrs.update(exit_code=exit_status, bytes=len(stdout))
     result = None
-    if int(exit_status) == 0:
-        result = stdout.read()
+    if exit_status == 0:
+        result = stdout
     elif fail_ok:
-        result = stderr.read()
+        result = stderr
     else:
         raise EnvironmentError(
             "Nonzero return code: {} stderr: {}".format(
                 exit_status,
-                stderr.read()))
+                stderr))
     return result
 
 
@@ -638,6 +1201,7 @@ def is_l3(config):
 
 
 def parse_route_table():
+    import ipaddress
     results = []
     data = exe("ip route show")
     for line in data.splitlines():
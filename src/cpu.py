@@ -0,0 +1,188 @@
+from __future__ import (print_function, unicode_literals, division,
+                        absolute_import)
+
+import re
+import time
+
+from common import vprint, check, ff, wf, hs, read_sysfs, list_sysfs
+
+SYS_CPU = "/sys/devices/system/cpu"
+CPU_RE = re.compile(r"^cpu(\d+)$")
+PSTATE_DRIVERS = ("intel_pstate", "amd_pstate")
+SAMPLE_WINDOW = 1.0
+SAMPLES = 5
+# Idle states that take longer than this (us) to exit add latency to every
+# I/O completion that lands on a sleeping core
+MAX_EXIT_LATENCY = 10
+# Sockets averaging below this share of their maximum frequency while
+# sampled are reported as down-clocking
+DOWNCLOCK_SHARE = 0.8
+
+
+def _int(value):
+    return int(value) if value and value.isdigit() else None
+
+
+def list_cpus():
+    cpus = []
+    for name in list_sysfs(SYS_CPU):
+        match = CPU_RE.match(name)
+        if not match:
+            continue
+        # cpu0 usually has no 'online' file and can't be offlined
+        if read_sysfs("{}/{}/online".format(SYS_CPU, name), "1") == "1":
+            cpus.append(int(match.group(1)))
+    return sorted(cpus)
+
+
+def read_cpu(cpu):
+    base = "{}/cpu{}".format(SYS_CPU, cpu)
+    info = {"socket": _int(read_sysfs(
+                base + "/topology/physical_package_id", "0")) or 0,
+            "governor": read_sysfs(base + "/cpufreq/scaling_governor"),
+            "driver": read_sysfs(base + "/cpufreq/scaling_driver"),
+            "cur_freq": _int(read_sysfs(base + "/cpufreq/scaling_cur_freq")),
+            "max_freq": _int(read_sysfs(base + "/cpufreq/cpuinfo_max_freq")),
+            "scaling_max_freq": _int(read_sysfs(
+                base + "/cpufreq/scaling_max_freq")),
+            "idle_states": {}}
+    for state in list_sysfs(base + "/cpuidle"):
+        path = "{}/cpuidle/{}".format(base, state)
+        name = read_sysfs(path + "/name", state)
+        info["idle_states"][name] = (
+            _int(read_sysfs(path + "/latency", "0")) or 0,
+            read_sysfs(path + "/disable", "0") == "0")
+    return info
+
+
+def read_pstate():
+    """
+    Returns {driver: {attribute: value}} for the p-state drivers present
+    """
+    result = {}
+    for driver in PSTATE_DRIVERS:
+        base = "{}/{}".format(SYS_CPU, driver)
+        attrs = list_sysfs(base)
+        if attrs:
+            result[driver] = {attr: read_sysfs("{}/{}".format(base, attr))
+                              for attr in ("status", "no_turbo",
+                                           "min_perf_pct", "max_perf_pct")
+                              if attr in attrs}
+    return result
+
+
+def sample_freqs(cpus, window, samples):
+    """
+    Reads scaling_cur_freq for every cpu 'samples' times over 'window'
+    seconds and returns {cpu: [khz, ...]}
+    """
+    result = {cpu: [] for cpu in cpus}
+    delay = window / max(samples - 1, 1)
+    for i in range(samples):
+        if i:
+            time.sleep(delay)
+        for cpu in cpus:
+            freq = _int(read_sysfs(
+                "{}/cpu{}/cpufreq/scaling_cur_freq".format(SYS_CPU, cpu)))
+            if freq:
+                result[cpu].append(freq)
+    return result
+
+
+def summarize(infos, freqs):
+    """
+    Returns per-socket summaries:
+    {socket: {"cpus", "governors", "min_mhz", "avg_mhz", "max_mhz",
+              "hw_max_mhz"}}
+    """
+    sockets = {}
+    for cpu, info in sorted(infos.items()):
+        sock = sockets.setdefault(info["socket"], {
+            "cpus": 0, "governors": {}, "samples": [], "hw_max": 0})
+        sock["cpus"] += 1
+        gov = info["governor"] or "unknown"
+        sock["governors"][gov] = sock["governors"].get(gov, 0) + 1
+        sock["samples"].extend(freqs.get(cpu, []))
+        sock["hw_max"] = max(sock["hw_max"], info["max_freq"] or 0)
+    result = {}
+    for socket, sock in sockets.items():
+        samples = sock["samples"]
+        result[socket] = {
+            "cpus": sock["cpus"],
+            "governors": sock["governors"],
+            "min_mhz": min(samples) // 1000 if samples else None,
+            "avg_mhz": (sum(samples) // len(samples) // 1000
+                        if samples else None),
+            "max_mhz": max(samples) // 1000 if samples else None,
+            "hw_max_mhz": sock["hw_max"] // 1000 or None}
+    return result
+
+
+def deep_idle_states(infos, max_latency):
+    """
+    Returns {state name: (exit latency, cpus with it enabled)} for idle
+    states slower than max_latency
+    """
+    found = {}
+    for info in infos.values():
+        for name, (latency, enabled) in info["idle_states"].items():
+            if enabled and latency > max_latency:
+                _, count = found.get(name, (latency, 0))
+                found[name] = (latency, count + 1)
+    return found
+
+
+@check("CPUFREQ", "basic", "cpufreq", "local")
+def check_cpufreq(config):
+    vprint("Checking cpufreq governors, p-states and idle states")
+    cpus = list_cpus()
+    infos = {cpu: read_cpu(cpu) for cpu in cpus}
+    pstate = read_pstate()
+    scaled = [cpu for cpu in cpus if infos[cpu]["governor"]]
+    state = {"pstate": pstate}
+    if not scaled:
+        hs("cpufreq", state)
+        return wf("No cpufreq governors exposed in sysfs.  If this system "
+                  "is a VM this can be ignored", "36AB43B2")
+    freqs = sample_freqs(
+        scaled, float(config.get("cpufreq_sample_window", SAMPLE_WINDOW)),
+        int(config.get("cpufreq_samples", SAMPLES)))
+    sockets = summarize({cpu: infos[cpu] for cpu in scaled}, freqs)
+    state["sockets"] = sockets
+    state["driver"] = infos[scaled[0]]["driver"]
+    idle = deep_idle_states(infos, int(config.get(
+        "cpuidle_max_latency", MAX_EXIT_LATENCY)))
+    state["deep_idle_states"] = {name: {"latency_us": lat, "cpus": n}
+                                 for name, (lat, n) in idle.items()}
+    hs("cpufreq", state)
+
+    slow = [cpu for cpu in scaled if infos[cpu]["governor"] != "performance"]
+    if slow:
+        governors = sorted(set(infos[cpu]["governor"] for cpu in slow))
+        ff("{}/{} CPUs are not using the 'performance' governor ({})".format(
+            len(slow), len(scaled), ", ".join(governors)), "333FBD45",
+           fix="cpupower frequency-set --governor performance")
+    capped = [cpu for cpu in scaled
+              if infos[cpu]["scaling_max_freq"] and infos[cpu]["max_freq"] and
+              infos[cpu]["scaling_max_freq"] < infos[cpu]["max_freq"]]
+    if capped:
+        wf("{}/{} CPUs have scaling_max_freq below the hardware "
+           "maximum".format(len(capped), len(scaled)), "B63558BD",
+           fix="Raise /sys/devices/system/cpu/cpu*/cpufreq/scaling_max_freq "
+               "to cpuinfo_max_freq")
+    for socket, summary in sorted(sockets.items()):
+        avg, hw_max = summary["avg_mhz"], summary["hw_max_mhz"]
+        if avg and hw_max and avg < hw_max * DOWNCLOCK_SHARE:
+            wf("Socket {} averaged {} MHz over the sample window, {:.0%} of "
+               "its {} MHz maximum".format(socket, avg, avg / hw_max,
+                                           hw_max), "ACC45ABA")
+    for name, (latency, count) in sorted(idle.items()):
+        wf("Idle state {} ({}us exit latency) is enabled on {} CPUs".format(
+            name, latency, count), "AC0349DA",
+           fix="cpupower idle-set -D {} or boot with "
+               "intel_idle.max_cstate=1 processor.max_cstate=1".format(
+                   MAX_EXIT_LATENCY))
+
+
+def load_checks():
+    return [check_cpufreq]
@@ -4,12 +4,13 @@ from __future__ import (print_function, unicode_literals, division,
 
 import curses
 import datetime
+import threading
 import time
 
-from io import StringIO
-
-from checkers import run_checks
-from common import gen_report, reset_checks, strip_invisible
+import common
+from checkers import run_checks, select_checks
+from common import reset_checks, strip_invisible
+from netmon import start_monitor, stop_monitor
 
 INVISIBLE = 0
 VISIBLE = 1
@@ -22,58 +23,262 @@ BLACK = 5
 WHITE = 6
 MAGENTA = 7
 
+# How long getch() waits for a key before the status line is updated
+TICK_MS = 500
+# Rows used by the title, status and help lines
+HEADER = 3
+FOOTER = 1
+
+PENDING = "...."
+STATUS_COLORS = {"FAIL": RED, "WARN": YELLOW, "Success": GREEN,
+                 PENDING: WHITE}
+# 's' cycles through these, None shows every check
+STATUS_FILTERS = (None, "FAIL", "WARN", "Success")
+# Failures first, then warnings, successes and checks still running
+STATUS_ORDER = {"FAIL": 0, "WARN": 1, "Success": 2, PENDING: 3}
+STATUS_WIDTH = 9
+HELP = ("q quit  r run now  p pause  s status filter  t tag filter  "
+        "up/down/PgUp/PgDn scroll")
+
+
+class View(object):
+    """
+    Remembers what each screen row shows so a redraw only rewrites the rows
+    whose content changed.  Lines are tuples of (text, color) segments
+    """
+
+    def __init__(self, scr):
+        self.scr = scr
+        self.drawn = {}
+
+    def invalidate(self):
+        self.drawn.clear()
+        self.scr.clear()
+
+    def draw(self, lines):
+        height, width = self.scr.getmaxyx()
+        for y in range(height):
+            line = clip(lines[y] if y < len(lines) else (), width - 1)
+            if self.drawn.get(y) == line:
+                continue
+            self.scr.move(y, 0)
+            self.scr.clrtoeol()
+            x = 0
+            for text, color in line:
+                self.scr.addstr(y, x, text, curses.color_pair(color))
+                x += len(text)
+            self.drawn[y] = line
+        self.scr.noutrefresh()
+        curses.doupdate()
+
 
-class WinWrap(object):
-    def __init__(self, win, x, y):
-        self.win = win
-        self.xbase = x
-        self.ybase = y
-        self.x = x
-        self.y = y
+def clip(line, width):
+    """
+    Cuts a line of (text, color) segments down to width characters
+    """
+    result = []
+    for text, color in line:
+        if width <= 0:
+            break
+        result.append((text[:width], color))
+        width -= len(text)
+    return tuple(result)
 
-        self.win.nodelay(1)
 
-    def addstr(self, y, x, s, color=0):
-        self.x = x
-        self.y = y
-        self.win.addstr(self.y, self.x, s, curses.color_pair(color))
+def status_label(report, name):
+    status = report.get_status(name)
+    return strip_invisible(status) if status else PENDING
 
-    def addsameln(self, s, color=0):
-        self.win.addstr(self.y, self.x, s, curses.color_pair(color))
-        self.x += len(s)
 
-    def endln(self):
-        self.x = self.xbase
-        self.y += 1
+def issue_lines(report, name):
+    """
+    Returns the reason and fix lines for a check as (text, color) segments
+    """
+    lines = []
+    for reasons, fixes in ((report.failure, report.failure_fix),
+                           (report.warning, report.warning_fix)):
+        for issue, fix in zip(reasons.get(name, []), fixes.get(name, [])):
+            # "ISSUE <uid>: reason"
+            prefix, _, reason = issue.partition(": ")
+            for index, text in enumerate(reason.split("\n")):
+                if index:
+                    lines.append((("  " + text, 0),))
+                else:
+                    lines.append(((prefix + ": ", MAGENTA), (text, 0)))
+            if fix:
+                lines.append(((fix, CYAN),))
+    return lines
 
-    def addln(self, s, color=0):
-        self.win.addstr(self.y, self.x, s, curses.color_pair(color))
-        self.y += 1
-        self.x = self.xbase
 
-    def upy(self, y=1):
-        self.x = self.xbase
-        self.y -= y
+def check_lines(report, checks, status_filter=None, tag_filter=None):
+    """
+    Builds the body: one block per check, worst status first, followed by
+    the host state when nothing is filtered
+    """
+    rows = []
+    for ck in checks:
+        if tag_filter and tag_filter not in ck._tags:
+            continue
+        status = status_label(report, ck._name)
+        if status_filter and status != status_filter:
+            continue
+        rows.append((STATUS_ORDER[status], ck._name, status))
+    if not rows:
+        return [(("No checks match the filter", 0),)]
+    width = max(len(name) for _, name, _ in rows) + 2
+    lines = []
+    for _, name, status in sorted(rows):
+        head = ((status.ljust(STATUS_WIDTH), STATUS_COLORS[status]),
+                (name.ljust(width), 0))
+        issues = issue_lines(report, name)
+        lines.append(head + (issues[0] if issues else ()))
+        indent = (" " * (STATUS_WIDTH + width), 0)
+        lines.extend((indent,) + issue for issue in issues[1:])
+    if report.host_state and not (status_filter or tag_filter):
+        lines.append(())
+        lines.append((("Host State", BLACK),))
+        for key, value in sorted(report.host_state.items()):
+            for index, text in enumerate(
+                    common.Report.state_lines(value, compact=True)):
+                lines.append(((key if not index else "", CYAN),
+                              ("  " + text, 0)))
+    return lines
 
-    def refresh(self, *args):
-        self.win.refresh(*args)
 
-    def clear(self):
-        self.win.clear()
-        self.x = self.xbase
-        self.y = self.ybase
+class Monitor(object):
+    """
+    Runs the checks every interval in a background thread and turns the
+    live report into screen lines.  The body is only rebuilt when a result
+    arrives or the filters change
+    """
 
-    def clrtoeol(self):
-        self.win.clrtoeol()
+    def __init__(self, config, args):
+        self.config = config
+        self.args = args
+        self.checks = select_checks(args.tags, args.not_tags,
+                                    args.use_plugins)
+        self.tags = sorted(set(t for ck in self.checks for t in ck._tags))
+        self.lock = threading.Lock()
+        self.thread = None
+        self.done = 0
+        self.started = None
+        self.updated = None
+        self.next_run = time.time()
+        self.paused = False
+        self.scroll = 0
+        self.status_filter = 0
+        self.tag_filter = 0
+        self.dirty = True
+        self.body = []
 
-    def getch(self):
-        return self.win.getch()
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
 
-    def subpad(self, *args):
-        return self.win.subpad(*args)
+    def _callback(self, ck):
+        with self.lock:
+            self.done += 1
+            self.dirty = True
 
-    def redrawln(self, *args):
-        self.win.redrawln(*args)
+    def _run(self):
+        run_checks(self.config, plugins=self.args.use_plugins,
+                   tags=self.args.tags, not_tags=self.args.not_tags,
+                   callback=self._callback)
+        if self.args.host_state:
+            from state import get_host_state
+            get_host_state(self.config)
+        if self.args.out:
+            common.gen_report(outfile=self.args.out, quiet=True,
+                              ojson=self.args.json)
+        with self.lock:
+            self.updated = datetime.datetime.now()
+            self.next_run = time.time() + float(self.args.interval)
+            self.dirty = True
+
+    def start(self):
+        if self.running:
+            return
+        reset_checks()
+        self.done = 0
+        self.started = time.time()
+        self.dirty = True
+        self.thread = threading.Thread(target=self._run, name="checks")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tick(self):
+        if not (self.paused or self.running) and time.time() >= self.next_run:
+            self.start()
+
+    def handle_key(self, key, page):
+        if key in (ord('r'), ord('R')):
+            self.start()
+        elif key in (ord('p'), ord('P')):
+            self.paused = not self.paused
+        elif key in (ord('s'), ord('S')):
+            self.status_filter = (self.status_filter + 1) % len(
+                STATUS_FILTERS)
+            self.scroll = 0
+            self.dirty = True
+        elif key in (ord('t'), ord('T')):
+            self.tag_filter = (self.tag_filter + 1) % (len(self.tags) + 1)
+            self.scroll = 0
+            self.dirty = True
+        elif key in (curses.KEY_DOWN, ord('j')):
+            self.scroll += 1
+        elif key in (curses.KEY_UP, ord('k')):
+            self.scroll -= 1
+        elif key in (curses.KEY_NPAGE, ord(' ')):
+            self.scroll += page
+        elif key == curses.KEY_PPAGE:
+            self.scroll -= page
+        elif key in (curses.KEY_HOME, ord('g')):
+            self.scroll = 0
+        elif key in (curses.KEY_END, ord('G')):
+            self.scroll = len(self.body)
+
+    def filters(self):
+        status = STATUS_FILTERS[self.status_filter]
+        tag = self.tags[self.tag_filter - 1] if self.tag_filter else None
+        return status, tag
+
+    def status_line(self):
+        report = common.report
+        if self.running:
+            state = "Running checks {}/{} ({:.0f}s)".format(
+                self.done, len(self.checks), time.time() - self.started)
+        elif self.paused:
+            state = "Paused"
+        else:
+            state = "Next run in {:.0f}s".format(
+                max(self.next_run - time.time(), 0))
+        status, tag = self.filters()
+        return ((state, BLACK),
+                ("  {} FAIL".format(len(report.failure)), RED),
+                ("  {} WARN".format(len(report.warning)), YELLOW),
+                ("  {} Success".format(len(report.success)), GREEN),
+                ("  Filter: status={} tag={}".format(status or "all",
+                                                     tag or "all"), 0))
+
+    def lines(self, height):
+        with self.lock:
+            dirty, self.dirty = self.dirty, False
+        if dirty:
+            status, tag = self.filters()
+            self.body = check_lines(common.report, self.checks, status, tag)
+        rows = max(height - HEADER - FOOTER, 1)
+        self.scroll = max(min(self.scroll, len(self.body) - rows), 0)
+        title = "Updated: {}  Plugins: {}  Tags: {}  Not Tags: {}".format(
+            self.updated.strftime("%Y-%m-%d %H:%M:%S") if self.updated
+            else "never", ", ".join(self.args.use_plugins),
+            ", ".join(self.args.tags), ", ".join(self.args.not_tags))
+        lines = [((title, 0),), self.status_line(), ()]
+        lines.extend(self.body[self.scroll:self.scroll + rows])
+        lines.extend(() for _ in range(rows - len(lines) + HEADER))
+        more = len(self.body) - self.scroll - rows
+        lines.append(((HELP + ("  (+{} more)".format(more) if more > 0
+                               else ""), BLACK),))
+        return lines
 
 
 def daemon(stdscr, config, args):
@@ -86,93 +291,28 @@ def daemon(stdscr, config, args):
     curses.init_pair(MAGENTA, curses.COLOR_MAGENTA, curses.COLOR_BLACK)
     curses.init_pair(BLACK, curses.COLOR_BLACK, curses.COLOR_WHITE)
     curses.init_pair(WHITE, curses.COLOR_WHITE, curses.COLOR_BLACK)
-    my, mx = stdscr.getmaxyx()
-    win = WinWrap(curses.newpad(2000, 2000), 1, 1)
-    key = 0
-    # interval = args.interval
-    while key not in (ord('q'), ord('Q')):
-        win.addln("Running Checks...", BLACK)
-        win.clrtoeol()
-        win.refresh(0, 0, 0, 0, my-1, mx-1)
-        reset_checks()
-        run_checks(config, plugins=args.use_plugins, tags=args.tags,
-                   not_tags=args.not_tags)
-        s = StringIO.StringIO()
-        gen_report(outfile=s, quiet=args.quiet, ojson=args.json)
-
-        # Draw Report
-        win.clear()
-        win.refresh(0, 0, 0, 0, my-1, mx-1)
-        win.addln("Updated: " + str(datetime.datetime.now()))
-        win.addln("Plugins: {}".format(", ".join(args.use_plugins)))
-        win.addln("Tags: {}".format(", ".join(args.tags)))
-        win.addln("Not Tags: {}".format(", ".join(args.not_tags)))
-        s.seek(0)
-        data = strip_invisible(s.read())
-        data = data.splitlines()
-        for line in data:
-            parts = line.split("|")
-            if line[0] == "|":
-                win.addsameln("|")
-                for part in parts:
-                    cp = 0
-                    if not part:
-                        continue
-                    elif "FAIL" in part:
-                        cp = RED
-                    elif "Success" in part:
-                        cp = GREEN
-                    elif "WARN" in part:
-                        cp = YELLOW
-                    elif "ISSUE" in part:
-                        length = 15
-                        prefix = part[:length]
-                        part = part[length:]
-                        win.addsameln(prefix, MAGENTA)
-                    elif "FIX" in part:
-                        length = 13
-                        prefix = part[:length]
-                        part = part[length:]
-                        win.addsameln(prefix, CYAN)
-                    win.addsameln(part, cp)
-                    win.addsameln("|")
-                win.endln()
-            else:
-                win.addln(line)
-        # Check for character
-        timeout = float(args.interval)
-        win.addln("")
-        win.addln("Press 'q' or 'Q' to exit")
-        win.addln("Press 'r' or 'R' to reload")
-        win.addln("Press 'p' or 'P' to pause")
-        win.refresh(0, 0, 0, 0, my-1, mx-1)
-        while timeout > 0:
-            key = win.getch()
-            win.addln("Checks will be run in {} seconds".format(timeout))
-            win.clrtoeol()
-            win.upy()
-            win.redrawln(win.y, 1)
-            win.refresh(0, 0, 0, 0, my-1, mx-1)
-            if key < 0:
-                time.sleep(0.2)
-                timeout -= 0.2
-                continue
+    stdscr.keypad(1)
+    stdscr.timeout(TICK_MS)
+    view = View(stdscr)
+    monitor = Monitor(config, args)
+    # Keep sampling NIC/TCP error counters between runs so short bursts
+    # show up in the Network Errors check
+    start_monitor(config, args.interval)
+    try:
+        while True:
+            monitor.tick()
+            height, _ = stdscr.getmaxyx()
+            view.draw(monitor.lines(height))
+            key = stdscr.getch()
             if key in (ord('q'), ord('Q')):
-                curses.curs_set(VISIBLE)
-                curses.endwin()
-                return
-            elif key in (ord('r'), ord('R')):
                 break
-            elif key in (ord('p'), ord('P')):
-                win.addln("Press any key to unpause", BLACK)
-                win.clrtoeol()
-                win.upy()
-                win.refresh(0, 0, 0, 0, my-1, mx-1)
-                subkey = -1
-                while subkey == -1:
-                    subkey = win.getch()
-                    time.sleep(0.1)
-                win.addln("")
-                win.clrtoeol()
-                win.upy()
-                win.refresh(0, 0, 0, 0, my-1, mx-1)
+            if key == curses.KEY_RESIZE:
+                view.invalidate()
+            monitor.handle_key(key, max(height - HEADER - FOOTER, 1))
+        if monitor.running:
+            view.draw([(("Waiting for running checks to finish...",
+                         BLACK),)])
+            monitor.thread.join()
+    finally:
+        stop_monitor()
+        curses.curs_set(VISIBLE)
@@ -7,34 +7,20 @@ Datera Deployment Check Tool
 """
 
 import argparse
-import curses
 import io
 import os
 import sys
 
-
+# Only lightweight modules are imported here.  Everything else (checkers,
+# daemon/curses, fixers, installers, dfs_sdk, ...) is imported by the
+# subcommand that needs it so 'version', '--list-plugins' and
+# '--print-tags' start instantly
 import common
-from common import gen_report, read_report, get_config
-from common import check_plugin_table, fix_plugin_table, install_plugin_table
-from checkers import run_checks, print_tags
-from daemon import daemon
-from fixers import run_fixes, print_fixes
-from installers import run_installers
-
-try:
-    from state import get_host_state
-except ImportError:
-    print("Not able to import from state.py, --host-state will not be "
-          "available")
-    get_host_state = None
-
-try:
-    from dfs_sdk import scaffold
-except ImportError:
-    scaffold = None
+import spans
+from common import AGENT_SOCKET
 
 
-VERSION = "v2.3.0"
+VERSION = "v2.14.0"
 
 VERSION_HISTORY = """
     v1.0.0 -- Initial version
@@ -56,6 +42,25 @@ VERSION_HISTORY = """
               scaffold
     v2.3.0 -- Added k8s_csi_iscsi installer plugin and fixed support for
               plugin-based installers
+    v2.4.0 -- Added "fleet check" for running checks across many hosts over
+              SSH with a merged per-host report
+    v2.5.0 -- Added resident agent ("ddct agent") and "check --agent" client
+    v2.5.1 -- Lazy imports and fast startup for version, --list-plugins and
+              --print-tags
+    v2.6.0 -- Added "ddct netbench" TCP connect latency/throughput probe and
+              the "TCP Probe" check
+    v2.7.0 -- Re-enabled "ddct fix" with a staged, de-duplicated fix plan,
+              concurrent fixes and --dry-run
+    v2.8.0 -- Checkpointed installer steps, concurrent install plugins and
+              a working cinder_volume installer
+    v2.9.0 -- Content-addressed installer artifact cache and "ddct cache"
+              for offline bundles
+    v2.10.0 -- Cached results for checks with declared inputs, --no-cache
+    v2.11.0 -- "check --profile" timing table and Chrome trace output
+    v2.12.0 -- Streaming report renderer, --width, --compact and --summary
+    v2.13.0 -- Daemon view with live progress, scrolling and filters
+    v2.14.0 -- "check --cluster-probe" collecting cluster MTUs, ARP and
+               target sessions in one SSH round trip
 """
 
 
@@ -77,6 +82,10 @@ This only needs to be done once.
 """
 
 WCS = ".wcs"
+# (tag, check flag) of checks that only run when asked for
+OPT_IN_TAGS = (("cluster", "cluster_probe"),
+               ("mpath_bench", "mpath_bench"),
+               ("netbench", "netbench"))
 
 
 def version(args):
@@ -101,22 +110,56 @@ def checker(args):
     # Global flags
     common.VERBOSE = args.verbose
     common.WARNINGS = not args.disable_warnings
+    common.HOST_STATE = args.host_state
     common.WRAPTXT = not args.no_wrap
+    common.CHECK_CACHE = not args.no_cache
+    common.REPORT_WIDTH = args.width
+    if args.compact:
+        common.REPORT_MODE = common.REPORT_COMPACT
+    elif args.summary:
+        common.REPORT_MODE = common.REPORT_SUMMARY
+    if args.profile:
+        # The agent and daemon run checks elsewhere or forever, so there is
+        # no single run to time
+        if args.agent or args.daemon:
+            print("--profile can't be used with --agent or --daemon")
+            sys.exit(1)
+        spans.enable()
 
     if args.list_plugins:
-        check_plugin_table()
+        common.check_plugin_table()
+        sys.exit(0)
+
+    if args.print_tags:
+        from checkers import print_tags
+        print_tags(None, plugins=args.use_plugins)
         sys.exit(0)
 
-    config = get_config()
+    # The cluster checks need root SSH access to the cluster and the
+    # benchmarks take minutes or load the storage network, so they only run
+    # when asked for with their flag or tag
+    for tag, flag in OPT_IN_TAGS:
+        if not (getattr(args, flag) or tag in args.tags):
+            args.not_tags.append(tag)
+
+    if args.agent:
+        from agent import agent_check
+        agent_check(args.agent, args)
+        return
+
+    from dfs_sdk import scaffold
+    from checkers import run_checks, validate_plugins
+    try:
+        validate_plugins(args.use_plugins)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    config = common.get_config()
 
     if not args.hide_config:
         print("Using CONFIG:")
         scaffold.print_config()
 
-    if args.print_tags:
-        print_tags(config, plugins=args.use_plugins)
-        sys.exit(0)
-
     if args.no_local:
         args.not_tags.append("local")
     if not args.quiet:
@@ -124,33 +167,51 @@ def checker(args):
               "Tags: {}\n".format(", ".join(args.tags)),
               "Not Tags: {}\n".format(", ".join(args.not_tags)), sep='')
     if args.daemon:
+        import curses
+        from daemon import daemon
         curses.wrapper(daemon, config, args)
     else:
         run_checks(config, plugins=args.use_plugins, tags=args.tags,
                    not_tags=args.not_tags)
         if args.host_state:
-            get_host_state(config)
-        gen_report(outfile=args.out,
-                   quiet=args.quiet,
-                   ojson=args.json,
-                   push_data=args.push_data)
+            try:
+                from state import get_host_state
+            except ImportError:
+                print("Not able to import from state.py, --host-state will "
+                      "not be available")
+            else:
+                get_host_state(config)
+        with spans.span("report", "gen_report"):
+            common.gen_report(outfile=args.out,
+                              quiet=args.quiet,
+                              ojson=args.json,
+                              push_data=args.push_data)
+        if args.profile:
+            spans.write_trace(args.profile)
+            if not (args.quiet or args.json):
+                spans.print_profile()
+                print("Chrome trace written to {} (open in "
+                      "chrome://tracing or ui.perfetto.dev)".format(
+                          args.profile))
 
 
 def fixer(args):
     # Global flags
     common.VERBOSE = args.verbose
 
+    from fixers import run_fixes, print_fixes, print_results
+
     if args.print_codes:
         print_fixes(args.use_plugins)
         sys.exit(0)
 
     if args.list_plugins:
-        fix_plugin_table()
+        common.fix_plugin_table()
         sys.exit(0)
 
     report = None
     if args.in_report:
-        report = read_report(args.in_report)
+        report = common.read_report(args.in_report)
 
     codes = args.codes
     if report and not codes:
@@ -160,8 +221,14 @@ def fixer(args):
         print("No codes or report provided, not sure which fixes to run")
         sys.exit(1)
 
-    config = get_config()
-    run_fixes(codes, config, plugins=args.use_plugins)
+    config = common.get_config()
+    results = run_fixes(codes, config, plugins=args.use_plugins,
+                        dry_run=args.dry_run, concurrency=args.concurrency)
+    if args.dry_run and not args.json:
+        print("Fix plan (not applied)")
+    print_results(results, args.json)
+    if any(r["status"] == "failed" for r in results):
+        sys.exit(1)
 
 
 def installer(args):
@@ -169,15 +236,77 @@ def installer(args):
     common.VERBOSE = args.verbose
 
     if args.list_plugins:
-        install_plugin_table()
+        common.install_plugin_table()
         sys.exit(0)
 
     if not args.use_plugins:
         print("At least one plugin must be specified via '-u'")
         sys.exit(1)
 
-    config = get_config()
-    run_installers(config, args.use_plugins)
+    from installers import run_installers, print_results
+    config = common.get_config()
+    results = run_installers(config, args.use_plugins, force=args.force)
+    print_results(results)
+    if any(r["status"] == "failed" for r in results):
+        sys.exit(1)
+
+
+def agent(args):
+    # Global flags
+    common.VERBOSE = args.verbose
+
+    from agent import serve, request
+    if args.stop:
+        for _ in request(args.socket, cmd="stop"):
+            pass
+        return
+    serve(args.socket)
+
+
+def netbench(args):
+    # Global flags
+    common.VERBOSE = args.verbose
+
+    from netbench import netbench as run_netbench
+    run_netbench(args)
+
+
+def cache(args):
+    # Global flags
+    common.VERBOSE = args.verbose
+
+    from artifacts import cache as run_cache
+    run_cache(args)
+
+
+def fleet(args):
+    # Global flags
+    common.VERBOSE = args.verbose
+
+    from fleet import fleet_check
+    fleet_check(args)
+
+
+FAST_FLAGS = {"-l", "--list-plugins", "-b", "--print-tags"}
+
+
+def fast_path(argv):
+    """
+    True if the command line only needs the lightweight argument parser.
+    These commands never talk to the cluster, so dfs_sdk is not imported
+    """
+    subcommand = next((arg for arg in argv if not arg.startswith("-")), None)
+    # netbench only needs the cluster config to look up the VIPs
+    if subcommand == "netbench":
+        return "--vips" not in argv
+    return (subcommand in ("version", "cache") or
+            bool(FAST_FLAGS.intersection(argv)))
+
+
+def fast_argparser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    return parser
 
 
 if __name__ == "__main__":
@@ -186,7 +315,16 @@ if __name__ == "__main__":
         print(sys.argv[0] + " needs to be executed as root")
         sys.exit(1)
 
-    top_parser = scaffold.get_argparser(add_help=False)
+    fast = fast_path(sys.argv[1:])
+    if fast:
+        top_parser = fast_argparser()
+    else:
+        try:
+            from dfs_sdk import scaffold
+        except ImportError:
+            print("Please install requirements listed in requirements.txt")
+            sys.exit(1)
+        top_parser = scaffold.get_argparser(add_help=False)
     kargs, rem = top_parser.parse_known_args()
 
     parser = argparse.ArgumentParser(parents=[top_parser])
@@ -201,18 +339,43 @@ if __name__ == "__main__":
                                          parents=[top_parser])
     check_parser.set_defaults(func=checker)
 
-    # fix_parser = subparsers.add_parser("fix", help="Run fixes")
-    # fix_parser.set_defaults(func=fixer)
+    fix_parser = subparsers.add_parser("fix", help="Run fixes",
+                                       parents=[top_parser])
+    fix_parser.set_defaults(func=fixer)
 
     install_parser = subparsers.add_parser("install", help="Install things")
     install_parser.set_defaults(func=installer)
 
+    agent_parser = subparsers.add_parser("agent", help="Run a resident agent "
+                                                       "for fast repeated "
+                                                       "checks",
+                                         parents=[top_parser])
+    agent_parser.set_defaults(func=agent)
+
+    netbench_parser = subparsers.add_parser(
+        "netbench", help="TCP connect latency and throughput benchmark",
+        parents=[top_parser])
+    netbench_parser.set_defaults(func=netbench)
+
+    cache_parser = subparsers.add_parser(
+        "cache", help="Manage the local installer artifact cache",
+        parents=[top_parser])
+    cache_parser.set_defaults(func=cache)
+
+    fleet_parser = subparsers.add_parser("fleet", help="Run ddct across "
+                                                       "many hosts over SSH")
+    fleet_subparsers = fleet_parser.add_subparsers(help="Fleet subcommands")
+    fleet_check_parser = fleet_subparsers.add_parser(
+        "check", help="Run checks on every host in an inventory",
+        parents=[top_parser])
+    fleet_check_parser.set_defaults(func=fleet)
+
     # Version parser arguments
     version_parser.add_argument("--history", action="store_true",
                                 help="Show version history")
 
     # Common arguments
-    for p in [check_parser, install_parser]:
+    for p in [check_parser, fix_parser, install_parser]:
         p.add_argument("-o", "--out", help="Output file.Will still print to "
                                            "stdout unless -q option is "
                                            "provided")
@@ -229,6 +392,17 @@ if __name__ == "__main__":
     # Check Parser Arguments
     check_parser.add_argument("-w", "--disable-warnings", action="store_true",
                               help="Disables showing warnings in output")
+    check_parser.add_argument("--profile", nargs="?", metavar="TRACE_FILE",
+                              const=os.path.join(common.TMP_DIR,
+                                                 "profile.json"),
+                              help="Time every check, command and API call, "
+                                   "print the slowest and write a Chrome "
+                                   "trace JSON file (default "
+                                   "/tmp/.ddct/profile.json)")
+    check_parser.add_argument("--no-cache", action="store_true",
+                              help="Run every check instead of replaying "
+                                   "cached results for checks whose inputs "
+                                   "haven't changed")
     check_parser.add_argument("-t", "--tags", nargs="*", default=[],
                               help="Accepts a space separated list of tags.  "
                               "These tags are used to select checks matching "
@@ -246,6 +420,15 @@ if __name__ == "__main__":
                               help="Output json")
     check_parser.add_argument("-s", "--no-wrap", action="store_true",
                               help="Disable text wrapping in report output")
+    check_parser.add_argument("--width", type=int,
+                              help="Fit the report into this many columns.  "
+                                   "Defaults to the terminal width")
+    layout = check_parser.add_mutually_exclusive_group()
+    layout.add_argument("--compact", action="store_true",
+                        help="One line per check, without fixes")
+    layout.add_argument("--summary", action="store_true",
+                        help="Only print result counts and the checks that "
+                             "did not pass")
     check_parser.add_argument("-a", "--no-local", action="store_true",
                               help="Disable local checks.  This is useful for "
                                    "plugins that access resources remotely "
@@ -262,30 +445,156 @@ if __name__ == "__main__":
                                    "in callhome")
     check_parser.add_argument("-k", "--host-state", action="store_true",
                               help="Enable host-state output during check")
-    # # Fix Parser Arguments
-    # fix_parser.add_argument("-i", "--in-report", help="Report file location "
-    #                                                   "to read in")
-    # fix_parser.add_argument("-d", "--codes", nargs="*", default=[],
-    #                         help="Used for specifying codes manually")
-    # fix_parser.add_argument("-p", "--print-codes", action="store_true",
-    #                         help="Print out the tool's currently supported "
-    #                              "fixes and codes")
+    check_parser.add_argument("--cluster-probe", action="store_true",
+                              help="Also run the 'cluster' tagged checks, "
+                                   "which compare cluster MTUs, ARP entries "
+                                   "and target sessions with this client "
+                                   "over SSH.  Needs cluster_root_keyfile or "
+                                   "cluster_root_password in the config")
+    check_parser.add_argument("--mpath-bench", action="store_true",
+                              help="Also run the 'mpath_bench' tagged "
+                                   "checks, which time O_DIRECT reads on "
+                                   "every Datera multipath path")
+    check_parser.add_argument("--netbench", action="store_true",
+                              help="Also run the 'netbench' tagged checks, "
+                                   "which time TCP connects to the VIPs on "
+                                   "port 3260")
+    check_parser.add_argument("-g", "--agent", nargs="?", const=AGENT_SOCKET,
+                              help="Submit the run to a running ddct agent "
+                                   "listening on this socket instead of "
+                                   "running checks in this process")
+
+    # Agent Parser Arguments
+    agent_parser.add_argument("--socket", default=AGENT_SOCKET,
+                              help="Unix socket the agent listens on")
+    agent_parser.add_argument("--stop", action="store_true",
+                              help="Stop the agent listening on --socket")
+    agent_parser.add_argument('--wcs', action="store_true")
+
+    # Netbench Parser Arguments
+    netbench_parser.add_argument("--server", action="store_true",
+                                 help="Run a netbench server for other "
+                                      "hosts to test against")
+    netbench_parser.add_argument("--bind", default="0.0.0.0",
+                                 help="Address the server listens on")
+    netbench_parser.add_argument("--port", type=int,
+                                 help="Port the server listens on")
+    netbench_parser.add_argument("--peer",
+                                 help="host[:port] of a netbench server to "
+                                      "run the throughput test against")
+    netbench_parser.add_argument("--loopback", action="store_true",
+                                 help="Run the throughput test against a "
+                                      "local loopback server")
+    netbench_parser.add_argument("--vips", action="store_true",
+                                 help="Measure connect latency to the "
+                                      "cluster VIPs on port 3260")
+    netbench_parser.add_argument("--connect", nargs="*", default=[],
+                                 help="Additional host[:port] targets for "
+                                      "the connect latency test (port "
+                                      "defaults to 3260)")
+    netbench_parser.add_argument("--connects", type=int,
+                                 help="Connections opened per target")
+    netbench_parser.add_argument("--streams", type=int,
+                                 help="Maximum number of parallel streams, "
+                                      "scaled up from 1")
+    netbench_parser.add_argument("--duration", type=float,
+                                 help="Seconds per throughput test")
+    netbench_parser.add_argument("-j", "--json", action="store_true",
+                                 help="Output json")
+    netbench_parser.add_argument('--wcs', action="store_true")
+
+    # Fleet Check Parser Arguments
+    fleet_check_parser.add_argument("-f", "--inventory", required=True,
+                                    help="Inventory file.  Either one "
+                                         "[user@]host[:port] per line or a "
+                                         "JSON list of host objects.  The "
+                                         "host 'local' runs on this machine")
+    fleet_check_parser.add_argument("-c", "--concurrency", type=int,
+                                    default=32,
+                                    help="Maximum number of hosts checked at "
+                                         "once")
+    fleet_check_parser.add_argument("--timeout", type=float, default=300,
+                                    help="Per-host timeout in seconds")
+    fleet_check_parser.add_argument("--ssh-user", default="root",
+                                    help="Default SSH user for hosts")
+    fleet_check_parser.add_argument("--ssh-keyfile",
+                                    help="Default SSH private key file")
+    fleet_check_parser.add_argument("--ssh-password",
+                                    help="Default SSH password")
+    fleet_check_parser.add_argument("--remote-ddct", default="ddct",
+                                    help="Path to the ddct executable on the "
+                                         "remote hosts")
+    fleet_check_parser.add_argument("-o", "--out", help="Output file")
+    fleet_check_parser.add_argument("-q", "--quiet", action="store_true",
+                                    help="No output to stdout")
+    fleet_check_parser.add_argument("-j", "--json", action="store_true",
+                                    help="Output json")
+    fleet_check_parser.add_argument("-u", "--use-plugins", nargs="*",
+                                    default=[],
+                                    help="Accepts a space separated list of "
+                                         "plugins")
+    fleet_check_parser.add_argument("-t", "--tags", nargs="*", default=[],
+                                    help="Accepts a space separated list of "
+                                         "tags")
+    fleet_check_parser.add_argument("-n", "--not-tags", nargs="*",
+                                    default=[],
+                                    help="Accepts as space separated list of "
+                                         "tags to deselect")
+    fleet_check_parser.add_argument("-w", "--disable-warnings",
+                                    action="store_true",
+                                    help="Disables showing warnings in "
+                                         "output")
+    fleet_check_parser.add_argument("--no-cache", action="store_true",
+                                    help="Run every check instead of "
+                                         "replaying cached results")
+    fleet_check_parser.add_argument("-k", "--host-state",
+                                    action="store_true",
+                                    help="Enable host-state output during "
+                                         "check")
+    fleet_check_parser.add_argument('--wcs', action="store_true")
+
+    # Fix Parser Arguments
+    fix_parser.add_argument("-i", "--in-report", help="Report file location "
+                                                      "to read in")
+    fix_parser.add_argument("-d", "--codes", nargs="*", default=[],
+                            help="Used for specifying codes manually")
+    fix_parser.add_argument("-p", "--print-codes", action="store_true",
+                            help="Print out the tool's currently supported "
+                                 "fixes and codes")
+    fix_parser.add_argument("--dry-run", action="store_true",
+                            help="Print the fix plan without running it")
+    fix_parser.add_argument("-c", "--concurrency", type=int, default=4,
+                            help="Maximum number of fixes run at once within "
+                                 "the services and config stages")
+    fix_parser.add_argument("-j", "--json", action="store_true",
+                            help="Output fix plan/results in JSON")
+
+    # Cache Parser Arguments
+    cache_parser.add_argument("--seed", help="Load artifacts from a bundle "
+                                             "made with --export")
+    cache_parser.add_argument("--export", help="Write every cached artifact "
+                                               "to a bundle tarball")
+    cache_parser.add_argument("--list", action="store_true",
+                              help="List cached artifacts and verify their "
+                                   "checksums (default)")
 
     # Install Parser Arguments
-    pass
+    install_parser.add_argument("--force", action="store_true",
+                                help="Ignore saved checkpoints and rerun "
+                                     "every install step")
 
-    args = parser.parse_args()
+    if fast:
+        # Connection options from the full scaffold parser are ignored
+        args, _ = parser.parse_known_args()
+    else:
+        args = parser.parse_args()
 
     if not args.verbose:
         os.environ['DSDK_LOG_CFG'] = 'disable'
 
-    if not scaffold:
-        print("Please install requirements listed in requirements.txt")
-        sys.exit(1)
-
     if not hasattr(args, 'func'):
         args.func = none
-    if not args.wcs and not wcs():
+    if not getattr(args, 'wcs', False) and not wcs():
         print(DDCT_WARNING)
     else:
         make_wcs()
@@ -1,16 +1,36 @@
 from __future__ import (print_function, unicode_literals, division,
                         absolute_import)
+import inspect
 import io
+import json
 import os
 import shutil
 import sys
+import threading
+import time
 import uuid
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from common import vprint, exe, get_os, idempotent, fix_load, load_run_fixes
-from common import save_run_fixes, UBUNTU
-
-from tabulate import tabulate
+from common import save_run_fixes, UBUNTU, plugin_manifest, PLUGIN_FIX
+from sysctl import fix_codes, SYSCTL_DROPIN
+from packages import requires, collect, resolve, install, PackageError
+
+# Fix stages, run in this order.  Packages have to be in place before the
+# services they provide can be started, and services have to be running
+# before their configuration is reloaded
+PACKAGES = 0
+SERVICES = 1
+CONFIG = 2
+STAGE_NAMES = {PACKAGES: "packages", SERVICES: "services", CONFIG: "config"}
+# The package stage is one package manager transaction (see packages.py), so
+# only the later stages run their fixes concurrently
+PARALLEL_STAGES = (SERVICES, CONFIG)
+CONCURRENCY = 4
 
 # Using string REPLACEME instead of normal string formatting because it's
 # easier than escaping everything
@@ -73,25 +93,59 @@ blacklist_exceptions {
 """
 
 
+def stage(order):
+    """
+    Assigns a fix to one of the PACKAGES, SERVICES or CONFIG stages.  Fixes
+    without a stage run with CONFIG
+    """
+    def _decorator(fix):
+        fix._stage = order
+        return fix
+    return _decorator
+
+
+def get_stage(fix):
+    return getattr(fix, "_stage", CONFIG)
+
+
+def _argspec(fix):
+    fix = getattr(fix, "__wrapped__", fix)
+    try:
+        return inspect.getfullargspec(fix)
+    except AttributeError:
+        return inspect.getargspec(fix)
+
+
+def takes_config(fix):
+    """
+    True if the (possibly @idempotent wrapped) fix accepts a config argument
+    """
+    spec = _argspec(fix)
+    return bool(spec.args or spec.varargs)
+
+
+def takes_codes(fix):
+    """
+    True if the fix also wants the codes it is fixing: fix(config, codes)
+    """
+    return "codes" in _argspec(fix).args
+
+
 def no_fix():
     """No-op function"""
     vprint("No fix for this code")
 
 
-@idempotent
-def fix_arp_1():
-    """Fixes net.ipv4.conf.all.arp_announce"""
-    vprint("Fixing ARP setting")
-    exe("sysctl -w net.ipv4.conf.all.arp_announce=2")
-
-
-@idempotent
-def fix_arp_2():
-    """Fixes net.ipv4.conf.all.arp_ignore"""
-    vprint("Fixing ARP setting")
-    exe("sysctl -w net.ipv4.conf.all.arp_ignore=1")
+def fix_sysctl_1(config, codes):
+    """Applies the failing sysctl_rules.txt settings in one batch and
+    persists them in 99-datera.conf"""
+    vprint("Applying sysctl settings for {}".format(", ".join(codes)))
+    changed = fix_codes(codes)
+    vprint("Changed {} sysctl settings, wrote {}".format(
+        len(changed), SYSCTL_DROPIN))
 
 
+@stage(SERVICES)
 @idempotent
 def fix_irq_1():
     """Stops irqbalance services"""
@@ -99,20 +153,15 @@ def fix_irq_1():
     exe("service irqbalance stop")
 
 
+@stage(PACKAGES)
+@requires("cpufreq")
 @idempotent
 def fix_cpufreq_1():
     """Installs cpufreq tooling packages"""
-    if get_os() == UBUNTU:
-        # Install necessary headers and utils
-        exe("apt-get install linux-tools-$(uname -r) "
-            "linux-cloud-tools-$(uname -r) linux-tools-common -y")
-        # Install cpufrequtils package
-        exe("apt-get install cpufrequtils -y")
-    else:
-        # Install packages
-        exe("yum install kernel-tools -y")
+    install(["cpufreq"])
 
 
+@stage(SERVICES)
 @idempotent
 def fix_cpufreq_2():
     """Updates governer to performance via cpufreq"""
@@ -129,46 +178,31 @@ def fix_cpufreq_2():
 
 
 @idempotent
-def fix_block_devices_1():
-    """Updates GRUB with noop scheduling, requires restart"""
-    vprint("Fixing block device settings")
-    grub = "/etc/default/grub"
-    bgrub = "/etc/default/grub.bak.{}".format(str(uuid.uuid4())[:4])
-    vprint("Backing up grub default file to {}".format(bgrub))
-    shutil.copyfile(grub, bgrub)
-    vprint("Writing new grub default file")
-    data = []
-    with io.open(grub, "r+") as f:
-        for line in f.readlines():
-            if ("GRUB_CMDLINE_LINUX_DEFAULT=" in line and
-                    "elevator=noop" not in line):
-                i = line.rindex("\"")
-                lline = list(line)
-                if lline[i-1] == "\"":
-                    lline.insert(i, "elevator=noop")
-                else:
-                    lline.insert(i, " elevator=noop")
-                line = "".join(lline)
-            data.append(line)
-    with io.open(grub, "w+") as f:
-        print(data)
-        f.writelines(data)
-    if get_os() == UBUNTU:
-        exe("update-grub2")
-    else:
-        exe("grub2-mkconfig -o /boot/grub2/grub.cfg")
+def fix_cpufreq_3():
+    """Sets the performance governor on every CPU through sysfs"""
+    vprint("Setting performance governor")
+    exe("for f in /sys/devices/system/cpu/cpu*/cpufreq/scaling_governor; "
+        "do echo performance > $f; done")
 
 
+@stage(PACKAGES)
+@requires("multipath")
 @idempotent
 def fix_multipath_1():
     """Installs multipath tooling packages"""
     vprint("Fixing multipath settings")
-    if get_os() == UBUNTU:
-        exe("apt-get install multipath-tools -y")
-    else:
-        exe("yum install device-mapper-multipath -y")
+    install(["multipath"])
+
+
+@stage(PACKAGES)
+@requires("iscsi")
+@idempotent
+def fix_iscsi_1():
+    """Installs iSCSI initiator packages"""
+    install(["iscsi"])
 
 
+@stage(SERVICES)
 @idempotent
 def fix_multipath_2():
     """Enables multipathd service"""
@@ -200,41 +234,77 @@ def fix_multipath_conf_1():
 
 
 fix_dict = {
+    "01190E66": [],
+    "01C594E7": [fix_sysctl_1],
+    "031E20C7": [],
+    "05207BED": [],
     "057AF23D": [no_fix],
     "0762A89B": [],
     "08193032": [],
+    "0912A26B": [],
     "09E37E51": [],
+    "0AF31334": [fix_sysctl_1],
     "0BB2848F": [],
     "0D862946": [],
+    "10373CD0": [],
+    "1128F298": [fix_sysctl_1],
     "11F30DCF": [],
+    "12628C60": [],
+    "17CE2EEF": [],
     "17FF7B78": [],
+    "18224821": [],
     "1827147B": [],
+    "18CFCFEE": [],
     "1C8F2E07": [],
     "1D506D89": [fix_multipath_conf_1],
     "1D8C438C": [],
+    "1F523B04": [fix_sysctl_1],
+    "1F9E44E3": [],
     "20CEE732": [fix_cpufreq_1, fix_cpufreq_2],
     "228241A8": [],
     "22DC6275": [],
     "2330CACB": [],
     "244C0B34": [],
+    "2862CB28": [fix_sysctl_1],
+    "2A6057BD": [fix_sysctl_1],
+    "2B75B04B": [],
     "2D18685C": [fix_multipath_1, fix_multipath_2],
+    "2EECBA9E": [fix_sysctl_1],
     "2FD6A7B4": [],
-    "333FBD45": [],
+    "300F72CD": [],
+    "333FBD45": [fix_cpufreq_3],
+    "34A7B822": [fix_sysctl_1],
+    "36AB43B2": [],
     "3A6A78D1": [],
     "3AAF82CA": [],
     "3C33D70D": [],
+    "3D1B5037": [],
     "3D76CE5A": [],
+    "3ED0249A": [],
+    "3F06CFEE": [],
     "3F9F67BF": [],
+    "41A5C447": [],
     "42481C71": [],
     "42BAAC76": [],
-    "47BB5083": [fix_block_devices_1],
+    "4365CBC4": [],
+    "459D0B94": [],
     "49BDC893": [],
     "4B16C4F7": [],
+    "4C4B3F0B": [fix_sysctl_1],
+    "4CC65BE1": [],
+    "4F26C658": [],
     "4F6B8D91": [],
+    "508CDEC4": [],
+    "52437E9E": [],
     "525BAAB0": [],
+    "5407F8FA": [],
     "540C3008": [],
     "541C10BF": [fix_multipath_2],
+    "5476F774": [],
+    "55EF997B": [fix_sysctl_1],
+    "56C51694": [],
     "572B0511": [],
+    "59FD5DF7": [fix_sysctl_1],
     "5B3729F2": [],
     "5B6EFC71": [],
     "5FEC0454": [],
@@ -242,77 +312,133 @@ fix_dict = {
     "642753A0": [],
     "6515ADB8": [],
     "65FC68BB": [],
+    "66CDAD99": [],
     "675E2887": [],
     "680E61DB": [],
+    "68191DE5": [fix_sysctl_1],
+    "69B6B4B1": [],
+    "6BA8619A": [],
+    "6BE2899E": [fix_sysctl_1],
     "6C531C5D": [],
     "6D03F50B": [],
     "6E281004": [],
-    "6F7B6A25": [],
     "70191A9A": [],
     "710BFC7E": [],
+    "7410CABE": [],
     "7475B000": [],
     "75A8A315": [],
+    "7656C46C": [fix_sysctl_1],
     "797A6031": [],
+    "7A9AB850": [fix_sysctl_1],
     "7B98CFA1": [],
+    "7F8479C2": [fix_sysctl_1],
+    "801F04A0": [],
+    "81DC27AC": [],
     "8208B9E7": [],
     "842A4DB1": [],
+    "84D1635F": [],
     "86FFD7F2": [],
+    "8737A1AC": [],
+    "8881546E": [fix_sysctl_1],
     "8A28D615": [],
+    "8D0D857F": [],
+    "8D95E6B2": [],
     "8DBC87E8": [],
-    "9000C3B6": [fix_arp_1],
+    "8FA26A66": [fix_sysctl_1],
+    "9000C3B6": [fix_sysctl_1],
+    "90DADFEA": [],
+    "9375E5DB": [],
+    "937F8E15": [],
+    "93DF124C": [],
     "945148B0": [],
     "94BF0B77": [],
     "95C9B3AC": [],
+    "98464E5F": [],
+    "989229FC": [fix_sysctl_1],
     "995EA49E": [],
     "9990F32F": [],
     "99B9D136": [],
+    "9B57A98B": [],
+    "9D06D368": [],
+    "9DC9C486": [],
+    "9F644595": [],
     "A06CD19F": [],
+    "A15B0633": [],
     "A2EED511": [],
+    "A363C2ED": [],
     "A37FD778": [],
     "A433E6C6": [],
     "A4402034": [],
     "A4CA0D72": [],
-    "A65B6D97": [no_fix],
+    "A8A6F381": [fix_sysctl_1],
     "A8B6BA35": [],
+    "A9B0467B": [],
     "A9DF3F8C": [],
     "AA27965F": [],
+    "AA37C12A": [],
+    "AAC26813": [],
+    "AC0349DA": [],
+    "ACC45ABA": [],
     "AF3DB8B3": [],
     "AFCBBDD7": [],
+    "B0DFF6B5": [],
     "B106D1CD": [],
     "B19D9FF1": [fix_irq_1],
     "B3BF691D": [],
     "B5D29621": [],
+    "B63558BD": [],
     "B65FD598": [],
     "B74CEBC3": [],
     "B845D5B1": [],
+    "B86C398D": [],
     "B8C8A19C": [],
-    "BDB4D5D8": [fix_arp_2],
+    "BDB4D5D8": [fix_sysctl_1],
+    "BEB8B292": [],
     "BF6A912A": [],
     "C1802A6E": [],
     "C2B8C696": [],
+    "C387AC81": [],
+    "C414E635": [],
     "C521E039": [],
     "C5B86514": [],
     "CA9AA865": [],
     "CBF8CC4C": [],
+    "CCB07C74": [],
+    "CD37F436": [fix_sysctl_1],
+    "D1860A51": [],
     "D2DA6596": [],
+    "D3E55910": [],
     "D7F667BC": [],
+    "DAFE6AD4": [],
     "DD51CEC9": [],
-    "D3E55910": [],
+    "DE2B8446": [],
+    "DE4AB6DD": [],
+    "E0505F7A": [],
     "E29BF18A": [],
     "E48C1907": [],
+    "E5790074": [],
+    "E72F4010": [],
+    "E7CDECDA": [],
     "E9F02293": [],
     "EB22737E": [],
     "EC2D3621": [],
-    "EFBB085C": [],
+    "EFBB085C": [fix_iscsi_1],
+    "F0D7A1AD": [fix_sysctl_1],
+    "F3531E07": [],
     "F3C47DDF": [],
+    "F45FCE90": [],
     "F5DEC8B1": [],
     "F6A49337": [],
+    "F9ABD24F": [],
+    "FBCA17D5": [fix_sysctl_1],
     "FCFE3444": [],
     "FE13A328": [],
+    "FFBAB0AE": [],
 }
 
 
 def print_fixes(plugins):
+    from tabulate import tabulate
     print("Supported Fixes")
     if plugins:
         load_plugin_fixes(plugins)
@@ -326,30 +452,154 @@ def print_fixes(plugins):
 
 
 def load_plugin_fixes(plugins):
-    plugs = fix_load()
+    available = plugin_manifest(PLUGIN_FIX)
     for plugin in plugins:
-        if plugin not in plugs:
+        if plugin not in available:
             print("Unrecognized fix plugin requested:", plugin)
-            print("Available fix plugins:", ", ".join(plugins.keys()))
+            print("Available fix plugins:", ", ".join(sorted(available)))
             sys.exit(1)
+    plugs = fix_load(plugins)
+    for plugin in plugins:
         fix_dict.update(plugs[plugin].load_fixes())
 
 
-def run_fixes(codes, config, plugins=None):
+def plan_fixes(codes):
+    """
+    De-duplicates the fixes for codes and groups them by stage.  Returns
+    [(stage, [(fix, [codes])])] in execution order.  Codes without a fix
+    are listed under no_fix
+    """
+    seen = {}
+    order = []
+    for code in codes:
+        fixes = fix_dict.get(code) or [no_fix]
+        for fix in fixes:
+            if fix not in seen:
+                seen[fix] = []
+                order.append(fix)
+            if code not in seen[fix]:
+                seen[fix].append(code)
+    stages = {}
+    for fix in order:
+        stages.setdefault(get_stage(fix), []).append((fix, seen[fix]))
+    return sorted(stages.items(), key=lambda x: x[0])
+
+
+def _result(fix, fix_codes, status, seconds=0.0, error=None):
+    return {"fix": fix.__name__,
+            "packages": getattr(fix, "_packages", ()),
+            "description": fix.__doc__,
+            "stage": STAGE_NAMES[get_stage(fix)],
+            "codes": fix_codes,
+            "status": status,
+            "seconds": round(seconds, 3),
+            "error": error}
+
+
+def _run_fix(fix, fix_codes, config):
+    start = time.time()
+    try:
+        if takes_codes(fix):
+            fix(config, fix_codes)
+        elif takes_config(fix):
+            fix(config)
+        else:
+            fix()
+    except Exception as e:
+        vprint("Fix {} failed: {}".format(fix.__name__, e))
+        return _result(fix, fix_codes, "failed", time.time() - start, str(e))
+    return _result(fix, fix_codes, "ok", time.time() - start)
+
+
+def _run_stage(fixes, config, concurrency):
+    """
+    Runs a stage's fixes with at most concurrency in flight and returns
+    their results in plan order
+    """
+    results = [None] * len(fixes)
+    work = queue.Queue()
+    for index, item in enumerate(fixes):
+        work.put((index, item))
+
+    def _worker():
+        while True:
+            try:
+                index, (fix, fix_codes) = work.get_nowait()
+            except queue.Empty:
+                return
+            results[index] = _run_fix(fix, fix_codes, config)
+
+    threads = [threading.Thread(target=_worker)
+               for _ in range(max(1, min(concurrency, len(fixes))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _install_stage(fixes, config):
+    """
+    Installs the packages of every fix in the stage in a single package
+    manager transaction, then runs the fixes themselves, which find
+    everything already installed
+    """
+    start = time.time()
+    names = collect(fix for fix, _ in fixes)
+    try:
+        if names:
+            vprint("Installing packages: {}".format(
+                ", ".join(resolve(names))))
+            install(names)
+    except PackageError as e:
+        return [_result(fix, fix_codes, "failed", time.time() - start,
+                        str(e)) for fix, fix_codes in fixes]
+    return _run_stage(fixes, config, 1)
+
+
+def run_fixes(codes, config, plugins=None, dry_run=False,
+              concurrency=CONCURRENCY):
+    """
+    Runs the de-duplicated fixes for codes stage by stage and returns a
+    result dict per fix.  A failed fix doesn't stop the others, but every
+    fix in a later stage is skipped once a stage has a failure
+    """
+    if plugins:
+        load_plugin_fixes(plugins)
+    plan = plan_fixes(codes)
+    if dry_run:
+        return [_result(fix, fix_codes, "planned")
+                for _, fixes in plan for fix, fix_codes in fixes]
     load_run_fixes()
-    reraise = False
+    results = []
+    failed = False
     try:
-        if plugins:
-            load_plugin_fixes(plugins)
-        for code in codes:
-            fixes = fix_dict[code]
-            for fix in fixes:
-                try:
-                    fix()
-                except TypeError:
-                    fix(config)
-    except Exception:
-        reraise = True
-    save_run_fixes()
-    if reraise:
-        raise
+        for order, fixes in plan:
+            if failed:
+                results.extend(_result(fix, fix_codes, "skipped")
+                               for fix, fix_codes in fixes)
+                continue
+            vprint("Running {} fix stage".format(STAGE_NAMES[order]))
+            if order == PACKAGES:
+                results.extend(_install_stage(fixes, config))
+            else:
+                results.extend(_run_stage(
+                    fixes, config,
+                    concurrency if order in PARALLEL_STAGES else 1))
+            failed = any(r["status"] == "failed" for r in results)
+    finally:
+        save_run_fixes()
+    return results
+
+
+def print_results(results, ojson=False):
+    if ojson:
+        print(json.dumps(results, indent=4))
+        return
+    from tabulate import tabulate
+    print(tabulate([[r["stage"], r["fix"], r["description"],
+                     ", ".join(r["codes"]), r["status"].upper(),
+                     r["seconds"], r["error"] or ""] for r in results],
+                   headers=["Stage", "Fix", "Description", "Codes", "Status",
+                            "Seconds", "Error"],
+                   tablefmt="grid"))
@@ -0,0 +1,435 @@
+from __future__ import (print_function, unicode_literals, division,
+                        absolute_import)
+
+import io
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from common import vprint, get_ssh, ssh_exe, close_ssh
+from common import SUCCESS, FAILURE, WARNING
+
+DDCTPY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ddct.py")
+REMOTE_DDCT = "ddct"
+LOCAL_DDCT = "{} {}".format(quote(sys.executable), quote(DDCTPY))
+# Hosts with this name are run through a local subprocess instead of SSH,
+# which lets fleet mode be exercised without any remote machines
+LOCAL_HOST = "local"
+
+# Keys a JSON inventory entry may set
+HOST_KEYS = ("host", "user", "port", "keyfile", "password", "ddct")
+
+HOST_OK = "ok"
+HOST_ERROR = "error"
+HOST_TIMEOUT = "timeout"
+
+_print_lock = threading.Lock()
+
+
+class InventoryError(EnvironmentError):
+    pass
+
+
+class Host(object):
+
+    def __init__(self, host, user="root", port=22, keyfile=None,
+                 password=None, ddct=REMOTE_DDCT):
+        self.host = host
+        self.user = user
+        self.port = int(port)
+        self.keyfile = keyfile
+        self.password = password
+        self.ddct = ddct
+        # Results are keyed by name, see name_hosts()
+        self.name = host
+
+    def __str__(self):
+        return self.name
+
+
+class HostResult(object):
+
+    def __init__(self, host, status, report=None, error=None, duration=0.0):
+        self.host = host
+        self.status = status
+        self.report = report
+        self.error = error
+        self.duration = duration
+
+    def failures(self):
+        if not self.report:
+            return {}
+        return self.report.get("failures", {})
+
+    def warnings(self):
+        if not self.report:
+            return {}
+        return self.report.get("warnings", {})
+
+    def gen_json(self):
+        return {"status": self.status,
+                "error": self.error,
+                "duration": round(self.duration, 3),
+                "report": self.report}
+
+
+def parse_host(line, defaults):
+    """
+    Parses an inventory entry of the form [user@]host[:port]
+    """
+    host = dict(defaults)
+    if "@" in line:
+        host["user"], line = line.split("@", 1)
+    if line.count(":") == 1:
+        line, host["port"] = line.split(":")
+    host["host"] = line
+    return Host(**host)
+
+
+def parse_entry(entry, defaults):
+    """
+    Parses a JSON inventory entry, an object with a host and any of
+    HOST_KEYS
+    """
+    if not isinstance(entry, dict) or "host" not in entry:
+        raise ValueError("expected an object with a host")
+    unknown = sorted(set(entry) - set(HOST_KEYS))
+    if unknown:
+        raise ValueError("unknown keys {}, expected {}".format(
+            ", ".join(unknown), ", ".join(HOST_KEYS)))
+    host = dict(defaults)
+    host.update(entry)
+    return Host(**host)
+
+
+def name_hosts(hosts):
+    """
+    Hosts are named by their address.  Addresses listed more than once
+    (e.g. different ports or users) are named user@host:port instead, and
+    entries that are still identical are rejected
+    """
+    counts = {}
+    for host in hosts:
+        counts[host.host] = counts.get(host.host, 0) + 1
+    names = set()
+    for host in hosts:
+        if counts[host.host] > 1:
+            host.name = "{}@{}:{}".format(host.user, host.host, host.port)
+        if host.name in names:
+            raise InventoryError("Duplicate inventory entry {}".format(
+                host.name))
+        names.add(host.name)
+    return hosts
+
+
+def load_inventory(path, user="root", keyfile=None, password=None,
+                   ddct=REMOTE_DDCT):
+    """
+    Reads an inventory file.  Either a JSON list of host objects
+    (keys: host, user, port, keyfile, password, ddct) or one
+    [user@]host[:port] entry per line with '#' comments.  Raises
+    InventoryError naming the first invalid entry
+    """
+    defaults = {"user": user, "keyfile": keyfile, "password": password,
+                "ddct": ddct}
+    with io.open(path, 'r') as f:
+        data = f.read()
+    hosts = []
+    if data.lstrip().startswith("["):
+        try:
+            entries = json.loads(data)
+        except ValueError as e:
+            raise InventoryError("Invalid JSON inventory {}: {}".format(
+                path, e))
+        for index, entry in enumerate(entries):
+            try:
+                hosts.append(parse_entry(entry, defaults))
+            except (ValueError, TypeError) as e:
+                raise InventoryError(
+                    "Invalid inventory entry {} in {}: {}: {}".format(
+                        index + 1, path, json.dumps(entry), e))
+        return name_hosts(hosts)
+    for number, line in enumerate(data.splitlines(), 1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        try:
+            hosts.append(parse_host(line, defaults))
+        except ValueError as e:
+            raise InventoryError("Invalid inventory line {} in {}: {}: "
+                                 "{}".format(number, path, line, e))
+    return name_hosts(hosts)
+
+
+def remote_check_cmd(host, args, ddct=None):
+    """
+    The shell command running ddct check on host.  Every argument is quoted,
+    the ddct command itself is used as given so it can include an
+    interpreter
+    """
+    cmd = ["check", "--json", "--hide-config", "--wcs"]
+    if args.use_plugins:
+        cmd.extend(["-u"] + args.use_plugins)
+    if args.tags:
+        cmd.extend(["-t"] + args.tags)
+    if args.not_tags:
+        cmd.extend(["-n"] + args.not_tags)
+    if args.disable_warnings:
+        cmd.append("-w")
+    if args.no_cache:
+        cmd.append("--no-cache")
+    if args.host_state:
+        cmd.append("-k")
+    cmd = [ddct or host.ddct] + [quote(arg) for arg in cmd]
+    if host.user != "root":
+        cmd.insert(0, "sudo -n")
+    return " ".join(cmd)
+
+
+def parse_check_output(output):
+    """
+    Pulls the JSON report out of 'ddct check --json' output, skipping
+    any banner lines printed before it
+    """
+    lines = output.splitlines()
+    for index, line in enumerate(lines):
+        if line.startswith("{"):
+            return json.loads("\n".join(lines[index:]))
+    raise ValueError("No JSON report found in ddct output")
+
+
+def _run_local(cmd, timeout):
+    vprint("Running local fleet cmd:", cmd)
+    # In its own process group so a timeout kills ddct, not just the shell
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, preexec_fn=os.setsid)
+    timed_out = []
+
+    def _kill():
+        timed_out.append(True)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    timer = threading.Timer(timeout, _kill)
+    timer.start()
+    try:
+        out, err = proc.communicate()
+    finally:
+        timer.cancel()
+    if timed_out:
+        raise socket.timeout("Local ddct run timed out")
+    return (proc.returncode, out.decode("utf-8", "replace"),
+            err.decode("utf-8", "replace"))
+
+
+def run_host(host, args):
+    """
+    Runs ddct check on host.  Connecting and running share one
+    args.timeout deadline
+    """
+    start = time.time()
+    deadline = start + args.timeout
+    try:
+        if host.host == LOCAL_HOST:
+            cmd = remote_check_cmd(host, args, ddct=LOCAL_DDCT)
+            status, out, err = _run_local(cmd, args.timeout)
+        else:
+            cmd = remote_check_cmd(host, args)
+            ssh = get_ssh(host.host, username=host.user,
+                          password=host.password, keyfile=host.keyfile,
+                          port=host.port, timeout=args.timeout)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout("Timed out connecting")
+            vprint("Executing command: {} on {}".format(cmd, host))
+            status, out, err = ssh_exe(ssh, cmd, timeout=remaining)
+        if status != 0:
+            raise EnvironmentError(
+                "Nonzero return code: {} stderr: {}".format(
+                    status, err.strip()))
+        return HostResult(str(host), HOST_OK,
+                          report=parse_check_output(out),
+                          duration=time.time() - start)
+    except socket.timeout:
+        return HostResult(str(host), HOST_TIMEOUT,
+                          error="Timed out after {}s".format(args.timeout),
+                          duration=time.time() - start)
+    except Exception as e:
+        return HostResult(str(host), HOST_ERROR, error=str(e),
+                          duration=time.time() - start)
+
+
+def _stream(result):
+    if result.status == HOST_OK:
+        msg = "{} failures, {} warnings".format(
+            len(result.failures()), len(result.warnings()))
+    else:
+        msg = result.error
+    with _print_lock:
+        print("[{:.1f}s] {}: {} ({})".format(
+            result.duration, result.host, result.status.upper(), msg))
+        sys.stdout.flush()
+
+
+def run_fleet(hosts, args, stream=True):
+    """
+    Runs checks on every host with at most args.concurrency hosts in
+    flight at once.  Results are streamed as each host finishes
+    """
+    work = queue.Queue()
+    for host in hosts:
+        work.put(host)
+    fleet_report = FleetReport()
+
+    def _worker():
+        while True:
+            try:
+                host = work.get_nowait()
+            except queue.Empty:
+                return
+            result = run_host(host, args)
+            fleet_report.add(result)
+            if stream:
+                _stream(result)
+
+    threads = []
+    for _ in range(max(1, min(args.concurrency, len(hosts)))):
+        thread = threading.Thread(target=_worker)
+        thread.daemon = True
+        threads.append(thread)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    close_ssh()
+    return fleet_report
+
+
+class FleetReport(object):
+
+    def __init__(self):
+        self.results = {}
+        self._lock = threading.Lock()
+
+    def add(self, result):
+        with self._lock:
+            self.results[result.host] = result
+
+    def by_test(self):
+        """
+        Returns {test: (failed_hosts, warned_hosts, ids)}
+        """
+        tests = {}
+        for host, result in self.results.items():
+            for kind, entries in ((0, result.failures()),
+                                  (1, result.warnings())):
+                for uid, (name, _) in entries.items():
+                    entry = tests.setdefault(name, (set(), set(), set()))
+                    entry[kind].add(host)
+                    entry[2].add(uid)
+            if result.report:
+                for name in result.report.get("success", []):
+                    tests.setdefault(name, (set(), set(), set()))
+        return tests
+
+    def generate(self):
+        from tabulate import tabulate
+        h = []
+        for host, result in sorted(self.results.items()):
+            if result.status != HOST_OK:
+                status = FAILURE
+                detail = result.error
+            elif result.failures():
+                status = FAILURE
+                detail = ", ".join(sorted(set(
+                    name for name, _ in result.failures().values())))
+            elif result.warnings():
+                status = WARNING
+                detail = ", ".join(sorted(set(
+                    name for name, _ in result.warnings().values())))
+            else:
+                status = SUCCESS
+                detail = ""
+            h.append([host, status, len(result.failures()),
+                      len(result.warnings()),
+                      "{:.1f}s".format(result.duration), detail])
+        r1 = tabulate(
+            h,
+            headers=["Host", "Status", "Failures", "Warnings", "Time",
+                     "Failing Tests"],
+            tablefmt="grid")
+
+        t = []
+        total = len(self.results)
+        for name, (failed, warned, ids) in sorted(self.by_test().items()):
+            if failed:
+                status = FAILURE
+            elif warned:
+                status = WARNING
+            else:
+                status = SUCCESS
+            t.append([name, status,
+                      "{}/{}".format(len(failed), total),
+                      "{}/{}".format(len(warned), total),
+                      "\n".join(sorted(ids))])
+        r2 = tabulate(
+            t,
+            headers=["Test", "Status", "Failed Hosts", "Warned Hosts", "IDs"],
+            tablefmt="grid")
+        return "\n".join(("HOSTS: {}".format(total), r1, r2))
+
+    def gen_json(self):
+        return {"hosts": {host: result.gen_json()
+                          for host, result in self.results.items()},
+                "tests": {name: {"failed": sorted(failed),
+                                 "warned": sorted(warned),
+                                 "ids": sorted(ids)}
+                          for name, (failed, warned, ids)
+                          in self.by_test().items()}}
+
+
+def fleet_check(args):
+    try:
+        hosts = load_inventory(args.inventory,
+                               user=args.ssh_user,
+                               keyfile=args.ssh_keyfile,
+                               password=args.ssh_password,
+                               ddct=args.remote_ddct)
+    except InventoryError as e:
+        print(e)
+        sys.exit(1)
+    if not hosts:
+        print("No hosts found in inventory", args.inventory)
+        sys.exit(1)
+    if not args.quiet:
+        print("Running checks on {} hosts, {} at a time".format(
+            len(hosts), args.concurrency))
+    fleet_report = run_fleet(hosts, args, stream=not args.quiet)
+    if args.json:
+        results = json.dumps(fleet_report.gen_json(), indent=4)
+    else:
+        results = fleet_report.generate()
+    if args.out:
+        with io.open(args.out, 'w+') as f:
+            f.write(results)
+            f.write("\n")
+    if not args.quiet:
+        print(results)
+    if any(r.status != HOST_OK or r.failures()
+           for r in fleet_report.results.values()):
+        sys.exit(1)
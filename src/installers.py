@@ -1,25 +1,182 @@
 from __future__ import (print_function, unicode_literals, division,
                         absolute_import)
 
+import hashlib
+import io
+import json
+import os
 import sys
+import threading
+import time
 
-from common import install_load
+from common import vprint, install_load, plugin_manifest, PLUGIN_INSTALL
+from common import TMP_DIR
+from packages import install, PackageError
+
+CHECKPOINT_DIR = os.path.join(TMP_DIR, "install")
 
 install_list = []
+# Packages the loaded installers need, installed in one transaction before
+# any installer runs
+install_packages = []
+
+
+def plugin_requirements(module, config):
+    """
+    The packages an installer needs, from its requirements(config) if it
+    has one, else its REQUIREMENTS
+    """
+    if hasattr(module, "requirements"):
+        return module.requirements(config)
+    return getattr(module, "REQUIREMENTS", ())
 
 
-def load_plugin_installers(plugins):
-    plugs = install_load()
+def load_plugin_installers(plugins, config):
+    available = plugin_manifest(PLUGIN_INSTALL)
     for plugin in plugins:
-        if plugin not in plugs:
+        if plugin not in available:
             print("Unrecognized install plugin requested:", plugin)
-            print("Available install plugins:", ", ".join(plugins.keys()))
+            print("Available install plugins:", ", ".join(sorted(available)))
             sys.exit(1)
-        install_list.append(plugs[plugin].install)
+    plugs = install_load(plugins)
+    for plugin in plugins:
+        install_list.append((plugin, get_steps(plugs[plugin])))
+        for name in plugin_requirements(plugs[plugin], config):
+            if name not in install_packages:
+                install_packages.append(name)
+
+
+def get_steps(module):
+    """
+    Returns the plugin's [(step name, step(config, state))].  Plugins
+    without load_steps() run their install(config) as a single step
+    """
+    if hasattr(module, "load_steps"):
+        return module.load_steps()
+    return [("install", lambda config, state: module.install(config))]
+
+
+def config_key(config):
+    """
+    Hashes the plain values in config.  A checkpoint is only reused while
+    this matches, so changing the config file reruns every step
+    """
+    plain = {k: v for k, v in config.items()
+             if isinstance(v, (type(""), int, float, bool, type(None)))}
+    return hashlib.sha256(json.dumps(
+        plain, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def checkpoint_path(plugin):
+    return os.path.join(CHECKPOINT_DIR, "{}.json".format(plugin))
+
+
+def load_checkpoint(plugin, key):
+    """
+    Returns {"key", "done", "state"} for the plugin's last run, or a fresh
+    checkpoint if there is none or it was made with another config
+    """
+    fresh = {"key": key, "done": [], "state": {}}
+    try:
+        with io.open(checkpoint_path(plugin), 'r') as f:
+            checkpoint = json.loads(f.read())
+    except (IOError, OSError, ValueError):
+        return fresh
+    if checkpoint.get("key") != key:
+        return fresh
+    return checkpoint
+
+
+def save_checkpoint(plugin, checkpoint):
+    if not os.path.isdir(CHECKPOINT_DIR):
+        os.makedirs(CHECKPOINT_DIR)
+    path = checkpoint_path(plugin)
+    tmp = path + ".tmp"
+    with io.open(tmp, 'w') as f:
+        f.write(json.dumps(checkpoint, indent=4))
+    os.rename(tmp, path)
+
+
+def clear_checkpoint(plugin):
+    try:
+        os.remove(checkpoint_path(plugin))
+    except OSError:
+        pass
+
+
+def run_steps(plugin, steps, config, force=False):
+    """
+    Runs the plugin's steps in order, checkpointing after each one so a
+    rerun resumes after the last completed step.  Steps share a state dict
+    that is persisted with the checkpoint.  The checkpoint is removed once
+    every step succeeded, so only partial runs are resumed and a later run
+    installs again (e.g. a newer "latest" driver).  Returns a result dict
+    """
+    checkpoint = load_checkpoint(plugin, config_key(config))
+    if force:
+        checkpoint["done"], checkpoint["state"] = [], {}
+    result = {"plugin": plugin, "status": "ok", "steps": [], "error": None}
+    for name, step in steps:
+        if name in checkpoint["done"]:
+            vprint("{}: {} already done, skipping".format(plugin, name))
+            result["steps"].append({"step": name, "status": "skipped",
+                                    "seconds": 0.0})
+            continue
+        vprint("{}: running {}".format(plugin, name))
+        start = time.time()
+        try:
+            step(config, checkpoint["state"])
+        except Exception as e:
+            result["steps"].append({"step": name, "status": "failed",
+                                    "seconds": round(time.time() - start, 3)})
+            result.update(status="failed", error="{}: {}".format(name, e))
+            save_checkpoint(plugin, checkpoint)
+            break
+        checkpoint["done"].append(name)
+        save_checkpoint(plugin, checkpoint)
+        result["steps"].append({"step": name, "status": "ok",
+                                "seconds": round(time.time() - start, 3)})
+    if result["status"] == "ok":
+        clear_checkpoint(plugin)
+    return result
+
+
+def run_installers(config, plugins, force=False):
+    """
+    Installs the requirements of every requested plugin, then runs the
+    plugins' pipelines concurrently.  Returns a result dict per plugin
+    """
+    load_plugin_installers(plugins, config)
+    if install_packages:
+        try:
+            install(install_packages)
+        except PackageError as e:
+            print("Cannot install installer requirements:", e)
+            sys.exit(1)
+    results = [None] * len(install_list)
+
+    def _run(index, plugin, steps):
+        results[index] = run_steps(plugin, steps, config, force)
+
+    threads = [threading.Thread(target=_run, args=(i, plugin, steps))
+               for i, (plugin, steps) in enumerate(install_list)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
 
 
-def run_installers(config, plugins):
-    results = []
-    load_plugin_installers(plugins)
-    for installer in install_list:
-        results.append(installer(config))
+def print_results(results):
+    from tabulate import tabulate
+    rows = []
+    for result in results:
+        for step in result["steps"]:
+            rows.append([result["plugin"], step["step"],
+                         step["status"].upper(), step["seconds"]])
+    print(tabulate(rows, headers=["Plugin", "Step", "Status", "Seconds"],
+                   tablefmt="grid"))
+    for result in results:
+        if result["error"]:
+            print("{} failed during {}".format(result["plugin"],
+                                               result["error"]))
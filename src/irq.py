@@ -0,0 +1,147 @@
+from __future__ import (print_function, unicode_literals, division,
+                        absolute_import)
+
+import time
+
+from common import vprint, check, ff, wf, hs, read_sysfs, list_sysfs
+from common import parse_cpulist
+from mtu import get_storage_interfaces, get_physical_interfaces
+
+PROC_INTERRUPTS = "/proc/interrupts"
+SAMPLE_INTERVAL = 1.0
+# A single CPU handling more than this share of a NIC's interrupts is
+# considered a hotspot
+HOTSPOT_SHARE = 0.5
+# Ignore hotspots when the NIC is basically idle during sampling
+MIN_RATE = 100
+
+
+def read_interrupts():
+    """
+    Parses /proc/interrupts into {irq: ([per-cpu counts], name)}
+    """
+    data = read_sysfs(PROC_INTERRUPTS, "")
+    lines = data.splitlines()
+    if not lines:
+        return {}
+    ncpus = len(lines[0].split())
+    result = {}
+    for line in lines[1:]:
+        irq, _, rest = line.partition(":")
+        irq = irq.strip()
+        if not irq.isdigit():
+            continue
+        parts = rest.split()
+        counts = [int(c) for c in parts[:ncpus] if c.isdigit()]
+        result[irq] = (counts, " ".join(parts[ncpus:]))
+    return result
+
+
+def nic_irqs(iface, interrupts):
+    """
+    Returns the irqs serving iface, using its MSI-X vectors from sysfs and
+    falling back to matching the interface name in /proc/interrupts
+    """
+    irqs = [irq for irq in list_sysfs(
+        "/sys/class/net/{}/device/msi_irqs".format(iface))
+        if irq in interrupts]
+    if irqs:
+        return irqs
+    found = []
+    for irq, (_, name) in interrupts.items():
+        device = name.split()[-1] if name else ""
+        if device == iface or device.startswith(iface + "-"):
+            found.append(irq)
+    return found
+
+
+def numa_cpus():
+    cpus = {}
+    for node in list_sysfs("/sys/devices/system/node"):
+        if node.startswith("node") and node[4:].isdigit():
+            cpus[int(node[4:])] = set(parse_cpulist(read_sysfs(
+                "/sys/devices/system/node/{}/cpulist".format(node))))
+    return cpus
+
+
+def analyze(iface, irqs, before, after, interval, node_cpus):
+    numa_node = read_sysfs(
+        "/sys/class/net/{}/device/numa_node".format(iface), "-1")
+    numa_node = int(numa_node) if numa_node.lstrip("-").isdigit() else -1
+    local = node_cpus.get(numa_node)
+    affinity = {}
+    cross = []
+    rates = {}
+    for irq in irqs:
+        cpus = parse_cpulist(read_sysfs(
+            "/proc/irq/{}/smp_affinity_list".format(irq)))
+        affinity[irq] = cpus
+        if local and cpus and not set(cpus) & local:
+            cross.append(irq)
+        old = before.get(irq, ([], ""))[0]
+        new = after.get(irq, ([], ""))[0]
+        for cpu, (o, n) in enumerate(zip(old, new)):
+            if n > o:
+                rates[cpu] = rates.get(cpu, 0) + (n - o) / interval
+    return {"numa_node": numa_node,
+            "affinity": affinity,
+            "cross_numa": cross,
+            "rates": {cpu: round(rate, 1) for cpu, rate in rates.items()}}
+
+
+@check("IRQ Affinity", "basic", "irq", "local")
+def check_irq_affinity(config):
+    vprint("Checking storage NIC interrupt affinity")
+    ifaces = get_storage_interfaces(config)
+    if not ifaces:
+        return wf("Couldn't find the interfaces serving VIP1/VIP2, IRQ "
+                  "affinity not checked", "B86C398D")
+    nics = []
+    for name, iface in sorted(ifaces.items()):
+        for phys in get_physical_interfaces(iface):
+            if phys not in nics:
+                nics.append(phys)
+    interval = float(config.get("irq_sample_interval", SAMPLE_INTERVAL))
+    before = read_interrupts()
+    time.sleep(interval)
+    after = read_interrupts()
+    node_cpus = numa_cpus()
+    state = {}
+    for nic in nics:
+        irqs = nic_irqs(nic, after)
+        if not irqs:
+            wf("No interrupt vectors found for storage NIC {}".format(nic),
+               "C414E635")
+            continue
+        result = analyze(nic, irqs, before, after, interval, node_cpus)
+        targets = set()
+        for cpus in result["affinity"].values():
+            targets.update(cpus)
+        if len(irqs) > 1 and len(targets) == 1:
+            ff("All {} interrupt vectors for storage NIC {} are pinned to "
+               "CPU {}".format(len(irqs), nic, list(targets)[0]), "459D0B94",
+               fix="Spread the NIC queue irqs across cores on NUMA node {} "
+                   "via /proc/irq/<irq>/smp_affinity_list (or the vendor "
+                   "set_irq_affinity script)".format(result["numa_node"]))
+        if result["cross_numa"]:
+            wf("{}/{} interrupt vectors for storage NIC {} are pinned to "
+               "CPUs outside its NUMA node {}".format(
+                   len(result["cross_numa"]), len(irqs), nic,
+                   result["numa_node"]), "18224821")
+        total = sum(result["rates"].values())
+        if total >= MIN_RATE and len(irqs) > 1:
+            cpu, rate = max(result["rates"].items(), key=lambda x: x[1])
+            if rate / total > HOTSPOT_SHARE:
+                wf("CPU {} handled {:.0%} of storage NIC {} interrupts "
+                   "({:.0f}/s)".format(cpu, rate / total, nic, rate),
+                   "12628C60")
+        state[nic] = {"numa_node": result["numa_node"],
+                      "vectors": len(irqs),
+                      "cpus": ",".join(str(c) for c in sorted(targets)),
+                      "cross_numa_vectors": len(result["cross_numa"]),
+                      "irqs_per_sec_by_cpu": result["rates"]}
+    hs("storage_nic_irqs", state)
+
+
+def load_checks():
+    return [check_irq_affinity]
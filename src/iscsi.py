@@ -0,0 +1,219 @@
+from __future__ import (print_function, unicode_literals, division,
+                        absolute_import)
+
+import os
+import posixpath
+import subprocess
+
+from common import vprint, check, exe, wf, ff, hs, read_sysfs, list_sysfs
+from common import host_path, one_of, at_least, at_most
+
+SYS_SESSIONS = "/sys/class/iscsi_session"
+SYS_CONNECTIONS = "/sys/class/iscsi_connection"
+SYS_ISCSI_HOSTS = "/sys/class/iscsi_host"
+SYS_SCSI_HOSTS = "/sys/class/scsi_host"
+DATERA_IQN = "com.daterainc"
+# Number of example session names shown per deviation in the report
+SAMPLE = 5
+
+# Reported name: sysfs attribute.  recovery_tmo is
+# node.session.timeo.replacement_timeout, ping_tmo and recv_tmo are the
+# noop_out timeout and interval
+SESSION_ATTRS = {"targetname": "targetname",
+                 "ifacename": "ifacename",
+                 "state": "state",
+                 "replacement_timeout": "recovery_tmo"}
+CONNECTION_ATTRS = {"portal": "persistent_address",
+                    "port": "persistent_port",
+                    "MaxRecvDataSegmentLength": "max_recv_dlength",
+                    "MaxXmitDataSegmentLength": "max_xmit_dlength",
+                    "noop_out_timeout": "ping_tmo",
+                    "noop_out_interval": "recv_tmo"}
+
+# attribute: iscsiadm node setting
+NODE_SETTINGS = {
+    "noop_out_timeout": "node.conn[0].timeo.noop_out_timeout",
+    "noop_out_interval": "node.conn[0].timeo.noop_out_interval",
+    "replacement_timeout": "node.session.timeo.replacement_timeout",
+    "cmds_max": "node.session.cmds_max",
+    "queue_depth": "node.session.queue_depth",
+    "MaxRecvDataSegmentLength":
+        "node.conn[0].iscsi.MaxRecvDataSegmentLength",
+}
+
+# attribute: ((validator, description), code, failure?)
+PROFILE = {
+    "noop_out_timeout": (one_of("2"), "A363C2ED", True),
+    "noop_out_interval": (one_of("2"), "A15B0633", True),
+    "replacement_timeout": (at_most(120), "F45FCE90", False),
+    "cmds_max": (at_least(128), "1F9E44E3", False),
+    "queue_depth": (at_least(32), "8737A1AC", False),
+    "MaxRecvDataSegmentLength": (at_least(262144), "7410CABE", False),
+    "state": (one_of("LOGGED_IN"), "F9ABD24F", True),
+}
+
+
+def _resolve(path, link):
+    """
+    Resolves a sysfs symlink relative to HOST_ROOT.  The /sys/class entries
+    are symlinks themselves, so the link has to be followed from the real
+    directory, not joined onto the class path
+    """
+    target = os.path.realpath(host_path("{}/{}".format(path, link)))
+    if not os.path.exists(target):
+        return None
+    root = os.path.realpath(host_path("/"))
+    if root != "/":
+        if not target.startswith(root + "/"):
+            return None
+        target = target[len(root):]
+    return target
+
+
+def lun_queue_depth(device):
+    """
+    Returns the smallest queue_depth of the LUNs under a session's device
+    directory
+    """
+    depths = []
+    for target in list_sysfs(device):
+        if not target.startswith("target"):
+            continue
+        tpath = "{}/{}".format(device, target)
+        for lun in list_sysfs(tpath):
+            depth = read_sysfs("{}/{}/queue_depth".format(tpath, lun), "")
+            if depth.isdigit():
+                depths.append(int(depth))
+    return str(min(depths)) if depths else None
+
+
+def read_session(name, connection):
+    path = "{}/{}".format(SYS_SESSIONS, name)
+    session = {key: read_sysfs("{}/{}".format(path, attr))
+               for key, attr in SESSION_ATTRS.items()}
+    device = _resolve(path, "device")
+    # .../hostN/sessionM
+    host = posixpath.basename(posixpath.dirname(device)) if device else None
+    session["host"] = host
+    session["cmds_max"] = (read_sysfs("{}/{}/can_queue".format(
+        SYS_SCSI_HOSTS, host)) if host else None)
+    session["queue_depth"] = lun_queue_depth(device) if device else None
+    if host:
+        netdev = read_sysfs("{}/{}/netdev".format(SYS_ISCSI_HOSTS, host))
+        session["netdev"] = (netdev if netdev and netdev != "<NULL>"
+                             else None)
+    if connection:
+        cpath = "{}/{}".format(SYS_CONNECTIONS, connection)
+        for key, attr in CONNECTION_ATTRS.items():
+            session[key] = read_sysfs("{}/{}".format(cpath, attr))
+    return session
+
+
+def get_sessions():
+    """
+    Returns {session: {attribute: value}} for every iSCSI session in a
+    single pass over sysfs
+    """
+    # connectionN:0 belongs to sessionN
+    connections = {}
+    for conn in list_sysfs(SYS_CONNECTIONS):
+        sid = conn[len("connection"):].split(":")[0]
+        connections.setdefault("session" + sid, conn)
+    return {name: read_session(name, connections.get(name))
+            for name in list_sysfs(SYS_SESSIONS)
+            if name.startswith("session")}
+
+
+def route_interface(address, cache):
+    """
+    Software iSCSI sessions bound to the default iface have no netdev, so
+    the kernel routing decision tells us which interface carries them
+    """
+    if address not in cache:
+        cache[address] = None
+        try:
+            parts = exe("ip route get {}".format(address)).split()
+        except subprocess.CalledProcessError:
+            return None
+        if "dev" in parts:
+            cache[address] = parts[parts.index("dev") + 1]
+    return cache[address]
+
+
+def portal_map(sessions):
+    """
+    Returns {portal: interface}
+    """
+    cache = {}
+    portals = {}
+    for session in sessions.values():
+        portal = session.get("portal")
+        if not portal:
+            continue
+        iface = session.get("netdev") or route_interface(portal, cache)
+        portals["{}:{}".format(portal, session.get("port"))] = iface
+    return portals
+
+
+def find_deviations(sessions):
+    """
+    Returns {attribute: {value: [sessions]}} for every attribute that
+    doesn't match PROFILE
+    """
+    deviations = {}
+    for name, session in sorted(sessions.items()):
+        for attr, ((valid, _), _, _) in PROFILE.items():
+            value = session.get(attr)
+            if value is None or valid(value):
+                continue
+            deviations.setdefault(attr, {}).setdefault(value, []).append(
+                name)
+    return deviations
+
+
+def summarize(sessions):
+    summary = {}
+    for session in sessions.values():
+        for attr in PROFILE:
+            value = session.get(attr)
+            if value is None:
+                continue
+            counts = summary.setdefault(attr, {})
+            counts[value] = counts.get(value, 0) + 1
+    return summary
+
+
+@check("ISCSI Sessions", "basic", "iscsi", "local")
+def check_iscsi_sessions(config):
+    vprint("Checking iSCSI session and connection settings")
+    sessions = get_sessions()
+    datera = {name: session for name, session in sessions.items()
+              if DATERA_IQN in (session.get("targetname") or "")}
+    if not datera:
+        return wf("No Datera iSCSI sessions are logged in, session settings "
+                  "could not be checked", "2B75B04B")
+    hs("iscsi_sessions", {"sessions": len(sessions),
+                          "datera_sessions": len(datera),
+                          "settings": summarize(datera),
+                          "portals": portal_map(datera)})
+    total = len(datera)
+    for attr, values in sorted(find_deviations(datera).items()):
+        (_, expected), code, fail = PROFILE[attr]
+        for value, names in sorted(values.items()):
+            msg = ("{} is '{}' on {}/{} Datera sessions, expected {} "
+                   "[{}]".format(attr, value, len(names), total, expected,
+                                 ", ".join(names[:SAMPLE]) +
+                                 (", ..." if len(names) > SAMPLE else "")))
+            fix = None
+            if attr in NODE_SETTINGS:
+                fix = ("iscsiadm -m node -T <target> -o update -n {} -v "
+                       "<value>, then log the sessions out and back "
+                       "in".format(NODE_SETTINGS[attr]))
+            if fail:
+                ff(msg, code, fix=fix)
+            else:
+                wf(msg, code, fix=fix)
+
+
+def load_checks():
+    return [check_iscsi_sessions]
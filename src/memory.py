@@ -0,0 +1,138 @@
+from __future__ import (print_function, unicode_literals, division,
+                        absolute_import)
+
+import re
+
+from common import vprint, check, wf, hs, read_sysfs, list_sysfs, run_fact
+
+PROC_MEMINFO = "/proc/meminfo"
+PROC_VM = "/proc/sys/vm"
+SYS_NODE = "/sys/devices/system/node"
+SYS_THP = "/sys/kernel/mm/transparent_hugepage"
+VM_TUNABLES = ("dirty_ratio", "dirty_background_ratio", "dirty_bytes",
+               "dirty_background_bytes", "swappiness", "min_free_kbytes",
+               "zone_reclaim_mode")
+SELECTED_RE = re.compile(r"\[(\S+)\]")
+NODE_MEMINFO_RE = re.compile(r"^Node \d+ (\S+):\s+(\d+)")
+# A NUMA node with less free (plus inactive page cache) memory than this
+# share of its total is reported, allocations for I/O buffers on it spill
+# to remote memory
+MIN_NODE_FREE = 0.05
+GBi = 1024 * 1024.0
+
+# tunable: (maximum recommended value, code).  Large dirty ratios on big
+# memory hosts let gigabytes of dirty page cache build up and then flush to
+# the Datera volumes in bursts
+RECOMMENDED = {"dirty_ratio": (10, "1128F298"),
+               "dirty_background_ratio": (5, "8881546E"),
+               "swappiness": (10, "0AF31334"),
+               "zone_reclaim_mode": (0, "2EECBA9E")}
+
+
+def parse_meminfo(data):
+    """
+    Parses /proc/meminfo into {key: kB (or count for HugePages_*)}
+    """
+    result = {}
+    for line in data.splitlines():
+        key, _, value = line.partition(":")
+        parts = value.split()
+        if parts and parts[0].isdigit():
+            result[key.strip()] = int(parts[0])
+    return result
+
+
+def read_nodes():
+    """
+    Returns {node: {"total_gib", "free_gib", "reclaimable_gib"}} from the
+    per node meminfo
+    """
+    nodes = {}
+    for node in list_sysfs(SYS_NODE):
+        if not (node.startswith("node") and node[4:].isdigit()):
+            continue
+        info = {}
+        for line in read_sysfs("{}/{}/meminfo".format(
+                SYS_NODE, node), "").splitlines():
+            match = NODE_MEMINFO_RE.match(line)
+            if match:
+                info[match.group(1)] = int(match.group(2))
+        nodes[int(node[4:])] = {
+            "total_gib": round(info.get("MemTotal", 0) / GBi, 2),
+            "free_gib": round(info.get("MemFree", 0) / GBi, 2),
+            "reclaimable_gib": round((info.get("MemFree", 0) +
+                                      info.get("Inactive(file)", 0)) / GBi,
+                                     2)}
+    return nodes
+
+
+def _selected(path):
+    value = read_sysfs(path, "")
+    match = SELECTED_RE.search(value)
+    return match.group(1) if match else value or None
+
+
+@run_fact
+def get_memory_state():
+    """
+    Collects VM tunables, THP mode, hugepages and per node free memory in
+    one pass.  Shared by the Memory check and --host-state
+    """
+    meminfo = parse_meminfo(read_sysfs(PROC_MEMINFO, ""))
+    vm = {}
+    for name in VM_TUNABLES:
+        value = read_sysfs("{}/{}".format(PROC_VM, name))
+        vm[name] = int(value) if value and value.isdigit() else value
+    hugepage_kb = meminfo.get("Hugepagesize", 0)
+    return {"vm": vm,
+            "thp": {"enabled": _selected(SYS_THP + "/enabled"),
+                    "defrag": _selected(SYS_THP + "/defrag")},
+            "hugepages": {"total": meminfo.get("HugePages_Total", 0),
+                          "free": meminfo.get("HugePages_Free", 0),
+                          "size_kb": hugepage_kb},
+            "memory": {"total_gib": round(
+                           meminfo.get("MemTotal", 0) / GBi, 2),
+                       "available_gib": round(
+                           meminfo.get("MemAvailable", 0) / GBi, 2),
+                       "dirty_mib": round(meminfo.get("Dirty", 0) / 1024.0,
+                                          1)},
+            "numa_nodes": read_nodes()}
+
+
+@check("Memory", "basic", "memory", "sysctl", "local")
+def check_memory(config):
+    vprint("Checking VM tunables, THP, hugepages and NUMA memory")
+    state = get_memory_state()
+    hs("memory", state)
+    vm = state["vm"]
+    for name, (maximum, code) in sorted(RECOMMENDED.items()):
+        value = vm.get(name)
+        if not isinstance(value, int):
+            continue
+        # The ratios are ignored by the kernel when the _bytes form is set
+        if name.endswith("ratio") and vm.get(
+                name.replace("ratio", "bytes")):
+            continue
+        if value > maximum:
+            wf("vm.{} is {}, recommended <= {}".format(name, value, maximum),
+               code, fix="sysctl -w vm.{}={}".format(name, maximum))
+    if state["thp"]["enabled"] == "always":
+        wf("Transparent hugepages are set to 'always', compaction stalls "
+           "add latency", "8D0D857F",
+           fix="echo madvise > {}/enabled".format(SYS_THP))
+    huge = state["hugepages"]
+    if huge["total"] and huge["free"] == huge["total"]:
+        wf("{} hugepages ({:.1f} GiB) are reserved but unused and are not "
+           "available to the page cache".format(
+               huge["total"], huge["total"] * huge["size_kb"] / GBi),
+           "10373CD0", fix="sysctl -w vm.nr_hugepages=0")
+    for node, info in sorted(state["numa_nodes"].items()):
+        if info["total_gib"] and (
+                info["reclaimable_gib"] / info["total_gib"] < MIN_NODE_FREE):
+            wf("NUMA node {} has {} GiB of {} GiB free or reclaimable".format(
+                node, info["reclaimable_gib"], info["total_gib"]),
+               "937F8E15")
+
+
+def load_checks():
+    return [check_memory]
@@ -5,7 +5,7 @@ import re
 import subprocess
 
 from common import vprint, exe, exe_check, ff, check, parse_route_table, is_l3
-from common import wf
+from common import wf, list_sysfs
 
 import ipaddress
 import socket
@@ -37,6 +37,44 @@ def get_interface_for_ip(ip):
     None
 
 
+def get_storage_interfaces(config, names=("VIP1", "VIP2")):
+    """
+    Returns {name: interface} for the local interfaces routing to the
+    MGMT/VIP1/VIP2 ips in config.  Names without an ip or a route are left
+    out
+    """
+    keys = {"MGMT": "mgmt_ip", "VIP1": "vip1_ip", "VIP2": "vip2_ip"}
+    found = {}
+    for name in names:
+        ip = config.get(keys[name])
+        if not ip:
+            continue
+        iface = get_interface_for_ip(ip)
+        if iface:
+            found[name] = iface
+    return found
+
+
+def get_physical_interfaces(iface):
+    """
+    Resolves bonds, vlans and bridges down to the physical NICs backing
+    iface by following the lower_* links in sysfs
+    """
+    base = "/sys/class/net/{}".format(iface)
+    if list_sysfs(base + "/device"):
+        return [iface]
+    lowers = [e[len("lower_"):] for e in list_sysfs(base)
+              if e.startswith("lower_")]
+    if not lowers:
+        return [iface]
+    result = []
+    for lower in lowers:
+        for phys in get_physical_interfaces(lower):
+            if phys not in result:
+                result.append(phys)
+    return result
+
+
 def check_mtu_normal(name, ip, config):
     vprint("Performing MTU check")
     cname = iface_dict[name]
@@ -1,15 +1,40 @@
 from __future__ import (print_function, unicode_literals, division,
                         absolute_import)
 import io
+import mmap
 import os
+import random
+import subprocess
+import threading
+import time
 
 from common import vprint, parse_mconf, check, exe_check, ff, wf, get_os
+from common import exe, hs, read_sysfs, list_sysfs, which, host_path
 from common import ASSETS, UBUNTU, CENTOS6, CENTOS7
+from block import is_datera_device
+from netbench import percentile
 
 
 CENTOS6_CONF = os.path.join(ASSETS, "centos6.mconf")
 CENTOS7_CONF = os.path.join(ASSETS, "centos7.mconf")
 UBUNTU_CONF = os.path.join(ASSETS, "ubuntu.mconf")
+MULTIPATH_CONF = "/etc/multipath.conf"
+
+# Path latency benchmark
+IO_SIZE = 4096
+PATH_READS = 200
+# Only read from the start of the LUN so the benchmark doesn't depend on
+# what has been written to the rest of it
+READ_SPAN = 1024 ** 3
+# A path whose median latency is this many times the median of all paths
+# is reported as slow
+SLOW_PATH_FACTOR = 2.0
+# How long a path stays failed during the failover test
+FAILOVER_HOLD = 5.0
+MAX_STALL_MS = 5000
+# How long the failover test waits for a read that is still blocked after
+# the hold
+STALL_WAIT = 60.0
 
 CONFS = {CENTOS6: CENTOS6_CONF,
          CENTOS7: CENTOS7_CONF,
@@ -19,10 +44,10 @@ CONFS = {CENTOS6: CENTOS6_CONF,
 @check("Multipath", "basic", "multipath", "local")
 def check_multipath(config):
     vprint("Checking multipath settings")
-    if not exe_check("which multipath", err=False):
+    if not which("multipath"):
         ff("Multipath binary could not be found, is it installed?",
            "2D18685C")
-    if not exe_check("which systemctl"):
+    if not which("systemctl"):
         if not exe_check("service multipathd status | grep 'Active: active'",
                          err=False):
             fix = "service multipathd start"
@@ -34,24 +59,25 @@ def check_multipath(config):
             ff("multipathd not enabled", "541C10BF", fix=fix)
 
 
-@check("Multipath Conf", "basic", "multipath", "local")
+@check("Multipath Conf", "basic", "multipath", "local",
+       inputs=["file:/etc/multipath.conf", "hash:/etc/os-release"])
 def check_multipath_conf(config):
     dist = get_os()
     vfile = CONFS.get(dist)
     if not vfile:
         wf("No supported multipath.conf file for: {}".format(dist), "381CE248")
     mfile = "/etc/multipath.conf"
-    if not os.path.exists(mfile):
+    if not os.path.exists(host_path(mfile)):
         if not vfile:
             fix = "copy a multipath.conf file from the Datera Deployment Guide"
         else:
             fix = "copy {} to /etc/multipath.conf".format(vfile)
         return ff("/etc/multipath.conf file not found", "1D506D89", fix=fix)
-    with io.open(mfile, 'r') as f:
+    with io.open(host_path(mfile), 'r') as f:
         mconf = parse_mconf(f.read())
 
     # Check defaults section
-    defaults = filter(lambda x: x[0] == 'defaults', mconf)
+    defaults = list(filter(lambda x: x[0] == 'defaults', mconf))
     fix = ("check the example multipath.conf file from Datera deployment"
            "guide")
     if not defaults:
@@ -68,7 +94,7 @@ def check_multipath_conf(config):
                "70191A9A", fix=fix)
 
     # Check devices section
-    devices = filter(lambda x: x[0] == 'devices', mconf)
+    devices = list(filter(lambda x: x[0] == 'devices', mconf))
     if not devices:
         ff("Missing devices section", "797A6031", fix=fix)
     else:
@@ -88,7 +114,7 @@ def check_multipath_conf(config):
                fix=fix)
 
     # Blacklist exceptions
-    be = filter(lambda x: x[0] == 'blacklist_exceptions', mconf)
+    be = list(filter(lambda x: x[0] == 'blacklist_exceptions', mconf))
     if not be:
         ff("Missing blacklist_exceptions section", "B8C8A19C")
     else:
@@ -111,5 +137,282 @@ def check_multipath_conf(config):
                "642753A0", fix=fix)
 
 
+def get_datera_maps():
+    """
+    Returns {map name: {"dm": dm-N, "paths": [sdX, ...]}} for every
+    multipath map whose paths are Datera LUNs
+    """
+    maps = {}
+    for dm in list_sysfs("/sys/block"):
+        if not dm.startswith("dm-"):
+            continue
+        uuid = read_sysfs("/sys/block/{}/dm/uuid".format(dm), "")
+        if not uuid.startswith("mpath-"):
+            continue
+        paths = [sd for sd in list_sysfs("/sys/block/{}/slaves".format(dm))
+                 if is_datera_device(sd)]
+        if paths:
+            name = read_sysfs("/sys/block/{}/dm/name".format(dm), dm)
+            maps[name] = {"dm": dm, "paths": paths}
+    return maps
+
+
+def get_mpath_settings():
+    """
+    Returns the checker_timeout, failback and path_selector in effect for
+    Datera devices according to /etc/multipath.conf
+    """
+    settings = {}
+    try:
+        with io.open(host_path(MULTIPATH_CONF), 'r') as f:
+            mconf = parse_mconf(f.read())
+    except (IOError, OSError):
+        return settings
+    for section, entries in mconf:
+        if section == "defaults":
+            settings.update((k, v) for k, v in entries
+                            if not isinstance(v, list))
+    for section, entries in mconf:
+        if section != "devices":
+            continue
+        for _, device in entries:
+            ddict = dict((k, v) for k, v in device
+                         if not isinstance(v, list))
+            if ddict.get("vendor") == "DATERA":
+                settings.update(ddict)
+    return {key: settings.get(key) for key in ("checker_timeout", "failback",
+                                               "path_selector")}
+
+
+def _percentiles(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+    return {"p50_us": percentile(latencies, 50),
+            "p99_us": percentile(latencies, 99),
+            "max_us": latencies[-1]}
+
+
+def _direct_reader(dev):
+    """
+    Opens dev for O_DIRECT reads.  Returns (file, aligned buffer, number of
+    IO_SIZE blocks that can be read)
+    """
+    fd = os.open("/dev/{}".format(dev), os.O_RDONLY | os.O_DIRECT)
+    f = io.FileIO(fd, "r", closefd=True)
+    size = int(read_sysfs("/sys/block/{}/size".format(dev), "0")) * 512
+    # Anonymous mmaps are page aligned, which O_DIRECT requires
+    buf = mmap.mmap(-1, IO_SIZE)
+    return f, buf, max(min(size, READ_SPAN) // IO_SIZE, 1)
+
+
+def read_latency(dev, count=PATH_READS):
+    """
+    Issues count random IO_SIZE direct reads to dev and returns latency
+    percentiles in microseconds
+    """
+    f, buf, blocks = _direct_reader(dev)
+    latencies = []
+    errors = 0
+    try:
+        for _ in range(count):
+            offset = random.randrange(blocks) * IO_SIZE
+            start = time.time()
+            try:
+                f.seek(offset)
+                f.readinto(buf)
+            except (IOError, OSError):
+                errors += 1
+                continue
+            latencies.append(int((time.time() - start) * 1e6))
+    finally:
+        f.close()
+        buf.close()
+    result = _percentiles(latencies)
+    result["errors"] = errors
+    return result
+
+
+class StallMonitor(object):
+    """
+    Reads from a multipath map in a loop and records the longest time
+    without a completed read, including a read that is still blocked
+    """
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.stopped = threading.Event()
+        self.cond = threading.Condition()
+        self.errors = 0
+        self.reads = 0
+        self.max_gap = 0.0
+        self.last = time.time()
+        self.error = None
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+
+    def _loop(self):
+        try:
+            f, buf, blocks = _direct_reader(self.dev)
+        except Exception as e:
+            with self.cond:
+                self.error = e
+                self.cond.notify_all()
+            return
+        try:
+            while not self.stopped.is_set():
+                try:
+                    f.seek(random.randrange(blocks) * IO_SIZE)
+                    f.readinto(buf)
+                    self.reads += 1
+                except (IOError, OSError):
+                    self.errors += 1
+                with self.cond:
+                    now = time.time()
+                    self.max_gap = max(self.max_gap, now - self.last)
+                    self.last = now
+                    self.cond.notify_all()
+        except Exception as e:
+            with self.cond:
+                self.error = e
+                self.cond.notify_all()
+        finally:
+            f.close()
+            buf.close()
+
+    def check(self):
+        """
+        Raises the error that stopped the reader, if any
+        """
+        if self.error is not None:
+            raise self.error
+
+    def measure(self, action, hold):
+        """
+        Resets the gap, runs action and keeps reading for hold seconds.  A
+        read still blocked after hold is waited for, up to STALL_WAIT
+        seconds, and counted.  Returns (max gap ms, errors)
+        """
+        with self.cond:
+            self.max_gap = 0.0
+            self.last = time.time()
+        errors = self.errors
+        action()
+        time.sleep(hold)
+        deadline = time.time() + STALL_WAIT
+        with self.cond:
+            reads = self.reads + self.errors
+            while (self.reads + self.errors == reads and self.error is None
+                   and time.time() < deadline):
+                self.cond.wait(deadline - time.time())
+            gap = self.max_gap
+            if self.reads + self.errors == reads:
+                # Still blocked (or the reader died)
+                gap = max(gap, time.time() - self.last)
+        self.check()
+        return int(gap * 1000), self.errors - errors
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        # A reader stuck in a read that never completes is a daemon thread
+        self.thread.join(STALL_WAIT)
+
+
+def failover_test(dm, path, hold):
+    """
+    Fails path with multipathd while reading from dm, reinstates it and
+    returns the I/O stall and errors seen during each transition
+    """
+    result = {"path": path}
+    with StallMonitor(dm) as monitor:
+        time.sleep(0.5)
+        # Don't fail a path without a working reader
+        monitor.check()
+        try:
+            result["fail_stall_ms"], result["fail_errors"] = monitor.measure(
+                lambda: exe("multipathd fail path {}".format(path)), hold)
+        finally:
+            result["reinstate_stall_ms"], result["reinstate_errors"] = (
+                monitor.measure(
+                    lambda: exe("multipathd reinstate path {}".format(path)),
+                    hold))
+        result["reads"] = monitor.reads
+    return result
+
+
+@check("Multipath Paths", "multipath", "mpath_bench", "local")
+def check_multipath_paths(config):
+    vprint("Benchmarking Datera multipath path latency")
+    maps = get_datera_maps()
+    if not maps:
+        return wf("No Datera multipath maps found, path latency not "
+                  "measured", "84D1635F")
+    count = int(config.get("mpath_path_reads", PATH_READS))
+    state = {"settings": get_mpath_settings(), "maps": {}}
+    for name, mpath in sorted(maps.items()):
+        paths = {}
+        for path in mpath["paths"]:
+            try:
+                paths[path] = read_latency(path, count)
+            except (IOError, OSError) as e:
+                ff("Could not open path {} of {}: {}".format(path, name, e),
+                   "BEB8B292")
+                continue
+            if paths[path]["errors"]:
+                ff("{}/{} reads failed on path {} of {}".format(
+                    paths[path]["errors"], count, path, name), "BEB8B292")
+        state["maps"][name] = {"dm": mpath["dm"], "paths": paths}
+        medians = sorted(p["p50_us"] for p in paths.values() if "p50_us" in p)
+        if len(medians) < 2:
+            continue
+        median = medians[len(medians) // 2]
+        for path, result in sorted(paths.items()):
+            if result.get("p50_us", 0) > median * SLOW_PATH_FACTOR:
+                wf("Path {} of {} has a median read latency of {}us, the "
+                   "median across its paths is {}us".format(
+                       path, name, result["p50_us"], median), "3ED0249A")
+    if config.get("mpath_failover_test"):
+        failover(config, maps, state)
+    hs("multipath_paths", state)
+
+
+def failover(config, maps, state):
+    """
+    Runs the optional failover test against the first Datera map with more
+    than one path
+    """
+    candidates = [(name, m) for name, m in sorted(maps.items())
+                  if len(m["paths"]) > 1]
+    if not candidates:
+        return wf("No Datera multipath map with more than one path, "
+                  "failover not tested", "6BA8619A")
+    name, mpath = candidates[0]
+    checker_timeout = state["settings"].get("checker_timeout")
+    max_stall = int(config.get("mpath_max_stall_ms", MAX_STALL_MS))
+    vprint("Failing path {} of {}".format(mpath["paths"][0], name))
+    try:
+        result = failover_test(mpath["dm"], mpath["paths"][0], float(
+            config.get("mpath_failover_hold", FAILOVER_HOLD)))
+    except (subprocess.CalledProcessError, IOError, OSError) as e:
+        return ff("Failover test on {} failed: {}".format(name, e),
+                  "D1860A51")
+    state["failover"] = dict(result, map=name)
+    for phase, done in (("fail", "failed"), ("reinstate", "reinstated")):
+        if result["{}_errors".format(phase)]:
+            ff("{} I/O errors on {} while the path was {}".format(
+                result["{}_errors".format(phase)], name, done), "E5790074",
+               fix="Check that no_path_retry/queue_if_no_path is set for "
+                   "the Datera device")
+        stall = result["{}_stall_ms".format(phase)]
+        if stall > max_stall:
+            wf("I/O on {} stalled for {}ms while the path was {} "
+               "(checker_timeout {})".format(name, stall, done,
+                                             checker_timeout), "4365CBC4")
+
+
 def load_checks():
-    return [check_multipath, check_multipath_conf]
+    return [check_multipath, check_multipath_conf, check_multipath_paths]
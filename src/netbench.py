@@ -0,0 +1,336 @@
+from __future__ import (print_function, unicode_literals, division,
+                        absolute_import)
+
+import json
+import math
+import socket
+import struct
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from common import vprint, check, ff, wf, hs
+
+ISCSI_PORT = 3260
+NETBENCH_PORT = 7637
+CONNECTS = 50
+CONNECT_CONCURRENCY = 8
+CONNECT_TIMEOUT = 2.0
+DURATION = 5.0
+STREAMS = 8
+BUFFER_SIZE = 128 * 1024
+PERCENTILES = (50, 90, 99)
+# Connect p99 above this (ms) is reported
+MAX_CONNECT_MS = 10.0
+
+NET_FIX = ("Check that the iSCSI portal is reachable over TCP and not "
+           "filtered by a firewall")
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    if not values:
+        return None
+    index = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+def connect_latency(host, port=ISCSI_PORT, count=CONNECTS,
+                    concurrency=CONNECT_CONCURRENCY,
+                    timeout=CONNECT_TIMEOUT):
+    """
+    Opens count TCP connections to host:port, concurrency at a time, and
+    returns {"count", "errors", "min_ms", "pN_ms", "max_ms"}.  Connections
+    are closed as soon as the handshake completes
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    remaining = [count]
+
+    def _worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            start = time.time()
+            try:
+                sock = socket.create_connection((host, port), timeout)
+            except (socket.error, socket.timeout) as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            elapsed = (time.time() - start) * 1000.0
+            # Reset instead of a FIN handshake so probes don't leave
+            # TIME_WAIT sockets behind on either side
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                            struct.pack(str("ii"), 1, 0))
+            sock.close()
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=_worker)
+               for _ in range(min(concurrency, count))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    result = {"count": count, "errors": len(errors)}
+    if errors:
+        result["last_error"] = errors[-1]
+    if latencies:
+        result["min_ms"] = round(latencies[0], 3)
+        for pct in PERCENTILES:
+            result["p{}_ms".format(pct)] = round(
+                percentile(latencies, pct), 3)
+        result["max_ms"] = round(latencies[-1], 3)
+    return result
+
+
+class NetbenchHandler(socketserver.BaseRequestHandler):
+    """
+    Discards everything the client sends and, once the client shuts down
+    its side, replies with the number of bytes received
+    """
+
+    def handle(self):
+        received = 0
+        try:
+            while True:
+                data = self.request.recv(BUFFER_SIZE)
+                if not data:
+                    break
+                received += len(data)
+            self.request.sendall("{}\n".format(received).encode("utf-8"))
+        except socket.error:
+            # Connect latency probes reset the connection right away
+            pass
+
+
+class NetbenchServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # Connect probes complete and reset faster than a Python accept loop
+    # drains them.  The default backlog of 5 overflows and shows up as 1s
+    # SYN retransmits in the latency percentiles
+    request_queue_size = 1024
+
+
+def serve(host="0.0.0.0", port=NETBENCH_PORT):
+    server = NetbenchServer((host, port), NetbenchHandler)
+    print("ddct netbench server listening on {}:{}".format(
+        *server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def start_loopback():
+    """
+    Starts a server on an ephemeral loopback port in a background thread
+    and returns it.  Call shutdown() when done
+    """
+    server = NetbenchServer(("127.0.0.1", 0), NetbenchHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _stream(host, port, duration, result):
+    payload = b"\0" * BUFFER_SIZE
+    sock = socket.create_connection((host, port), CONNECT_TIMEOUT)
+    try:
+        sock.settimeout(duration + 30)
+        start = time.time()
+        deadline = start + duration
+        sent = 0
+        while time.time() < deadline:
+            sock.sendall(payload)
+            sent += len(payload)
+        sock.shutdown(socket.SHUT_WR)
+        reply = b""
+        while not reply.endswith(b"\n"):
+            data = sock.recv(64)
+            if not data:
+                break
+            reply += data
+        result.update(start=start, end=time.time(), sent=sent,
+                      received=int(reply.strip() or 0))
+    finally:
+        sock.close()
+
+
+def throughput(host, port=NETBENCH_PORT, streams=1, duration=DURATION):
+    """
+    Runs streams parallel memory-to-memory transfers to a netbench server
+    and returns {"streams", "gbps", "bytes", "errors"}.  Only bytes the
+    server acknowledged are counted
+    """
+    results = [{} for _ in range(streams)]
+    errors = []
+
+    def _run(result):
+        try:
+            _stream(host, port, duration, result)
+        except (socket.error, socket.timeout, ValueError) as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=_run, args=(r,)) for r in results]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    done = [r for r in results if r]
+    total = sum(r["received"] for r in done)
+    gbps = 0.0
+    if done:
+        elapsed = (max(r["end"] for r in done) -
+                   min(r["start"] for r in done))
+        gbps = round(total * 8 / max(elapsed, 1e-6) / 1e9, 3)
+    result = {"streams": streams, "gbps": gbps, "bytes": total,
+              "errors": len(errors)}
+    if errors:
+        result["last_error"] = errors[-1]
+    return result
+
+
+def stream_counts(maximum):
+    """
+    1, 2, 4, ... up to and including maximum
+    """
+    counts = []
+    n = 1
+    while n < maximum:
+        counts.append(n)
+        n *= 2
+    counts.append(maximum)
+    return counts
+
+
+def scaling(host, port=NETBENCH_PORT, max_streams=STREAMS,
+            duration=DURATION):
+    results = []
+    for streams in stream_counts(max_streams):
+        vprint("Running {} stream throughput test against {}:{}".format(
+            streams, host, port))
+        results.append(throughput(host, port, streams, duration))
+    return results
+
+
+def parse_peer(peer, default=NETBENCH_PORT):
+    """
+    Splits "host[:port]" into (host, port)
+    """
+    host, _, port = peer.rpartition(":") if ":" in peer else (peer, "", "")
+    return host, int(port) if port else default
+
+
+def get_vips(config):
+    return [(name, config[key]) for name, key in (("VIP1", "vip1_ip"),
+                                                  ("VIP2", "vip2_ip"))
+            if config.get(key)]
+
+
+@check("TCP Probe", "netbench", "connection", "local")
+def check_tcp_probe(config):
+    vprint("Probing iSCSI portal TCP connect latency")
+    count = int(config.get("netbench_connects", CONNECTS))
+    max_ms = float(config.get("netbench_max_connect_ms", MAX_CONNECT_MS))
+    state = {"connect": {}}
+    for name, vip in get_vips(config):
+        result = connect_latency(vip, ISCSI_PORT, count)
+        state["connect"][name] = result
+        if result["errors"]:
+            ff("{}/{} TCP connections to {} {}:{} failed: {}".format(
+                result["errors"], count, name, vip, ISCSI_PORT,
+                result["last_error"]), "C387AC81", fix=NET_FIX)
+        p99 = result.get("p99_ms")
+        if p99 is not None and p99 > max_ms:
+            wf("{} {}:{} connect p99 is {}ms, threshold {}ms".format(
+                name, vip, ISCSI_PORT, p99, max_ms), "E72F4010")
+    peer = config.get("netbench_peer")
+    if peer:
+        host, port = parse_peer(peer)
+        results = scaling(host, port,
+                          int(config.get("netbench_streams", STREAMS)),
+                          float(config.get("netbench_duration", DURATION)))
+        state["throughput"] = {"peer": "{}:{}".format(host, port),
+                               "results": results}
+        failed = [r for r in results if r["errors"]]
+        if failed:
+            ff("Throughput test against netbench peer {}:{} failed: "
+               "{}".format(host, port, failed[-1]["last_error"]),
+               "031E20C7", fix="Start 'ddct netbench --server' on the peer")
+    hs("tcp_probe", state)
+
+
+def load_checks():
+    return [check_tcp_probe]
+
+
+def print_results(results, ojson=False):
+    if ojson:
+        print(json.dumps(results, indent=4, sort_keys=True))
+        return
+    from tabulate import tabulate
+    for name, result in sorted(results.get("connect", {}).items()):
+        print("Connect latency to {}".format(name))
+        print(tabulate(sorted(result.items()), tablefmt="grid"))
+    if "throughput" in results:
+        print("Throughput to {}".format(results["throughput"]["peer"]))
+        print(tabulate([[r["streams"], r["gbps"], r["bytes"], r["errors"]]
+                        for r in results["throughput"]["results"]],
+                       headers=["Streams", "Gbit/s", "Bytes", "Errors"],
+                       tablefmt="grid"))
+
+
+def netbench(args):
+    """
+    'ddct netbench' entry point.  Options left unset on the command line
+    use the module defaults
+    """
+    for name, default in (("port", NETBENCH_PORT), ("connects", CONNECTS),
+                          ("streams", STREAMS), ("duration", DURATION)):
+        if getattr(args, name) is None:
+            setattr(args, name, default)
+    if args.server:
+        return serve(args.bind, args.port)
+    results = {"connect": {}}
+    if args.vips:
+        from common import get_config
+        config = get_config()
+        for name, vip in get_vips(config):
+            results["connect"][name] = connect_latency(
+                vip, ISCSI_PORT, args.connects)
+    for target in args.connect:
+        host, port = parse_peer(target, ISCSI_PORT)
+        results["connect"][target] = connect_latency(
+            host, port, args.connects)
+    server = None
+    peer = args.peer
+    if args.loopback:
+        server = start_loopback()
+        peer = "{}:{}".format(*server.server_address)
+    try:
+        if peer:
+            host, port = parse_peer(peer)
+            results["throughput"] = {
+                "peer": "{}:{}".format(host, port),
+                "results": scaling(host, port, args.streams, args.duration)}
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+    print_results(results, args.json)
@@ -0,0 +1,263 @@
+from __future__ import (print_function, unicode_literals, division,
+                        absolute_import)
+
+import collections
+import math
+import threading
+import time
+
+from common import vprint, check, ff, wf, hs, read_sysfs
+from mtu import get_storage_interfaces, get_physical_interfaces
+
+PROC_SNMP = "/proc/net/snmp"
+PROC_NETSTAT = "/proc/net/netstat"
+SAMPLE_INTERVAL = 1.0
+# Samples kept by the background sampler in daemon mode when there is no
+# daemon interval to cover
+WINDOW = 120
+
+# (section, counter) pairs read from /proc/net/snmp and /proc/net/netstat
+TCP_COUNTERS = (("Tcp", "OutSegs"),
+                ("Tcp", "RetransSegs"),
+                ("Tcp", "InErrs"),
+                ("TcpExt", "TCPTimeouts"),
+                ("TcpExt", "TCPLostRetransmit"))
+# /sys/class/net/<if>/statistics/<counter>
+NIC_COUNTERS = ("rx_packets", "tx_packets", "rx_errors", "rx_dropped",
+                "rx_missed_errors", "rx_crc_errors", "rx_fifo_errors",
+                "tx_errors", "tx_dropped")
+
+# Rates (per second) above these trigger a warning.  retrans_pct is the
+# share of outgoing segments that were retransmits.  Overridden per key by
+# the "netmon_thresholds" config entry
+THRESHOLDS = {"retrans_pct": 1.0,
+              "TCPTimeouts": 1.0,
+              "rx_dropped": 10.0,
+              "rx_missed_errors": 1.0,
+              "rx_fifo_errors": 1.0,
+              "rx_errors": 1.0,
+              "tx_errors": 1.0,
+              "rx_crc_errors": 0.0}
+# retrans_pct is meaningless on an idle host, ignore intervals with fewer
+# outgoing segments per second than this
+MIN_SEGS = 100
+
+# counter: (code, failure?)
+CODES = {"retrans_pct": ("AA37C12A", False),
+         "TCPTimeouts": ("56C51694", False),
+         "rx_dropped": ("3D1B5037", False),
+         "rx_missed_errors": ("3F06CFEE", False),
+         "rx_fifo_errors": ("3F06CFEE", False),
+         "rx_errors": ("A9B0467B", False),
+         "tx_errors": ("A9B0467B", False),
+         "rx_crc_errors": ("9375E5DB", True)}
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def parse_snmp(data):
+    """
+    Parses /proc/net/snmp style output, where every section is a header
+    line followed by a value line, into {section: {counter: value}}
+    """
+    result = {}
+    lines = data.splitlines()
+    for header, values in zip(lines[::2], lines[1::2]):
+        section, _, keys = header.partition(":")
+        vsection, _, vals = values.partition(":")
+        if section != vsection:
+            continue
+        result[section] = {k: int(v) for k, v in zip(keys.split(),
+                                                     vals.split())
+                           if v.lstrip("-").isdigit()}
+    return result
+
+
+def read_counters(nics):
+    """
+    Returns a flat tuple of every TCP counter followed by NIC_COUNTERS for
+    each nic, so samples stay compact in the ring buffer
+    """
+    snmp = parse_snmp(read_sysfs(PROC_SNMP, ""))
+    snmp.update(parse_snmp(read_sysfs(PROC_NETSTAT, "")))
+    values = [snmp.get(section, {}).get(name, 0)
+              for section, name in TCP_COUNTERS]
+    for nic in nics:
+        for name in NIC_COUNTERS:
+            value = read_sysfs("/sys/class/net/{}/statistics/{}".format(
+                nic, name), "0")
+            values.append(int(value) if value.isdigit() else 0)
+    return tuple(values)
+
+
+def compute_rates(nics, before, after):
+    """
+    Turns two (timestamp, counters) samples into per-second rates:
+    {"tcp": {counter: rate, "retrans_pct": pct}, "nics": {nic: {...}}}
+    """
+    (t0, old), (t1, new) = before, after
+    elapsed = max(t1 - t0, 1e-6)
+    # Counters can wrap or reset (driver reload), treat that as zero
+    deltas = [max(n - o, 0) for o, n in zip(old, new)]
+    tcp = {name: round(d / elapsed, 2)
+           for (_, name), d in zip(TCP_COUNTERS, deltas)}
+    out = tcp["OutSegs"]
+    tcp["retrans_pct"] = (round(100.0 * tcp["RetransSegs"] / out, 3)
+                          if out >= MIN_SEGS else 0.0)
+    result = {"tcp": tcp, "nics": {}}
+    offset = len(TCP_COUNTERS)
+    for i, nic in enumerate(nics):
+        start = offset + i * len(NIC_COUNTERS)
+        result["nics"][nic] = {
+            name: round(d / elapsed, 2)
+            for name, d in zip(NIC_COUNTERS,
+                               deltas[start:start + len(NIC_COUNTERS)])}
+    return result
+
+
+class Sampler(object):
+    """
+    Samples the counters every interval into a fixed size ring buffer so
+    short loss bursts between daemon runs still show up as peak rates
+    """
+
+    def __init__(self, nics, interval=SAMPLE_INTERVAL, window=WINDOW):
+        self.nics = list(nics)
+        self.interval = interval
+        self.samples = collections.deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        entry = (time.time(), read_counters(self.nics))
+        with self.lock:
+            self.samples.append(entry)
+
+    def start(self):
+        self.sample()
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _loop(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def rates(self):
+        """
+        Returns the rates for every interval currently in the window
+        """
+        with self.lock:
+            samples = list(self.samples)
+        return [compute_rates(self.nics, a, b)
+                for a, b in zip(samples, samples[1:])]
+
+
+def start_monitor(config, interval=None):
+    """
+    Starts the background sampler used by daemon mode.  Later runs of
+    check_network_errors report the peak rates seen across the window.
+    Unless netmon_window is set the window covers interval, the seconds
+    between daemon runs
+    """
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None:
+            nics = get_storage_nics(config)
+            if nics:
+                sample_interval = float(config.get("netmon_interval",
+                                                   SAMPLE_INTERVAL))
+                window = WINDOW
+                if interval:
+                    # One more sample than intervals, so the rates span it
+                    window = int(math.ceil(interval / sample_interval)) + 1
+                _sampler = Sampler(
+                    nics, sample_interval,
+                    int(config.get("netmon_window", window)))
+                _sampler.start()
+    return _sampler
+
+
+def stop_monitor():
+    global _sampler
+    with _sampler_lock:
+        if _sampler is not None:
+            _sampler.stop()
+            _sampler = None
+
+
+def get_storage_nics(config):
+    nics = []
+    for _, iface in sorted(get_storage_interfaces(config).items()):
+        for phys in get_physical_interfaces(iface):
+            if phys not in nics:
+                nics.append(phys)
+    return nics
+
+
+def peak(rates):
+    """
+    Collapses a list of interval rates into the worst value per counter
+    """
+    result = {"tcp": {}, "nics": {}}
+    for rate in rates:
+        for name, value in rate["tcp"].items():
+            result["tcp"][name] = max(result["tcp"].get(name, 0), value)
+        for nic, counters in rate["nics"].items():
+            current = result["nics"].setdefault(nic, {})
+            for name, value in counters.items():
+                current[name] = max(current.get(name, 0), value)
+    return result
+
+
+def _report(counter, value, limit, where):
+    code, fail = CODES[counter]
+    unit = "%" if counter == "retrans_pct" else "/s"
+    msg = "{} {} is {}{}, threshold {}{}".format(
+        where, counter, value, unit, limit, unit)
+    if fail:
+        ff(msg, code)
+    else:
+        wf(msg, code)
+
+
+@check("Network Errors", "basic", "network", "connection", "local")
+def check_network_errors(config):
+    vprint("Sampling TCP retransmits and storage NIC error counters")
+    thresholds = dict(THRESHOLDS)
+    thresholds.update(config.get("netmon_thresholds", {}))
+    if _sampler is not None:
+        rates = _sampler.rates()
+    else:
+        nics = get_storage_nics(config)
+        if not nics:
+            return wf("Couldn't find the interfaces serving VIP1/VIP2, NIC "
+                      "error rates not checked", "4F26C658")
+        interval = float(config.get("netmon_interval", SAMPLE_INTERVAL))
+        before = (time.time(), read_counters(nics))
+        time.sleep(interval)
+        rates = [compute_rates(nics, before,
+                               (time.time(), read_counters(nics)))]
+    if not rates:
+        return
+    worst = peak(rates)
+    for counter, value in sorted(worst["tcp"].items()):
+        limit = thresholds.get(counter)
+        if counter in CODES and value > limit:
+            _report(counter, value, limit, "TCP")
+    for nic, counters in sorted(worst["nics"].items()):
+        for counter, value in sorted(counters.items()):
+            limit = thresholds.get(counter)
+            if counter in CODES and value > limit:
+                _report(counter, value, limit, nic)
+    hs("network_error_rates", {"samples": len(rates) + 1,
+                               "peak_per_sec": worst})
+
+
+def load_checks():
+    return [check_network_errors]
@@ -0,0 +1,195 @@
+from __future__ import (print_function, unicode_literals, division,
+                        absolute_import)
+
+import os
+import re
+import subprocess
+
+from common import vprint, check, exe, ff, wf, hs, which, read_sysfs
+from mtu import get_storage_interfaces, get_physical_interfaces
+
+# ethtool query options, run in a single shell per interface
+ETHTOOL_OPTS = ("-g", "-l", "-k", "-a", "-c")
+SECTION = "=== ethtool {}"
+ADAPTIVE_RE = re.compile(r"Adaptive RX:\s*(\S+)\s+TX:\s*(\S+)")
+
+# Offloads that should be enabled on storage NICs: (feature, code)
+OFFLOADS = (("tcp-segmentation-offload", "CCB07C74"),
+            ("generic-receive-offload", "4CC65BE1"),
+            ("rx-checksumming", "81DC27AC"),
+            ("tx-checksumming", "81DC27AC"))
+# Datera profile for the rest: LRO on (the kernel turns it off itself when
+# the host forwards), pause frames on in both directions and adaptive RX
+# coalescing, or a fixed rx-usecs no higher than COALESCE_MAX_USECS
+LRO = ("large-receive-offload", "8D95E6B2")
+FLOW_CONTROL = ("rx", "tx")
+COALESCE_MAX_USECS = 50
+
+
+def ethtool(iface):
+    """
+    Runs every ethtool query for iface in one shell and returns
+    {option: output}.  Options the driver doesn't support are left empty
+    """
+    cmd = "; ".join("echo '{}'; ethtool {} {} 2>/dev/null".format(
+        SECTION.format(opt), opt, iface) for opt in ETHTOOL_OPTS)
+    data = exe(cmd + "; true")
+    result = {opt: "" for opt in ETHTOOL_OPTS}
+    current = None
+    for line in data.splitlines():
+        if line.startswith("=== ethtool "):
+            current = line[len("=== ethtool "):].strip()
+            continue
+        if current:
+            result[current] += line + "\n"
+    return result
+
+
+def parse_max_current(data):
+    """
+    Parses ethtool -g/-l output into ({max}, {current})
+    """
+    maximum, current = {}, {}
+    target = None
+    for line in data.splitlines():
+        if line.startswith("Pre-set maximums"):
+            target = maximum
+        elif line.startswith("Current hardware settings"):
+            target = current
+        elif target is not None and ":" in line:
+            key, value = line.split(":", 1)
+            value = value.strip()
+            target[key.strip().lower()] = (
+                int(value) if value.isdigit() else value)
+    return maximum, current
+
+
+def parse_features(data):
+    """
+    Parses 'key: value' ethtool output (-k, -a, -c).  '[fixed]' features
+    keep the suffix so they aren't reported as tunable
+    """
+    result = {}
+    for line in data.splitlines():
+        match = ADAPTIVE_RE.search(line)
+        if match:
+            result["adaptive-rx"], result["adaptive-tx"] = match.groups()
+            continue
+        if ":" not in line or line.endswith(":"):
+            continue
+        key, value = line.split(":", 1)
+        result[key.strip().lower()] = value.strip()
+    return result
+
+
+def inspect_nic(iface):
+    data = ethtool(iface)
+    ring_max, ring = parse_max_current(data["-g"])
+    chan_max, chan = parse_max_current(data["-l"])
+    return {"ring_max": ring_max,
+            "ring": ring,
+            "channels_max": chan_max,
+            "channels": chan,
+            "features": parse_features(data["-k"]),
+            "pause": parse_features(data["-a"]),
+            "coalesce": parse_features(data["-c"])}
+
+
+def nic_state(info):
+    ring, ring_max = info["ring"], info["ring_max"]
+    chan, chan_max = info["channels"], info["channels_max"]
+    features = info["features"]
+    return {
+        "rx_ring": "{}/{}".format(ring.get("rx"), ring_max.get("rx")),
+        "tx_ring": "{}/{}".format(ring.get("tx"), ring_max.get("tx")),
+        "combined_channels": "{}/{}".format(chan.get("combined"),
+                                            chan_max.get("combined")),
+        "tso": features.get("tcp-segmentation-offload"),
+        "gro": features.get("generic-receive-offload"),
+        "lro": features.get("large-receive-offload"),
+        "flow_control": "rx {} tx {}".format(info["pause"].get("rx"),
+                                             info["pause"].get("tx")),
+        "adaptive_rx": info["coalesce"].get("adaptive-rx"),
+        "rx_usecs": info["coalesce"].get("rx-usecs")}
+
+
+def compare_profile(nic, info, ncpus):
+    for key in ("rx", "tx"):
+        cur = info["ring"].get(key)
+        mx = info["ring_max"].get(key)
+        if isinstance(cur, int) and isinstance(mx, int) and cur < mx:
+            wf("{} {} ring size {} is below the hardware maximum {}".format(
+                nic, key.upper(), cur, mx), "52437E9E",
+               fix="ethtool -G {} {} {}".format(nic, key, mx))
+    cur = info["channels"].get("combined")
+    mx = info["channels_max"].get("combined")
+    if isinstance(cur, int) and isinstance(mx, int):
+        want = min(mx, ncpus)
+        if cur < want:
+            wf("{} has {} combined channels, {} are available".format(
+                nic, cur, want), "5476F774",
+               fix="ethtool -L {} combined {}".format(nic, want))
+    features = info["features"]
+    for feature, code in OFFLOADS:
+        value = features.get(feature, "")
+        if value.startswith("off") and "[fixed]" not in value:
+            wf("{} {} is disabled".format(nic, feature), code,
+               fix="ethtool -K {} {} on".format(nic, feature))
+    feature, code = LRO
+    value = features.get(feature, "")
+    if (value.startswith("off") and "[fixed]" not in value and
+            read_sysfs("/proc/sys/net/ipv4/ip_forward") != "1"):
+        wf("{} {} is disabled".format(nic, feature), code,
+           fix="ethtool -K {} lro on".format(nic))
+    pause = info["pause"]
+    off = [key for key in FLOW_CONTROL if pause.get(key) == "off"]
+    if off:
+        wf("{} flow control is off for {}".format(
+            nic, " and ".join(key.upper() for key in off)), "18CFCFEE",
+           fix="ethtool -A {} {}".format(
+               nic, " ".join("{} on".format(key) for key in off)))
+    coalesce = info["coalesce"]
+    adaptive = coalesce.get("adaptive-rx")
+    usecs = coalesce.get("rx-usecs", "")
+    if (adaptive != "on" and usecs.isdigit() and
+            int(usecs) > COALESCE_MAX_USECS):
+        if adaptive == "off":
+            wf("{} adaptive RX coalescing is off and rx-usecs is {} (at "
+               "most {})".format(nic, usecs, COALESCE_MAX_USECS),
+               "508CDEC4", fix="ethtool -C {} adaptive-rx on".format(nic))
+        else:
+            # The driver has no adaptive coalescing
+            wf("{} rx-usecs is {}, at most {} is recommended".format(
+                nic, usecs, COALESCE_MAX_USECS), "B0DFF6B5",
+               fix="ethtool -C {} rx-usecs {}".format(
+                   nic, COALESCE_MAX_USECS))
+
+
+@check("NIC Tuning", "basic", "nic", "connection", "local")
+def check_nic_tuning(config):
+    vprint("Checking storage NIC tuning")
+    if not which("ethtool"):
+        return ff("ethtool is not installed", "41A5C447")
+    ifaces = get_storage_interfaces(config, ("MGMT", "VIP1", "VIP2"))
+    if not ifaces:
+        return wf("Couldn't find the interfaces serving MGMT/VIP1/VIP2, NIC "
+                  "tuning not checked", "9D06D368")
+    nics = []
+    for name, iface in sorted(ifaces.items()):
+        for phys in get_physical_interfaces(iface):
+            if phys not in nics:
+                nics.append(phys)
+    ncpus = os.sysconf("SC_NPROCESSORS_ONLN")
+    state = {}
+    for nic in nics:
+        try:
+            info = inspect_nic(nic)
+        except subprocess.CalledProcessError:
+            continue
+        state[nic] = nic_state(info)
+        compare_profile(nic, info, ncpus)
+    hs("storage_nics", state)
+
+
+def load_checks():
+    return [check_nic_tuning]
@@ -0,0 +1,140 @@
+from __future__ import (print_function, unicode_literals, division,
+                        absolute_import)
+
+import os
+import subprocess
+import threading
+
+from common import vprint, exe, get_os, get_pkg_manager, run_fact
+from common import APT, YUM, UBUNTU
+
+# Logical package: {OS or package manager: [distro packages]}.  An entry for
+# the running OS takes precedence over the package manager entry.  Names
+# not listed here are installed as-is
+NAMES = {
+    "cpufreq": {UBUNTU: ["linux-tools-{kernel}", "linux-cloud-tools-{kernel}",
+                         "linux-tools-common", "cpufrequtils"],
+                APT: ["linux-cpupower", "cpufrequtils"],
+                YUM: ["kernel-tools"]},
+    "multipath": {APT: ["multipath-tools"],
+                  YUM: ["device-mapper-multipath"]},
+    "iscsi": {APT: ["open-iscsi"],
+              YUM: ["iscsi-initiator-utils"]},
+}
+INSTALL_CMDS = {
+    APT: "DEBIAN_FRONTEND=noninteractive apt-get install -y {}",
+    YUM: "yum install -y {}",
+}
+INVENTORY_CMDS = {
+    APT: "dpkg-query -W -f='${Status}|${Package}\\n'",
+    YUM: "rpm -qa --qf '%{NAME}\\n'",
+}
+
+_install_lock = threading.Lock()
+
+
+class PackageError(EnvironmentError):
+    pass
+
+
+def requires(*names):
+    """
+    Declares the logical packages a fix or installer needs so they can be
+    installed together with everything else selected for the run
+    """
+    def _decorator(func):
+        func._packages = names
+        return func
+    return _decorator
+
+
+def collect(funcs):
+    """
+    Returns the logical packages declared by funcs, without duplicates
+    """
+    names = []
+    for func in funcs:
+        for name in getattr(func, "_packages", ()):
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def resolve(names):
+    """
+    Maps logical package names to this host's distro package names
+    """
+    manager = get_pkg_manager()
+    kernel = os.uname()[2]
+    result = []
+    for name in names:
+        entry = NAMES.get(name)
+        if entry is None:
+            pkgs = [name]
+        else:
+            pkgs = None
+            if any(key not in INSTALL_CMDS for key in entry):
+                pkgs = entry.get(get_os())
+            pkgs = pkgs or entry.get(manager, [])
+        for pkg in pkgs:
+            pkg = pkg.format(kernel=kernel)
+            if pkg not in result:
+                result.append(pkg)
+    return result
+
+
+@run_fact
+def installed_packages():
+    """
+    Installed distro package names, queried once per run
+    """
+    manager = get_pkg_manager()
+    if manager not in INVENTORY_CMDS:
+        return set()
+    installed = set()
+    for line in exe(INVENTORY_CMDS[manager]).splitlines():
+        if manager == APT:
+            status, _, line = line.partition("|")
+            if not status.endswith(" installed"):
+                continue
+        installed.add(line.strip())
+    return installed
+
+
+def missing(names):
+    installed = installed_packages()
+    return [pkg for pkg in resolve(names) if pkg not in installed]
+
+
+def install_command(names):
+    """
+    The single package manager command that installs names, for fix hints
+    """
+    manager = get_pkg_manager()
+    if manager not in INSTALL_CMDS:
+        return None
+    return INSTALL_CMDS[manager].format(" ".join(resolve(names)))
+
+
+def install(names):
+    """
+    Installs every missing package for names in one package manager
+    transaction and returns the distro packages that were installed
+    """
+    with _install_lock:
+        manager = get_pkg_manager()
+        if manager not in INSTALL_CMDS:
+            raise PackageError("No supported package manager found (apt-get "
+                               "or yum)")
+        pkgs = missing(names)
+        if not pkgs:
+            vprint("Packages already installed: {}".format(
+                ", ".join(resolve(names))))
+            return []
+        try:
+            exe(INSTALL_CMDS[manager].format(" ".join(pkgs)))
+        except subprocess.CalledProcessError as e:
+            raise PackageError("Installing {} failed: {}".format(
+                ", ".join(pkgs), e))
+        installed_packages().update(pkgs)
+        return pkgs
@@ -7,7 +7,7 @@ import re
 import subprocess
 
 from common import vprint, exe, ff, wf, check, get_latest_driver_version
-from common import UUID4_STR_RE
+from common import UUID4_STR_RE, host_path
 
 ETC = "/etc/cinder/cinder.conf"
 PACKAGE_INSTALL = "/usr/lib/python2.7/dist-packages/cinder"
@@ -72,7 +72,7 @@ def check_cinder_volume_driver(config):
 @check("Cinder Image Cache Conf", "driver", "plugin", "config", "image",
        "local")
 def check_cinder_image_cache_conf(config):
-    with io.open(ETC, 'r') as f:
+    with io.open(host_path(ETC), 'r') as f:
         section = None
         for line in f:
             section = ETC_SECTION_RE.match(line)
@@ -96,10 +96,11 @@ def check_cinder_image_cache_conf(config):
                " type id in cinder.conf", "B845D5B1")
 
 
-@check("Cinder Volume Conf", "driver", "plugin", "config", "local")
+@check("Cinder Volume Conf", "driver", "plugin", "config", "local",
+       inputs=["file:" + ETC])
 def check_cinder_volume_conf(config):
     section = None
-    with io.open(ETC, 'r') as f:
+    with io.open(host_path(ETC), 'r') as f:
         for line in f:
             default = ETC_DEFAULT_RE.match(line)
             if default:
@@ -167,7 +168,7 @@ def check_cinder_volume_conf(config):
     if not vbn_check:
         ff("volume_backend_name is not set", "5FEC0454")
     if not debug_check:
-        wf("datera_debug is not enabled")
+        wf("datera_debug is not enabled", "9F644595")
     if not defaults_check:
         wf("datera_volume_type_defaults is not set, consider setting "
            "minimum QoS values here", "B5D29621")
@@ -7,6 +7,7 @@ import re
 import subprocess
 
 from common import vprint, exe, ff, wf, check, get_latest_driver_version
+from common import host_path
 
 ETC = "/etc/glance/glance-api.conf"
 PACKAGE_INSTALL = "/usr/lib/python2.7/dist-packages/glance_store"
@@ -106,11 +107,12 @@ def check_glance_driver(config):
            "'choices' parameter", "C521E039")
 
 
-@check("Glance Conf", "driver", "plugin", "config", "image", "local")
+@check("Glance Conf", "driver", "plugin", "config", "image", "local",
+       inputs=["file:" + ETC])
 def check_glance_conf(config):
     pass
     section = None
-    with io.open(ETC, 'r') as f:
+    with io.open(host_path(ETC), 'r') as f:
         for line in f:
             default = ETC_DEFAULT_RE.match(line)
             if default:
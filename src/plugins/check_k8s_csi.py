@@ -3,7 +3,7 @@ from __future__ import (print_function, unicode_literals, division,
 
 import re
 
-from common import exe_check, exe, ff, check
+from common import exe_check, exe, ff, check, which
 
 
 KCTL_MA_RE = re.compile("Major:\"(\d+)\",")
@@ -21,7 +21,7 @@ def calc_version(m1, m2):
 @check("K8S CSI", "driver", "plugin", "local", "csi")
 def check_kubernetes_driver_csi(config):
     # Is kubectl present?
-    if not exe_check("which kubectl"):
+    if not which("kubectl"):
         return ff("Could not detect kubectl installation", "572B0511")
     # Does kubectl have a supported version?
     kversion = exe("kubectl version").strip().split("\n")
@@ -38,7 +38,7 @@ def check_kubernetes_driver_csi(config):
             return ff("Kubectl has version {}, which is lower than supported "
                       "version {}".format(found, supported), "D2DA6596")
     # Are dependencies installed?
-    if not exe_check("which iscsiadm"):
+    if not which("iscsiadm"):
         ff("open-iscsi does not appear to be installed", "94BF0B77")
     # Is attach-detach disabled in kubelet?
     exstart = exe("systemctl show kubelet.service | grep ExecStart")
@@ -3,7 +3,7 @@ from __future__ import (print_function, unicode_literals, division,
 
 import re
 
-from common import exe_check, exe, ff, wf, check
+from common import exe, ff, wf, check, which
 
 
 KCTL_MA_RE = re.compile(r'Major:"(\d+)",')
@@ -21,7 +21,7 @@ def calc_version(m1, m2):
 @check("K8S FLEX", "driver", "plugin", "local", "flex")
 def check_kubernetes_driver_flex(config):
     # Is kubectl present?
-    if not exe_check("which kubectl"):
+    if not which("kubectl"):
         return ff("Could not detect kubectl installation", "572B0511")
     # Does kubectl have a supported version?
     kversion = exe("kubectl version").strip().split("\n")
@@ -38,9 +38,9 @@ def check_kubernetes_driver_flex(config):
             return ff("Kubectl has version {}, which is lower than supported "
                       "version {}".format(found, supported), "D2DA6596")
     # Are dependencies installed?
-    if not exe_check("which mkfs"):
+    if not which("mkfs"):
         ff("mkfs is not installed", "FE13A328")
-    if not exe_check("which iscsiadm"):
+    if not which("iscsiadm"):
         ff("sg3_utils does not appear to be installed", "94BF0B77")
     # Is attach-detach disabled in kubelet?
     exstart = exe("systemctl show kubelet.service | grep ExecStart")
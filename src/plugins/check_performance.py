@@ -1,25 +1,240 @@
 from __future__ import (print_function, unicode_literals, division,
                         absolute_import)
 
-# import io
-# import json
-# import os
+import io
+import json
+import os
+import subprocess
+import time
+import uuid
 
+from dfs_sdk import ApiError
 
-# from dfs_sdk import ApiNotFoundError
-
-from common import vprint, check, exe_check, ff
+from common import vprint, check, exe_check, exe, ff, wf, hs, which
 
 CONFIG_FILE = "/root/.datera-config-file"
+INITIATOR_FILE = "/etc/iscsi/initiatorname.iscsi"
+
+BLOCK_SIZES = ["4k", "64k", "1M"]
+PATTERNS = ["randread", "randwrite", "read", "write"]
+QUEUE_DEPTHS = [1, 16, 64]
+RUNTIME = 10
+VOLUME_SIZE = 10
+# Seconds to wait for the test volume to become available with access IPs
+ACCESS_WAIT = 30
+PERCENTILES = (("p50", "50.000000"),
+               ("p99", "99.000000"),
+               ("p99.9", "99.900000"))
+
+# Example "perf_thresholds" config entry.  Keys are either a full job name
+# or a "<bs>-<rw>" prefix that applies to every queue depth
+#   {"4k-randread": {"min_iops": 20000, "max_p99_us": 2000},
+#    "1M-read-qd16": {"min_bw_mibs": 1000}}
+
+
+class NoAccessError(EnvironmentError):
+    pass
+
+
+def job_name(bs, rw, qd):
+    return "{}-{}-qd{}".format(bs, rw, qd)
+
+
+def fio_cmd(device, bs, rw, qd, runtime):
+    cmd = ("fio --name={name} --filename={dev} --rw={rw} --bs={bs} "
+           "--iodepth={qd} --direct=1 --ioengine=libaio --runtime={rt} "
+           "--time_based --group_reporting --output-format=json".format(
+               name=job_name(bs, rw, qd), dev=device, rw=rw, bs=bs, qd=qd,
+               rt=runtime))
+    if "read" in rw:
+        cmd += " --readonly"
+    return cmd
+
+
+def parse_fio(data, rw):
+    """
+    Returns iops, bandwidth (MiB/s) and completion latency percentiles (us)
+    from fio's JSON output.  Handles both clat_ns (fio >= 3) and the older
+    clat (usec) layout
+    """
+    job = json.loads(data)["jobs"][0]
+    section = job["read"] if "read" in rw else job["write"]
+    result = {"iops": round(section["iops"], 1),
+              "bw_mibs": round(section["bw"] / 1024.0, 1)}
+    if "clat_ns" in section:
+        percentiles = section["clat_ns"].get("percentile", {})
+        scale = 1000.0
+    else:
+        percentiles = section.get("clat", {}).get("percentile", {})
+        scale = 1.0
+    for name, key in PERCENTILES:
+        if key in percentiles:
+            result[name + "_us"] = round(percentiles[key] / scale, 1)
+    return result
+
+
+def thresholds_for(thresholds, name):
+    found = {}
+    for key, limits in thresholds.items():
+        if name == key or name.startswith(key + "-"):
+            found.update(limits)
+    return found
+
+
+def check_thresholds(name, result, limits):
+    failures = []
+    for key, value in sorted(limits.items()):
+        if key.startswith("min_"):
+            metric = key[4:]
+            if metric in result and result[metric] < value:
+                failures.append("{} {} {} < {}".format(
+                    name, metric, result[metric], value))
+        elif key.startswith("max_"):
+            metric = key[4:]
+            if metric in result and result[metric] > value:
+                failures.append("{} {} {} > {}".format(
+                    name, metric, result[metric], value))
+    return failures
+
+
+def get_initiator():
+    with io.open(INITIATOR_FILE) as f:
+        for line in f:
+            if line.startswith("InitiatorName="):
+                return line.split("=", 1)[1].strip()
+
+
+class TestVolume(object):
+    """
+    Provisions a single replica Datera volume, logs into it over iSCSI and
+    cleans everything up on exit
+    """
+
+    def __init__(self, api, size):
+        self.api = api
+        self.size = size
+        self.name = "ddct-perf-{}".format(str(uuid.uuid4())[:8])
+        self.ai = None
+        self.iqn = None
+        self.ips = []
+        self.device = None
+
+    def __enter__(self):
+        try:
+            return self._attach()
+        except Exception:
+            self.__exit__()
+            raise
+
+    def _attach(self):
+        vprint("Provisioning test volume", self.name)
+        self.ai = self.api.app_instances.create(
+            name=self.name,
+            storage_instances=[{
+                "name": "storage-1",
+                "volumes": [{"name": "volume-1",
+                             "size": self.size,
+                             "replica_count": 1}]}])
+        si = self.ai.storage_instances.list()[0]
+        initiator = get_initiator()
+        if initiator:
+            init = self.api.initiators.create(
+                name=self.name, id=initiator, force=True)
+            si.acl_policy.initiators.add(init)
+        timeout = ACCESS_WAIT
+        while ((si["op_state"] != "available" or
+                not si["access"].get("ips")) and timeout > 0):
+            time.sleep(1)
+            timeout -= 1
+            si = si.reload()
+        self.iqn = si["access"]["iqn"]
+        self.ips = si["access"].get("ips") or []
+        if not self.ips:
+            raise NoAccessError("Test volume {} has no access IPs after "
+                                "{}s".format(self.name, ACCESS_WAIT))
+        portal = "{}:3260".format(self.ips[0])
+        exe("iscsiadm -m discovery -t st -p {}".format(portal))
+        exe("iscsiadm -m node -T {} -p {} --login".format(self.iqn, portal))
+        path = "/dev/disk/by-path/ip-{}-iscsi-{}-lun-0".format(
+            portal, self.iqn)
+        timeout = 30
+        while not os.path.exists(path) and timeout > 0:
+            time.sleep(1)
+            timeout -= 1
+        self.device = os.path.realpath(path)
+        return self
+
+    def __exit__(self, *args):
+        if self.iqn:
+            exe_check("iscsiadm -m node -T {} --logout".format(self.iqn))
+            exe_check("iscsiadm -m node -T {} -o delete".format(self.iqn))
+        if self.ai:
+            vprint("Deleting test volume", self.name)
+            self.ai.set(admin_state="offline", force=True)
+            self.ai.delete(force=True)
+
+
+def run_matrix(device, config, allow_write):
+    thresholds = config.get("perf_thresholds", {})
+    runtime = config.get("perf_runtime", RUNTIME)
+    results = {}
+    failures = []
+    for bs in config.get("perf_block_sizes", BLOCK_SIZES):
+        for rw in config.get("perf_patterns", PATTERNS):
+            if "write" in rw and not allow_write:
+                continue
+            for qd in config.get("perf_queue_depths", QUEUE_DEPTHS):
+                name = job_name(bs, rw, qd)
+                vprint("Running fio job", name)
+                try:
+                    result = parse_fio(
+                        exe(fio_cmd(device, bs, rw, qd, runtime)), rw)
+                except (subprocess.CalledProcessError, ValueError,
+                        KeyError, IndexError) as e:
+                    ff("fio job {} failed: {}".format(name, e), "9DC9C486")
+                    continue
+                results[name] = result
+                failures.extend(check_thresholds(
+                    name, result, thresholds_for(thresholds, name)))
+    return results, failures
 
 
-@check("Performance", "plugin", "perf", "fio", "4k")
-def check_single_volume_performance_fio_4k(config):
+@check("Performance", "plugin", "perf", "fio")
+def check_volume_performance_fio(config):
     vprint("Checking FIO performance, single volume")
-    if not exe_check("which fio"):
-        ff("FIO is not installed", "0BB2848F")
-    api = config['api']
+    if not which("fio"):
+        return ff("FIO is not installed", "0BB2848F")
+    device = config.get("perf_device")
+    if device:
+        # Writes to a device we didn't provision are destructive, so they
+        # need to be explicitly allowed
+        if not os.path.exists(device):
+            return ff("perf_device {} does not exist".format(device),
+                      "DE4AB6DD")
+        results, failures = run_matrix(
+            device, config, config.get("perf_allow_write", False))
+        if not config.get("perf_allow_write", False):
+            wf("Write jobs skipped for perf_device {}, set "
+               "perf_allow_write to include them".format(device), "66CDAD99")
+    else:
+        try:
+            with TestVolume(config["api"],
+                            config.get("perf_volume_size",
+                                       VOLUME_SIZE)) as vol:
+                if not os.path.exists(vol.device):
+                    return ff("Test volume {} did not attach".format(
+                        vol.name), "E7CDECDA")
+                results, failures = run_matrix(vol.device, config, True)
+        except NoAccessError as e:
+            return ff(str(e), "05207BED")
+        except (subprocess.CalledProcessError, EnvironmentError,
+                ApiError) as e:
+            return ff("Could not provision test volume: {}".format(e),
+                      "9B57A98B")
+    hs("fio", results)
+    for failure in failures:
+        ff("Performance below threshold: {}".format(failure), "AAC26813")
 
 
 def load_checks():
-    return [check_single_volume_performance_fio_4k]
+    return [check_volume_performance_fio]
@@ -6,14 +6,20 @@ import os
 import shutil
 import uuid
 
-from common import exe_check, exe, vprint
-from plugins.check_cinder_volume import ETC, detect_cinder_install
+from common import exe_check, exe, vprint, which, get_latest_driver_version
+from common import TMP_DIR, TAG_RE
+from artifacts import fetch_repo, extract, versions
+from plugins.check_cinder_volume import ETC, TAGS, detect_cinder_install
 
+# Only needed for installing from an existing checkout (cinder_driver_repo),
+# releases come from the artifact cache
 REQUIREMENTS = ('git', 'curl')
 DEVSTACK_INSTALL = "/opt/stack/cinder/cinder"
-GITHUB = "http://github.com/Datera/cinder-driver"
+GITHUB = "https://github.com/Datera/cinder-driver"
 HOME = os.path.expanduser("~")
 REPO = "{}/cinder-driver".format(HOME)
+ARTIFACT = "cinder-driver"
+BUILD_DIR = os.path.join(TMP_DIR, "build")
 ETC_TEMPLATE = """
 [datera]
 volume_driver = cinder.volume.drivers.datera.datera_iscsi.DateraDriver
@@ -26,26 +32,36 @@ datera_debug = True
 """
 
 
+def requirements(config):
+    """
+    Packages installers.run_installers installs before install() runs
+    """
+    if config.get("cinder_driver_repo"):
+        return REQUIREMENTS
+    return ()
+
+
 def check_requirements():
     vprint("Checking Requirements")
     for binary in REQUIREMENTS:
-        if not exe_check("which {}".format(binary), err=False):
-            return "missing" + binary
+        if not which(binary):
+            return "missing " + binary
 
 
 def clone_driver(cinder_driver, d_version):
-    # Get repository and checkout version
-    if not cinder_driver:
-        repo = REPO
-        if not os.path.isdir("{}/cinder-driver".format(HOME)):
-            exe("cd {} && git clone {}".format(HOME, GITHUB))
-    else:
-        repo = cinder_driver
-    version = d_version
-    exe("cd {} && git fetch --all".format(HOME))
-    exe("cd {} && git checkout {}".format(repo, version))
-    loc = detect_cinder_install()
-    return repo, loc
+    """
+    Checks out d_version in cinder_driver (or a clone in ~/cinder-driver).
+    An existing clone is reused and only fetched when it doesn't already
+    have d_version
+    """
+    repo = cinder_driver or REPO
+    if not os.path.isdir(repo):
+        exe("cd {} && git clone {}".format(HOME, GITHUB))
+    if not exe_check("cd {} && git rev-parse --verify -q {}^{{commit}}".format(
+            repo, d_version), err=False):
+        exe("cd {} && git fetch --all --tags".format(repo))
+    exe("cd {} && git checkout {}".format(repo, d_version))
+    return repo
 
 
 def detect_service_restart_cmd(service, display=False):
@@ -79,57 +95,110 @@ def detect_service_restart_cmd(service, display=False):
     raise EnvironmentError("Service: {} not detected".format(service))
 
 
-def install_volume_driver(cinder_driver, ip, username, password, d_version):
-    """Installs Cinder volume driver"""
-    # Copy files to install location
-    repo, loc = clone_driver(cinder_driver, d_version)
-    dloc = os.path.join(loc, "volume/drivers")
-    exe("cp -r {}/src/datera/ {}".format(repo, dloc))
-
-    # Modify etc file
-    data = None
+def update_etc(data, ip, username, password):
+    """
+    Returns cinder.conf lines with the Datera backend enabled under
+    [DEFAULT] and a fresh [datera] section.  Running it again on its own
+    output doesn't change anything
+    """
+    lines = []
+    section = None
+    for line in data:
+        line = line.strip()
+        if line.startswith("["):
+            section = line.lower()
+        if section == "[datera]":
+            continue
+        if section == "[default]" and any(line.startswith(elem) for elem in
+                                          ("enabled_backends", "verbose",
+                                           "debug")):
+            continue
+        lines.append(line)
+        if line == "[DEFAULT]":
+            lines.extend(("debug = True", "verbose = True",
+                          "enabled_backends = datera"))
+    while lines and not lines[-1]:
+        lines.pop()
+    lines.extend(ETC_TEMPLATE.format(
+        ip=ip, login=username, password=password).splitlines())
+    return lines
+
+
+def driver_version(config):
+    """
+    The configured driver version, else the latest tag on GitHub, else (for
+    hosts without network access) the newest cached version
+    """
+    if config.get("cinder_driver_version"):
+        return config["cinder_driver_version"]
+    try:
+        return get_latest_driver_version(TAGS)
+    except Exception as e:
+        cached = versions(ARTIFACT)
+        if not cached:
+            raise EnvironmentError(
+                "Couldn't look up the latest driver version ({}) and none "
+                "is cached, set cinder_driver_version".format(e))
+        return cached[-1]
+
+
+def fetch(config, state):
+    version = driver_version(config)
+    state["version"] = version
+    if config.get("cinder_driver_repo"):
+        reqs = check_requirements()
+        if reqs:
+            raise EnvironmentError(
+                "Cannot install cinder volume driver: " + reqs)
+        state["repo"] = clone_driver(config["cinder_driver_repo"], version)
+        return
+    # Branches are downloaded again, release tags come from the cache
+    archive = fetch_repo(ARTIFACT, version, GITHUB,
+                         refresh=not TAG_RE.search(version))
+    state["repo"] = extract(archive, os.path.join(
+        BUILD_DIR, "{}-{}".format(ARTIFACT, version)))
+
+
+def verify(config, state):
+    dfile = os.path.join(state["repo"], "src/datera/datera_iscsi.py")
+    if not os.path.exists(dfile):
+        raise EnvironmentError("{} is missing from the checkout".format(
+            dfile))
+    state["loc"] = detect_cinder_install()
+
+
+def copy(config, state):
+    dloc = os.path.join(state["loc"], "volume/drivers")
+    exe("cp -r {}/src/datera/ {}".format(state["repo"], dloc))
+
+
+def configure(config, state):
     with io.open(ETC, 'r') as f:
         data = f.readlines()
-    # Place lines under [DEFAULT]
-    insert = 0
-    for index, line in enumerate(data):
-        if any((elem in line for elem in
-                ("enabled_backends", "verbose", "debug"))):
-            del data[index]
-        elif "DEFAULT" in line:
-            insert = index
-    data.insert(insert + 1, "enabled_backends = datera")
-    data.insert(insert + 1, "verbose = True")
-    data.insert(insert + 1, "debug = True")
-
-    # Write [datera] section
-    tdata = ETC_TEMPLATE.format(
-        ip=ip,
-        login=username,
-        password=password)
-    data.extend(tdata.splitlines())
-
+    lines = update_etc(data, config["mgmt_ip"], config["username"],
+                       config["password"])
     shutil.copyfile(ETC, ETC + ".bak.{}".format(str(uuid.uuid4())[:4]))
     with io.open(ETC, 'w') as f:
-        for line in data:
-            line = line.strip()
-            f.write(line)
-            f.write("\n")
+        f.write("\n".join(lines) + "\n")
+
 
-    # Restart cinder-volume service
-    restart = detect_service_restart_cmd("cinder-volume")
+def restart(config, state):
+    cmd = detect_service_restart_cmd("cinder-volume")
     vprint("Restarting the cinder-volume service")
-    if loc == DEVSTACK_INSTALL:
+    if state["loc"] == DEVSTACK_INSTALL:
         vprint("Detected devstack")
     else:
         vprint("Detected non-devstack")
-    exe(restart)
+    exe(cmd)
+
+
+def load_steps():
+    return [("fetch", fetch), ("verify", verify), ("copy", copy),
+            ("configure", configure), ("restart", restart)]
 
 
 def install(config):
-    err_prefix = "Cannot install cinder volume driver: "
-    reqs = check_requirements()
-    if reqs:
-        return err_prefix + reqs
-    exe("git clone {}".format(GITHUB))
-    exe("cd {} && cp src")
+    """Installs Cinder volume driver"""
+    state = {}
+    for _, step in load_steps():
+        step(config, state)
@@ -1,34 +1,62 @@
 from __future__ import (print_function, unicode_literals, division,
                         absolute_import)
 
-import sys
+import io
+import os
+import shutil
+import stat
 
-from common import exe_check, verbose, vprint
+from common import exe, verbose, vprint, TMP_DIR, TAG_RE
+from artifacts import fetch_url
 
 INSTALL_SCRIPT = ("https://raw.githubusercontent.com/Datera/datera-csi/"
                   "master/assets/setup_iscsi.sh")
 SCRIPT_NAME = INSTALL_SCRIPT.split('/')[-1]
+# The script is fetched from master, set k8s_csi_script_version to pin a
+# datera-csi tag instead.  Branches can change under the same name, so they
+# are downloaded again on every run unless k8s_csi_script_sha256 pins them
+SCRIPT_VERSION = "master"
 
 
-def get_install_script():
+def fetch(config, state):
     vprint("Retrieving installation script")
-    if not exe_check("wget {}".format(INSTALL_SCRIPT)):
-        print("Failed to get iscsi-recv installation script {}".format(
-            INSTALL_SCRIPT))
-        sys.exit(1)
-    if not exe_check("chmod +x {}".format(SCRIPT_NAME)):
-        print("Failed to set iscsi-recv install script to executable: {}"
-              "".format(SCRIPT_NAME))
+    version = config.get("k8s_csi_script_version", SCRIPT_VERSION)
+    sha256 = config.get("k8s_csi_script_sha256")
+    cached = fetch_url(SCRIPT_NAME, version, INSTALL_SCRIPT.replace(
+        "/master/", "/{}/".format(version)), sha256=sha256,
+        refresh=not (sha256 or TAG_RE.search(version)))
+    # Run a copy so the cached object is never modified
+    if not os.path.isdir(TMP_DIR):
+        os.makedirs(TMP_DIR)
+    path = os.path.join(TMP_DIR, SCRIPT_NAME)
+    shutil.copyfile(cached, path)
+    state["script"] = path
 
 
-def run_install_script():
+def verify(config, state):
+    with io.open(state["script"], 'rb') as f:
+        if f.read(2) != b"#!":
+            raise EnvironmentError("{} is not a shell script".format(
+                state["script"]))
+
+
+def configure(config, state):
+    mode = os.stat(state["script"]).st_mode
+    os.chmod(state["script"], mode | stat.S_IXUSR)
+
+
+def run(config, state):
     with verbose():
-        if not exe_check("./{}".format(SCRIPT_NAME)):
-            print("Failed to run iscsi-recv install script successfully: {}"
-                  "".format(SCRIPT_NAME))
+        vprint(exe(state["script"]))
+
+
+def load_steps():
+    return [("fetch", fetch), ("verify", verify), ("configure", configure),
+            ("run", run)]
 
 
 def install(config):
     print("Running K8s CSI ISCSI installer")
-    get_install_script()
-    run_install_script()
+    state = {}
+    for _, step in load_steps():
+        step(config, state)
@@ -0,0 +1,134 @@
+from __future__ import (print_function, unicode_literals, division,
+                        absolute_import)
+
+import os
+import re
+import sys
+import textwrap
+
+# Grid tables in the same layout as tabulate's "grid" format, written a row
+# at a time.  Report.generate() used to build every row, re-wrap every
+# reason and hand the lot to tabulate, which got slow and far too wide with
+# thousands of results
+
+ANSI_RE = re.compile(r"\x1b\[[\d;]*m")
+# Used when stdout isn't a terminal (output redirected to a file)
+DEFAULT_WIDTH = 120
+# Wrapped columns never get narrower than this, even on tiny terminals
+MIN_WRAP = 20
+ELLIPSIS = "..."
+
+
+def terminal_width(default=DEFAULT_WIDTH):
+    """
+    COLUMNS if set, else the width of the terminal on stdout, else default
+    """
+    columns = os.environ.get("COLUMNS", "")
+    if columns.isdigit():
+        return int(columns)
+    try:
+        return os.get_terminal_size(sys.stdout.fileno()).columns
+    except (AttributeError, ValueError, OSError):
+        # Python 2, or stdout is not a terminal
+        return default
+
+
+def visible_len(s):
+    return len(ANSI_RE.sub("", s)) if "\x1b" in s else len(s)
+
+
+def truncate(s, width):
+    if width is None or visible_len(s) <= width:
+        return s
+    return ANSI_RE.sub("", s)[:max(width - len(ELLIPSIS), 0)] + ELLIPSIS
+
+
+class Grid(object):
+    """
+    Column widths grow as rows are added, so add_row() only looks at the
+    new cells.  write() then streams the table to a file object without
+    building it in memory.
+
+    Columns in wrap share whatever max_width leaves after the other columns
+    and lines longer than that are wrapped.  Compact grids have no rules
+    between rows and put each cell on a single (truncated) line
+    """
+
+    def __init__(self, headers, wrap=(), max_width=None, compact=False):
+        self.headers = list(headers)
+        self.widths = [visible_len(h) for h in self.headers]
+        self.wrap = wrap
+        self.max_width = max_width
+        self.compact = compact
+        self.rows = []
+
+    def add_row(self, cells):
+        """
+        cells are strings or lists of lines
+        """
+        row = []
+        for index, cell in enumerate(cells):
+            if not isinstance(cell, (list, tuple)):
+                cell = [cell]
+            lines = [line for item in cell
+                     for line in "{}".format(item).split("\n")]
+            if self.compact and len(lines) > 1:
+                lines = ["; ".join(line.strip() for line in lines
+                                   if line.strip())]
+            for line in lines:
+                length = visible_len(line)
+                if length > self.widths[index]:
+                    self.widths[index] = length
+            row.append(lines)
+        self.rows.append(row)
+
+    def fit(self):
+        """
+        Returns the column widths after shrinking the wrapped columns to
+        fit max_width
+        """
+        widths = list(self.widths)
+        if not (self.max_width and self.wrap):
+            return widths
+        # "| " + " | ".join(cells) + " |"
+        fixed = sum(w for i, w in enumerate(widths) if i not in self.wrap)
+        free = self.max_width - fixed - 3 * len(widths) - 1
+        share = max(free // len(self.wrap), MIN_WRAP)
+        for index in self.wrap:
+            widths[index] = min(widths[index], share)
+        return widths
+
+    def _cell(self, lines, width):
+        if self.compact:
+            return [truncate(line, width) for line in lines]
+        result = []
+        for line in lines:
+            if visible_len(line) <= width:
+                result.append(line)
+            else:
+                result.extend(textwrap.wrap(ANSI_RE.sub("", line), width)
+                              or [""])
+        return result
+
+    def _write_row(self, out, row, widths):
+        cells = [self._cell(lines, width)
+                 for lines, width in zip(row, widths)]
+        for index in range(max(len(c) for c in cells)):
+            parts = []
+            for cell, width in zip(cells, widths):
+                line = cell[index] if index < len(cell) else ""
+                parts.append(line + " " * (width - visible_len(line)))
+            out.write("| " + " | ".join(parts) + " |\n")
+
+    def write(self, out):
+        widths = self.fit()
+        rule = "+" + "+".join("-" * (w + 2) for w in widths) + "+\n"
+        out.write(rule)
+        self._write_row(out, [[h] for h in self.headers], widths)
+        out.write(rule.replace("-", "="))
+        for row in self.rows:
+            self._write_row(out, row, widths)
+            if not self.compact:
+                out.write(rule)
+        if self.compact and self.rows:
+            out.write(rule)
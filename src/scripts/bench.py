@@ -0,0 +1,690 @@
+#!/usr/bin/env python
+"""
+Benchmark and regression harness for ddct's hot paths.
+
+Builds a synthetic host under a temporary DDCT_HOST_ROOT (/proc, /sys and
+/etc), answers the commands the checks run with canned output instead of
+forking and replaces the dfs_sdk API with an in-memory fake, then times
+each scenario at several scales:
+
+    checks-luns   the local check suite with 10 to 10,000 Datera LUNs
+    checks-nics   the local check suite with 1 to 64 storage NICs
+    engine        run_checks() with 100+ synthetic checks
+    report        Report.generate() with up to 10,000 results
+    parse_mconf   parse_mconf() on multipath.conf with up to 1,000 devices
+    route_table   parse_route_table() with up to 10,000 routes
+    plugins       the cinder and glance conf checks on large config files
+
+Every scenario and scale runs in a fresh interpreter which reports the wall
+time (best of --repeat), the commands run (each would be a fork on a real
+host), the peak Python memory and the max RSS.
+
+Usage:
+    python src/scripts/bench.py [--quick] [--scenario NAME ...]
+        [--save BASELINE] [--baseline BASELINE]
+
+With --baseline the exit status is 1 if a measurement regressed: slower
+than --max-slowdown times the baseline, more peak memory than --max-memory
+times the baseline, or any additional command.  Scenarios that fail to run
+only count as regressions if the baseline measured them.  The reference
+baseline is src/scripts/bench_baseline.json.
+
+Requires Python 3.4+ for the memory measurements.
+"""
+from __future__ import (print_function, unicode_literals, division,
+                        absolute_import)
+
+import argparse
+import io
+import json
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# scenario: scales, --quick runs the first two
+SCENARIOS = {
+    "checks-luns": (10, 100, 1000, 10000),
+    "checks-nics": (1, 4, 16, 64),
+    "engine": (100, 250, 500),
+    "report": (100, 1000, 10000),
+    "parse_mconf": (10, 100, 1000),
+    "route_table": (100, 1000, 10000),
+    "plugins": (1, 100, 1000),
+}
+# Checks that need real traffic, real devices or the cluster
+SKIP_TAGS = ["netbench", "mpath_bench", "cluster"]
+# Wall time differences below this are noise, whatever the ratio
+NOISE_S = 0.05
+
+MGMT_IP = "10.0.0.5"
+VIP1_IP = "172.16.1.10"
+VIP2_IP = "172.16.2.10"
+MTU = 9000
+CPUS = 8
+IRQS_PER_NIC = 4
+DATERA_IQN = "iqn.2013-05.com.daterainc:tc:01:sn:{:016x}"
+
+BENCH_CONFIG = {
+    "mgmt_ip": MGMT_IP,
+    "vip1_ip": VIP1_IP,
+    "vip2_ip": VIP2_IP,
+    "username": "admin",
+    "password": "password",
+    # Sampling checks would otherwise sleep for seconds
+    "cpufreq_sample_window": 0,
+    "cpufreq_samples": 1,
+    "irq_sample_interval": 0,
+    "netmon_interval": 0,
+}
+
+
+# ---------------------------------------------------------------------------
+# Synthetic host
+# ---------------------------------------------------------------------------
+
+def _write(root, path, data):
+    full = root + path
+    parent = os.path.dirname(full)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    with io.open(full, 'w') as f:
+        f.write("{}\n".format(data))
+
+
+def _mkdir(root, path):
+    if not os.path.isdir(root + path):
+        os.makedirs(root + path)
+
+
+def disk_name(index):
+    """
+    0 -> sda, 25 -> sdz, 26 -> sdaa
+    """
+    name = ""
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        name = chr(ord("a") + rem) + name
+    return "sd" + name
+
+
+def nic_names(nics):
+    return ["eth{}".format(i) for i in range(nics)]
+
+
+def route_table(nics, routes=0):
+    """
+    'ip route show' output: the storage networks on bond0 and the mgmt
+    network on mgmt0, followed by 'routes' unrelated filler routes
+    """
+    lines = ["default via 10.0.0.1 dev mgmt0 proto static",
+             "10.0.0.0/24 dev mgmt0 proto kernel scope link src 10.0.0.2",
+             "172.16.1.0/24 dev bond0 proto kernel scope link src "
+             "172.16.1.2",
+             "172.16.2.0/24 dev bond0 proto kernel scope link src "
+             "172.16.2.2"]
+    names = nic_names(nics)
+    for i in range(routes):
+        lines.append("10.{}.{}.0/24 via 10.0.0.1 dev {} proto static".format(
+            100 + i // 256 % 150, i % 256, names[i % len(names)]))
+    return "\n".join(lines) + "\n"
+
+
+def multipath_conf(devices):
+    with io.open(os.path.join(SRC, os.pardir, "assets", "ubuntu.mconf"),
+                 'r') as f:
+        data = f.read()
+    entries = []
+    for i in range(devices):
+        entries.append("""    device {{
+        vendor "VENDOR{0}"
+        product "PRODUCT{0}"
+        path_grouping_policy group_by_prio
+        path_checker tur
+        prio alua
+        failback immediate
+        no_path_retry 12
+    }}""".format(i))
+    if entries:
+        data += "devices {{\n{}\n}}\n".format("\n".join(entries))
+    return data
+
+
+def openstack_conf(header, sections):
+    lines = ["[DEFAULT]", "debug = False",
+             "enabled_backends = datera", "default_store = datera"]
+    for i in range(sections):
+        lines.extend(["", "[backend{}]".format(i),
+                      "volume_driver = driver.Driver{}".format(i),
+                      "volume_backend_name = backend{}".format(i)])
+    lines.extend(["", header,
+                  "san_ip = {}".format(MGMT_IP),
+                  "san_login = admin",
+                  "san_password = password",
+                  "volume_driver = cinder.volume.drivers.datera."
+                  "datera_iscsi.DateraDriver",
+                  "datera_enable_image_cache = True",
+                  "datera_image_cache_volume_type_id = "
+                  "5bb0f4b4-1ee5-4a4b-91c1-2e1a4b8d3ad7",
+                  "stores = file,http,datera",
+                  "datera_san_ip = {}".format(MGMT_IP)])
+    return "\n".join(lines)
+
+
+def build_host(root, luns=10, nics=2, sections=0):
+    """
+    Writes the /proc, /sys and /etc files the local checks read.  Settings
+    are mostly correct with a few deliberate deviations so the report has
+    failures and warnings to render
+    """
+    from sysctl import parse_rules, proc_path
+    for key, value in parse_rules().items():
+        _write(root, proc_path(key), value)
+    _write(root, proc_path("net.ipv4.tcp_timestamps"), "1")
+    _write(root, "/proc/sys/net/ipv4/route/gc_interval", "5")
+    _write(root, "/proc/meminfo", "\n".join([
+        "MemTotal:       263842420 kB",
+        "MemFree:        201234560 kB",
+        "MemAvailable:   240123456 kB",
+        "HugePages_Total:       0",
+        "HugePages_Free:        0",
+        "Hugepagesize:       2048 kB"]))
+    _write(root, "/proc/net/snmp",
+           "Tcp: InSegs OutSegs RetransSegs InErrs\n"
+           "Tcp: 100000 100000 10 0")
+    _write(root, "/proc/net/netstat",
+           "TcpExt: TCPTimeouts TCPLostRetransmit\nTcpExt: 0 0")
+    _write(root, "/sys/kernel/mm/transparent_hugepage/enabled",
+           "always [madvise] never")
+    _write(root, "/sys/kernel/mm/transparent_hugepage/defrag",
+           "always defer [madvise] never")
+
+    # CPUs and NUMA nodes
+    half = CPUS // 2
+    for node in range(2):
+        base = "/sys/devices/system/node/node{}".format(node)
+        _write(root, base + "/cpulist", "{}-{}".format(
+            node * half, node * half + half - 1))
+        _write(root, base + "/meminfo", "\n".join(
+            "Node {} {}:  {} kB".format(node, key, value) for key, value in (
+                ("MemTotal", 131921210), ("MemFree", 100617280),
+                ("Inactive(file)", 1048576))))
+    for cpu in range(CPUS):
+        base = "/sys/devices/system/cpu/cpu{}".format(cpu)
+        _write(root, base + "/online", "1")
+        _write(root, base + "/topology/physical_package_id", cpu // half)
+        for attr, value in (("scaling_governor", "performance"),
+                            ("scaling_driver", "intel_pstate"),
+                            ("scaling_cur_freq", 2900000),
+                            ("cpuinfo_max_freq", 3000000),
+                            ("scaling_max_freq", 3000000)):
+            _write(root, "{}/cpufreq/{}".format(base, attr), value)
+        for state, (name, latency) in enumerate((("POLL", 0), ("C1", 2),
+                                                 ("C6", 133))):
+            sbase = "{}/cpuidle/state{}".format(base, state)
+            _write(root, sbase + "/name", name)
+            _write(root, sbase + "/latency", latency)
+            _write(root, sbase + "/disable", "0")
+
+    # Storage NICs bonded into bond0, mgmt0 is a plain NIC
+    from netmon import NIC_COUNTERS
+    interrupts = ["    " + " ".join("CPU{}".format(c) for c in range(CPUS))]
+    irq = 100
+    for index, nic in enumerate(["mgmt0"] + nic_names(nics)):
+        base = "/sys/class/net/{}".format(nic)
+        _write(root, base + "/device/numa_node", index % 2)
+        for counter in NIC_COUNTERS:
+            _write(root, "{}/statistics/{}".format(base, counter), 0)
+        for queue in range(IRQS_PER_NIC):
+            _write(root, "{}/device/msi_irqs/{}".format(base, irq), "msix")
+            _write(root, "/proc/irq/{}/smp_affinity_list".format(irq),
+                   (irq + queue) % CPUS)
+            interrupts.append("{:>4}: {} IR-PCI-MSI {}-TxRx-{}".format(
+                irq, " ".join("1000" for _ in range(CPUS)), nic, queue))
+            irq += 1
+        if nic != "mgmt0":
+            _mkdir(root, "/sys/class/net/bond0/lower_{}".format(nic))
+    _write(root, "/proc/interrupts", "\n".join(interrupts))
+    for counter in NIC_COUNTERS:
+        _write(root, "/sys/class/net/bond0/statistics/{}".format(counter), 0)
+
+    # One Datera LUN per iSCSI session, each on its own software iSCSI host
+    for i in range(luns):
+        dev = "/sys/block/{}".format(disk_name(i))
+        _write(root, dev + "/device/vendor", "DATERA")
+        _write(root, dev + "/device/model", "IBLOCK")
+        for attr, value in (("scheduler", "mq-deadline kyber [none]"),
+                            ("nr_requests", 256),
+                            ("read_ahead_kb", 128),
+                            ("max_sectors_kb", 512),
+                            ("rq_affinity", 1 if i % 10 == 0 else 2),
+                            ("nomerges", 0)):
+            _write(root, "{}/queue/{}".format(dev, attr), value)
+        # Like the kernel, the class entry is a symlink into /sys/devices
+        # and its device link is relative to the real directory
+        device = "/sys/devices/platform/host{0}/session{0}".format(i)
+        session = "{}/iscsi_session/session{}".format(device, i)
+        _write(root, session + "/targetname", DATERA_IQN.format(i))
+        _write(root, session + "/ifacename", "default")
+        _write(root, session + "/state", "LOGGED_IN")
+        _write(root, session + "/recovery_tmo", 120)
+        _write(root, "{0}/target{1}:0:0/{1}:0:0:0/queue_depth".format(
+            device, i), 32)
+        os.symlink("../../../session{}".format(i), root + session + "/device")
+        _mkdir(root, "/sys/class/iscsi_session")
+        os.symlink("../../devices/platform/host{0}/session{0}/iscsi_session/"
+                   "session{0}".format(i),
+                   root + "/sys/class/iscsi_session/session{}".format(i))
+        _write(root, "/sys/class/scsi_host/host{}/can_queue".format(i), 128)
+        _write(root, "/sys/class/iscsi_host/host{}/netdev".format(i),
+               "<NULL>")
+        conn = "/sys/class/iscsi_connection/connection{}:0".format(i)
+        for attr, value in (("persistent_address",
+                             VIP1_IP if i % 2 else VIP2_IP),
+                            ("persistent_port", 3260),
+                            ("max_recv_dlength", 262144),
+                            ("max_xmit_dlength", 262144),
+                            ("ping_tmo", 2),
+                            ("recv_tmo", 2)):
+            _write(root, "{}/{}".format(conn, attr), value)
+
+    # /etc
+    _write(root, "/etc/os-release", 'ID=ubuntu\nVERSION_ID="18.04"')
+    _write(root, "/etc/iscsi/iscsid.conf", "\n".join([
+        "node.startup = automatic",
+        "node.conn[0].timeo.noop_out_timeout = 2",
+        "node.conn[0].timeo.noop_out_interval = 2"]))
+    _write(root, "/etc/udev/rules.d/99-iscsi-luns.rules", "")
+    _write(root, "/sbin/fetch_device_serial_no.sh", "")
+    _write(root, "/etc/multipath.conf", multipath_conf(sections))
+    _write(root, "/etc/cinder/cinder.conf",
+           openstack_conf("[datera]", sections))
+    _write(root, "/etc/glance/glance-api.conf",
+           openstack_conf("[glance_store]", sections))
+
+
+class FakeShell(object):
+    """
+    Stands in for common.exe.  Answers the commands the checks run from the
+    synthetic host and counts them, anything else fails like a missing
+    binary would
+    """
+
+    ETHTOOL = {
+        "-g": "Pre-set maximums:\nRX:\t4096\nTX:\t4096\n"
+              "Current hardware settings:\nRX:\t512\nTX:\t4096\n",
+        "-l": "Pre-set maximums:\nCombined:\t16\n"
+              "Current hardware settings:\nCombined:\t8\n",
+        "-k": "tcp-segmentation-offload: on\ngeneric-receive-offload: on\n"
+              "large-receive-offload: off [fixed]\nrx-checksumming: on\n"
+              "tx-checksumming: on\n",
+        "-a": "Autonegotiate:\toff\nRX:\ton\nTX:\ton\n",
+        "-c": "Adaptive RX: on  TX: on\nrx-usecs: 50\n",
+    }
+
+    def __init__(self, root, routes):
+        self.root = root
+        self.routes = routes
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.handlers = [
+            (re.compile(r"^ip route show"), lambda m: self.routes),
+            (re.compile(r"^ip route get (\S+)"),
+             lambda m: "{} dev bond0 src 172.16.1.2 uid 0\n    cache\n"
+                       "".format(m.group(1))),
+            (re.compile(r"^ip ad show (\S+)"),
+             lambda m: "3: {}: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu {} "
+                       "qdisc noqueue state UP\n".format(m.group(1), MTU)),
+            (re.compile(r"^ip neigh show \| grep (\S+)"),
+             lambda m: "{} dev bond0 lladdr 0c:c4:7a:00:00:01 REACHABLE\n"
+                       "".format(m.group(1))),
+            (re.compile(r"^ping "),
+             lambda m: "2 packets transmitted, 2 received, 0% packet "
+                       "loss\n"),
+            (re.compile(r"^sysctl --all.*grep '(\S+) = (\S+)'"),
+             self._sysctl),
+            (re.compile(r"^cat (\S+)$"), self._cat),
+            (re.compile(r"^ps -ef \| grep (\S+)"),
+             lambda m: "root 1234 1 0 00:00 ? 00:00:00 /sbin/{}\n".format(
+                 m.group(1))),
+            (re.compile(r"^(?:systemctl status|service) (multipathd)"),
+             lambda m: "   Active: active (running)\n"),
+            (re.compile(r"^echo '=== ethtool"), self._ethtool),
+        ]
+
+    def __call__(self, cmd):
+        with self.lock:
+            self.calls += 1
+        for regex, handler in self.handlers:
+            match = regex.match(cmd)
+            if match:
+                return handler(match)
+        raise subprocess.CalledProcessError(127, cmd)
+
+    def _sysctl(self, match):
+        key, value = match.groups()
+        path = "{}/proc/sys/{}".format(self.root, key.replace(".", "/"))
+        with io.open(path, 'r') as f:
+            if f.read().strip() != value:
+                raise subprocess.CalledProcessError(1, match.group(0))
+        return "{} = {}\n".format(key, value)
+
+    def _cat(self, match):
+        with io.open(self.root + match.group(1), 'r') as f:
+            return f.read()
+
+    def _ethtool(self, match):
+        return "".join("=== ethtool {}\n{}".format(opt, out)
+                       for opt, out in sorted(self.ETHTOOL.items()))
+
+
+class FakeEndpoint(object):
+    """
+    Minimal dfs_sdk endpoint: get() returns canned data, attributes are
+    child endpoints
+    """
+
+    def __init__(self, data=None, **children):
+        self._data = data or {}
+        self.__dict__.update(children)
+
+    def get(self, *args, **kwargs):
+        return self._data
+
+
+def fake_api():
+    paths = [{"ip": VIP1_IP, "mtu": MTU}, {"ip": VIP2_IP, "mtu": MTU}]
+    network = FakeEndpoint(
+        {"access_vip": {"network_paths": paths}},
+        access_vip=FakeEndpoint({"network_paths": paths}),
+        mgmt_vip=FakeEndpoint({"network_paths": [{"ip": MGMT_IP,
+                                                  "mtu": 1500}]}))
+    return FakeEndpoint(system=FakeEndpoint(
+        {"callhome_enabled": False, "l3_enabled": False, "name": "bench"},
+        network=network))
+
+
+# ---------------------------------------------------------------------------
+# Scenarios, these run in the child process
+# ---------------------------------------------------------------------------
+
+def patch_modules(shell):
+    """
+    Points every loaded ddct module at the fake shell.  Modules import exe
+    and which by name, so common alone isn't enough
+    """
+    import common
+    real_exe, real_which = common.exe, common.which
+    for module in list(sys.modules.values()):
+        if getattr(module, "exe", None) is real_exe:
+            module.exe = shell
+        if getattr(module, "which", None) is real_which:
+            module.which = lambda binary: "/usr/bin/" + binary
+
+
+def _config():
+    config = dict(BENCH_CONFIG)
+    config["api"] = fake_api()
+    return config
+
+
+def setup_checks(root, luns, nics):
+    import checkers
+    build_host(root, luns=luns, nics=nics)
+    shell = FakeShell(root, route_table(nics))
+    patch_modules(shell)
+    config = _config()
+    return shell, lambda: checkers.run_checks(config, not_tags=SKIP_TAGS)
+
+
+def setup_engine(root, count):
+    import checkers
+    from common import check, ff, wf, hs, read_sysfs
+    build_host(root, luns=0, nics=1)
+    shell = FakeShell(root, route_table(1))
+    patch_modules(shell)
+
+    def _make(i):
+        @check("Bench {}".format(i), "bench", "local")
+        def _check(config):
+            value = read_sysfs("/proc/sys/vm/swappiness", "")
+            if i % 3 == 0:
+                ff("Synthetic failure {}".format(i), "BE{:06d}".format(i))
+            elif i % 3 == 1:
+                wf("Synthetic warning {}".format(i), "BE{:06d}".format(i),
+                   fix="sysctl vm.swappiness=10")
+            hs("bench_{}".format(i), {"swappiness": value})
+        return _check
+
+    checkers.check_list = [_make(i) for i in range(count)]
+    config = _config()
+    return shell, lambda: checkers.run_checks(config)
+
+
+def setup_report(root, count):
+    import common
+    report = common.Report()
+    report.hostname = "bench"
+    tags = ("basic", "local")
+    for i in range(count):
+        name = "Check {}".format(i)
+        if i % 3 == 0:
+            report.add_failure(name, "Synthetic failure {} with a reason "
+                               "long enough to be wrapped".format(i),
+                               "BF{:06d}".format(i), tags,
+                               fix="echo fix {}".format(i))
+        elif i % 3 == 1:
+            report.add_warning(name, "Synthetic warning {}".format(i),
+                               "BW{:06d}".format(i), tags)
+        else:
+            report.add_success(name, tags)
+    for i in range(count // 10):
+        report.add_host_state("state_{}".format(i), {
+            "sd{}".format(i): {"scheduler": "none", "nr_requests": 256},
+            "count": i})
+    return None, report.generate
+
+
+def setup_parse_mconf(root, count):
+    from common import parse_mconf
+    data = multipath_conf(count)
+    return None, lambda: parse_mconf(data)
+
+
+def setup_route_table(root, count):
+    from common import parse_route_table
+    shell = FakeShell(root, route_table(64, count))
+    patch_modules(shell)
+    return shell, parse_route_table
+
+
+def setup_plugins(root, sections):
+    import checkers
+    build_host(root, luns=0, nics=1, sections=sections)
+    plugins = ["cinder_volume", "glance"]
+    checkers.load_plugin_checks(plugins)
+    shell = FakeShell(root, route_table(1))
+    patch_modules(shell)
+    config = _config()
+    return shell, lambda: checkers.run_checks(config, plugins=plugins,
+                                              tags=["config"])
+
+
+SETUP = {
+    "checks-luns": lambda root, scale: setup_checks(root, scale, 2),
+    "checks-nics": lambda root, scale: setup_checks(root, 10, scale),
+    "engine": setup_engine,
+    "report": setup_report,
+    "parse_mconf": setup_parse_mconf,
+    "route_table": setup_route_table,
+    "plugins": setup_plugins,
+}
+
+
+def run_scenario(name, scale, repeat):
+    """
+    Returns {"wall", "forks", "peak_kib", "maxrss_kib"} for one scenario at
+    one scale
+    """
+    root = tempfile.mkdtemp(prefix="ddct-bench-")
+    # HOST_ROOT is read when common is imported
+    os.environ["DDCT_HOST_ROOT"] = root
+    sys.path.insert(0, SRC)
+    popens = [0]
+    real_popen = subprocess.Popen
+
+    class _CountingPopen(real_popen):
+        def __init__(self, *args, **kwargs):
+            popens[0] += 1
+            super(_CountingPopen, self).__init__(*args, **kwargs)
+
+    try:
+        import common
+        common.CHECK_CACHE = False
+        # Time the checks as a -k run, with their host state
+        common.HOST_STATE = True
+        common._facts.update(get_os=common.UBUNTU,
+                             get_pkg_manager=common.APT)
+        shell, func = SETUP[name](root, scale)
+        subprocess.Popen = _CountingPopen
+
+        def _once():
+            common.reset_checks()
+            start = time.time()
+            func()
+            return time.time() - start
+
+        walls = []
+        for i in range(repeat):
+            calls, spawned = shell.calls if shell else 0, popens[0]
+            walls.append(_once())
+            if not i:
+                forks = ((shell.calls if shell else 0) - calls +
+                         popens[0] - spawned)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = None
+        try:
+            import tracemalloc
+        except ImportError:
+            pass
+        else:
+            tracemalloc.start()
+            _once()
+            peak = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+            tracemalloc.stop()
+        return {"wall": round(min(walls), 4), "forks": forks,
+                "peak_kib": peak, "maxrss_kib": rss}
+    finally:
+        subprocess.Popen = real_popen
+        shutil.rmtree(root, ignore_errors=True)
+
+
+# ---------------------------------------------------------------------------
+# Driver
+# ---------------------------------------------------------------------------
+
+def measure(name, scale, repeat):
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                             "--child", name, str(scale),
+                             "--repeat", str(repeat)],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        lines = err.decode("utf-8", "replace").strip().splitlines()
+        return {"error": lines[-1] if lines else "exit code {}".format(
+            proc.returncode)}
+    return json.loads(out.decode("utf-8").strip().splitlines()[-1])
+
+
+def compare(result, base, args):
+    """
+    Returns the regressions of result against its baseline entry
+    """
+    if not base or "error" in base:
+        return []
+    if "error" in result:
+        return ["failed: {}".format(result["error"])]
+    problems = []
+    if (result["wall"] > base["wall"] * args.max_slowdown and
+            result["wall"] - base["wall"] > NOISE_S):
+        problems.append("wall {:.3f}s > {:.3f}s".format(
+            result["wall"], base["wall"]))
+    if result["forks"] > base["forks"]:
+        problems.append("forks {} > {}".format(result["forks"],
+                                               base["forks"]))
+    if (result.get("peak_kib") and base.get("peak_kib") and
+            result["peak_kib"] > base["peak_kib"] * args.max_memory):
+        problems.append("peak memory {:.0f}KiB > {:.0f}KiB".format(
+            result["peak_kib"], base["peak_kib"]))
+    return problems
+
+
+def main(args):
+    if args.child:
+        name, scale = args.child
+        print(json.dumps(run_scenario(name, int(scale), args.repeat)))
+        return 0
+    unknown = set(args.scenario or ()) - set(SCENARIOS)
+    if unknown:
+        print("Unknown scenarios: {}".format(", ".join(sorted(unknown))))
+        print("Available scenarios: {}".format(", ".join(sorted(SCENARIOS))))
+        return 1
+    baseline = {}
+    if args.baseline:
+        with io.open(args.baseline, 'r') as f:
+            baseline = json.loads(f.read())["results"]
+    results = {}
+    failed = False
+    for name, scales in sorted(SCENARIOS.items()):
+        if args.scenario and name not in args.scenario:
+            continue
+        for scale in scales[:2] if args.quick else scales:
+            key = "{}/{}".format(name, scale)
+            result = measure(name, scale, args.repeat)
+            results[key] = result
+            problems = compare(result, baseline.get(key), args)
+            if "error" in result:
+                print("{:<20} ERROR {}".format(key, result["error"]))
+            else:
+                print("{:<20} {:>9.3f}s {:>7} forks {:>10} KiB peak "
+                      "{:>8} KiB rss {}".format(
+                          key, result["wall"], result["forks"],
+                          result["peak_kib"], result["maxrss_kib"],
+                          "FAIL" if problems else
+                          "OK" if key in baseline else ""))
+            for problem in problems:
+                print("  Regression: {}".format(problem))
+            failed = failed or bool(problems)
+    if args.save:
+        with io.open(args.save, 'w') as f:
+            f.write(json.dumps({"python": sys.version.split()[0],
+                                "results": results}, indent=4,
+                               sort_keys=True))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", nargs="*",
+                        help="Only run these scenarios")
+    parser.add_argument("--quick", action="store_true",
+                        help="Only run the two smallest scales")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs per measurement, the fastest is kept")
+    parser.add_argument("--save", help="Write the results as a baseline")
+    parser.add_argument("--baseline", help="Compare against this baseline")
+    parser.add_argument("--max-slowdown", type=float, default=1.5,
+                        help="Allowed wall time ratio to the baseline")
+    parser.add_argument("--max-memory", type=float, default=1.25,
+                        help="Allowed peak memory ratio to the baseline")
+    parser.add_argument("--child", nargs=2, metavar=("SCENARIO", "SCALE"),
+                        help=argparse.SUPPRESS)
+    sys.exit(main(parser.parse_args()))
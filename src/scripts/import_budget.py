@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Import-time budget check for ddct's startup path.
+
+Runs 'python -X importtime' on the modules each scenario needs and fails if
+the cumulative import time goes over budget or if a heavy module that the
+scenario should never load (paramiko, dfs_sdk, curses, ...) shows up.
+
+The budget is a multiple of the time a bare 'python -c pass' spends on its
+own imports (site, encodings, ...), so it scales with the speed of the
+machine.  Every measurement is the fastest of --repeat runs.
+
+Usage:
+    python src/scripts/import_budget.py [--budget 12] [--repeat 5] [-v]
+
+Requires Python 3.7+ for -X importtime.
+"""
+from __future__ import (print_function, unicode_literals, division,
+                        absolute_import)
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY = ("dfs_sdk", "paramiko", "requests", "tabulate", "distro", "psutil",
+         "curses")
+
+# name: (modules imported, modules that must not be imported)
+SCENARIOS = {
+    # ddct version / check --list-plugins / check --print-tags
+    "startup": (["ddct"], HEAVY),
+    # Loading the local check suite must not pull in SSH or the TUI
+    "checks": (["ddct", "checkers"], ("paramiko", "curses", "tabulate")),
+}
+
+IMPORTTIME_RE = re.compile(
+    r"^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \|"
+    r"(?P<indent>\s+)(?P<name>\S+)$")
+
+
+def measure(modules):
+    """
+    Returns (total_us, {module: cumulative_us}) for a fresh interpreter
+    importing modules.  With no modules total_us is the interpreter's own
+    startup imports
+    """
+    code = "import sys; sys.path.insert(0, {!r}); {}".format(
+        SRC, "; ".join("import " + m for m in modules) or "pass")
+    proc = subprocess.Popen([sys.executable, "-X", "importtime", "-c", code],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, err = proc.communicate()
+    if proc.returncode != 0:
+        raise EnvironmentError(err.decode("utf-8", "replace"))
+    found = {}
+    total = 0
+    for line in err.decode("utf-8", "replace").splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if not match:
+            continue
+        name = match.group("name")
+        cumulative = int(match.group("cumulative"))
+        found[name] = cumulative
+        # Top level imports have a single space of indentation
+        if len(match.group("indent")) == 1 and (name in modules or
+                                                not modules):
+            total += cumulative
+    return total, found
+
+
+def fastest(modules, repeat):
+    return min((measure(modules) for _ in range(max(1, repeat))),
+               key=lambda result: result[0])
+
+
+def main(args):
+    failed = False
+    baseline = fastest([], args.repeat)[0] / 1000.0
+    print("baseline: {:.1f}ms (python -c pass)".format(baseline))
+    for name, (modules, forbidden) in sorted(SCENARIOS.items()):
+        total, found = fastest(modules, args.repeat)
+        loaded = sorted(m for m in found
+                        if m.split(".")[0] in forbidden)
+        ms = total / 1000.0
+        status = "OK"
+        if ms > args.budget * baseline or loaded:
+            status = "FAIL"
+            failed = True
+        print("{}: {} {:.1f}ms, {:.1f}x baseline (budget {:g}x)".format(
+            name, status, ms, ms / baseline, args.budget))
+        if loaded:
+            print("  Heavy modules imported: {}".format(", ".join(loaded)))
+        if args.verbose:
+            for mod, us in sorted(found.items(), key=lambda x: -x[1])[:15]:
+                print("  {:>8.1f}ms {}".format(us / 1000.0, mod))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget", type=float, default=12,
+                        help="Maximum cumulative import time per scenario "
+                             "as a multiple of the baseline")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Runs per measurement, the fastest is used")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,186 @@
+from __future__ import (print_function, unicode_literals, division,
+                        absolute_import)
+
+import io
+import json
+import numbers
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+# Timing spans for 'ddct check --profile'.  Recording is off unless
+# enable() is called, in which case span() only costs a dict and two
+# time.time() calls
+
+ENABLED = False
+_spans = []
+_lock = threading.Lock()
+_epoch = time.time()
+
+
+def enable():
+    global ENABLED, _epoch
+    ENABLED = True
+    _epoch = time.time()
+    del _spans[:]
+
+
+@contextmanager
+def span(kind, name, **attrs):
+    """
+    Records how long the block takes.  The yielded dict can be filled in
+    with results (exit code, output size, ...) and is stored with the span:
+
+        with span("exe", cmd) as attrs:
+            out = run(cmd)
+            attrs["bytes"] = len(out)
+    """
+    if not ENABLED:
+        yield attrs
+        return
+    thread = threading.current_thread()
+    start = time.time()
+    try:
+        yield attrs
+    except Exception as e:
+        attrs.setdefault("error", "{}: {}".format(type(e).__name__, e))
+        raise
+    finally:
+        end = time.time()
+        with _lock:
+            _spans.append({"kind": kind, "name": name, "start": start,
+                           "duration": end - start, "thread": thread.ident,
+                           "thread_name": thread.name, "attrs": attrs})
+
+
+def get_spans():
+    with _lock:
+        return list(_spans)
+
+
+def _plain(value):
+    """
+    True for values returned as is instead of being wrapped in ApiProxy.
+    Entities subclass dict, so only exact dicts count as plain
+    """
+    return (value is None or type(value) is dict or
+            isinstance(value, (type(""), bytes, numbers.Number)))
+
+
+def _unwrap(value):
+    if isinstance(value, ApiProxy):
+        return value._obj
+    if type(value) in (list, tuple):
+        return type(value)(_unwrap(v) for v in value)
+    return value
+
+
+class ApiProxy(object):
+    """
+    Wraps the dfs_sdk API so every call made through it ('system.get',
+    'app_instances.list', ...) is recorded as an "api" span.  Entities the
+    calls return are wrapped as well, so 'si.reload()' is recorded as
+    'app_instances.storage_instances.reload'
+    """
+
+    def __init__(self, obj, path=""):
+        self._obj = obj
+        self._path = path
+
+    def _wrap(self, value, path):
+        if _plain(value):
+            return value
+        if type(value) in (list, tuple):
+            return type(value)(self._wrap(v, path) for v in value)
+        return ApiProxy(value, path)
+
+    def __getattr__(self, name):
+        value = getattr(self._obj, name)
+        # Entity.get(), .items(), ... are local dict lookups, not API calls
+        if isinstance(self._obj, dict) and hasattr(dict, name):
+            return value
+        return self._wrap(value, "{}.{}".format(self._path, name).lstrip("."))
+
+    def __getitem__(self, key):
+        return self._wrap(self._obj[key], "{}[{}]".format(self._path, key))
+
+    def __iter__(self):
+        return iter(self._obj)
+
+    def __len__(self):
+        return len(self._obj)
+
+    def __contains__(self, key):
+        return key in self._obj
+
+    def __repr__(self):
+        return repr(self._obj)
+
+    def __call__(self, *args, **kwargs):
+        with span("api", self._path):
+            result = self._obj(*_unwrap(args),
+                               **{k: _unwrap(v) for k, v in kwargs.items()})
+        # Entities are named after their endpoint, 'app_instances.create'
+        # returns an 'app_instances' entity
+        return self._wrap(result, self._path.rpartition(".")[0] or
+                          self._path)
+
+
+def summarize(spans):
+    """
+    Returns [(kind, name, count, total seconds, max seconds)] sorted by
+    total time
+    """
+    totals = {}
+    for s in spans:
+        key = (s["kind"], s["name"])
+        count, total, longest = totals.get(key, (0, 0.0, 0.0))
+        totals[key] = (count + 1, total + s["duration"],
+                       max(longest, s["duration"]))
+    return sorted(((kind, name, count, total, longest)
+                   for (kind, name), (count, total, longest)
+                   in totals.items()), key=lambda x: -x[3])
+
+
+def chrome_trace(spans):
+    """
+    Converts spans to the Chrome trace event format, which chrome://tracing
+    and ui.perfetto.dev load directly
+    """
+    pid = os.getpid()
+    events = []
+    threads = {}
+    for s in spans:
+        threads[s["thread"]] = s["thread_name"]
+        events.append({"name": s["name"], "cat": s["kind"], "ph": "X",
+                       "ts": round((s["start"] - _epoch) * 1e6, 1),
+                       "dur": round(s["duration"] * 1e6, 1),
+                       "pid": pid, "tid": s["thread"],
+                       "args": s["attrs"]})
+    for tid, name in threads.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": pid,
+                       "tid": tid, "args": {"name": name}})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def write_trace(path, spans=None):
+    spans = get_spans() if spans is None else spans
+    if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with io.open(path, 'w') as f:
+        f.write(json.dumps(chrome_trace(spans), default=str))
+
+
+def print_profile(spans=None, limit=25):
+    from tabulate import tabulate
+    spans = get_spans() if spans is None else spans
+    rows = [[kind, name if len(name) < 60 else name[:57] + "...", count,
+             round(total, 3), round(longest, 3)]
+            for kind, name, count, total, longest in summarize(spans)]
+    print("Profile ({} spans, top {} by total time)".format(
+        len(spans), min(limit, len(rows))))
+    print(tabulate(rows[:limit], headers=["Kind", "Name", "Count",
+                                          "Total (s)", "Max (s)"],
+                   tablefmt="grid"))
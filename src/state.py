@@ -4,27 +4,42 @@ from __future__ import (print_function, unicode_literals, division,
 import distro
 import psutil
 
-from common import hs
+from common import hs, run_fact
+from memory import get_memory_state
 
 
 GBi = (1024 * 1024 * 1024.0)
 
 
+@run_fact
+def snapshot():
+    """
+    Takes every psutil reading host-state needs once per run
+    """
+    return {"cpu_count": psutil.cpu_count(),
+            "cpu_count_physical": psutil.cpu_count(logical=False),
+            "virtual_memory": psutil.virtual_memory(),
+            "swap_memory": psutil.swap_memory(),
+            "net_if_stats": psutil.net_if_stats(),
+            "net_if_addrs": psutil.net_if_addrs(),
+            "iscsid_pids": [p.info['pid'] for p in psutil.process_iter(
+                attrs=['pid', 'name']) if 'iscsid' in (p.info['name'] or '')]}
+
+
 def get_host_state(config):
+    snap = snapshot()
+    vmem = snap["virtual_memory"]
+    swap = snap["swap_memory"]
     hs("os", distro.os_release_info())
-    hs("cpus(logical)", psutil.cpu_count())
-    hs("cpus(physical)", psutil.cpu_count(logical=False))
-    hs("memory_total", str(round(
-        psutil.virtual_memory().total / GBi, 2)) + " GBi")
-    hs("memory_free", str(round(
-        psutil.virtual_memory().free / GBi, 2)) + " GBi")
-    hs("swap_total", str(round(
-        psutil.swap_memory().total / GBi, 2)) + " GBi")
-    hs("swap_free", str(round(
-        psutil.swap_memory().free / GBi, 2)) + " GBi")
+    hs("cpus(logical)", snap["cpu_count"])
+    hs("cpus(physical)", snap["cpu_count_physical"])
+    hs("memory_total", str(round(vmem.total / GBi, 2)) + " GBi")
+    hs("memory_free", str(round(vmem.free / GBi, 2)) + " GBi")
+    hs("swap_total", str(round(swap.total / GBi, 2)) + " GBi")
+    hs("swap_free", str(round(swap.free / GBi, 2)) + " GBi")
     infs = {}
-    stats = psutil.net_if_stats()
-    for name, inf in psutil.net_if_addrs().items():
+    stats = snap["net_if_stats"]
+    for name, inf in snap["net_if_addrs"].items():
         inf_info = {}
         inf_info['address'] = "/".join((str(inf[0].address),
                                         str(inf[0].netmask)))
@@ -32,7 +47,5 @@ def get_host_state(config):
         inf_info['mtu'] = stats[name].mtu
         infs[name] = inf_info
     hs("interfaces", infs)
-    pids = map(lambda x: x.pid,
-               filter(lambda x: 'iscsid' in x.info['name'],
-                      psutil.process_iter(attrs=['pid', 'name'])))
-    hs("iscsid_pids", pids)
+    hs("iscsid_pids", snap["iscsid_pids"])
+    hs("memory", get_memory_state())
@@ -0,0 +1,172 @@
+from __future__ import (print_function, unicode_literals, division,
+                        absolute_import)
+
+import collections
+import io
+import os
+
+from common import vprint, read_sysfs, host_path, ASSETS
+
+SYSCTL_RULES = os.path.join(ASSETS, "sysctl_rules.txt")
+SYSCTL_DROPIN = "/etc/sysctl.d/99-datera.conf"
+PROC_SYS = "/proc/sys"
+
+# Check codes for each setting in sysctl_rules.txt
+CODES = collections.OrderedDict([
+    ("net.ipv4.tcp_timestamps", "F0D7A1AD"),
+    ("net.ipv4.tcp_sack", "7A9AB850"),
+    ("net.core.netdev_max_backlog", "7656C46C"),
+    ("net.core.somaxconn", "34A7B822"),
+    ("net.core.rmem_max", "4C4B3F0B"),
+    ("net.core.wmem_max", "7F8479C2"),
+    ("net.core.rmem_default", "FBCA17D5"),
+    ("net.core.wmem_default", "68191DE5"),
+    ("net.core.optmem_max", "8FA26A66"),
+    ("net.ipv4.tcp_rmem", "2A6057BD"),
+    ("net.ipv4.tcp_wmem", "CD37F436"),
+    ("net.ipv4.tcp_low_latency", "6BE2899E"),
+    ("net.ipv4.tcp_fin_timeout", "59FD5DF7"),
+    ("net.ipv4.tcp_syncookies", "01C594E7"),
+    ("net.ipv4.tcp_adv_win_scale", "1F523B04"),
+    ("net.ipv4.tcp_window_scaling", "A8A6F381"),
+    ("net.ipv4.tcp_max_syn_backlog", "2862CB28"),
+    ("net.ipv4.tcp_tw_reuse", "989229FC"),
+    ("net.ipv4.tcp_synack_retries", "55EF997B"),
+    ("net.ipv4.conf.all.arp_announce", "9000C3B6"),
+    ("net.ipv4.conf.all.arp_ignore", "BDB4D5D8"),
+    ("vm.dirty_ratio", "1128F298"),
+    ("vm.dirty_background_ratio", "8881546E"),
+    ("vm.swappiness", "0AF31334"),
+    ("vm.zone_reclaim_mode", "2EECBA9E"),
+])
+
+
+class SysctlError(EnvironmentError):
+    pass
+
+
+def normalize(value):
+    """
+    Collapses quoting and whitespace so "4096 87380 16777216" matches the
+    tab separated form the kernel reports
+    """
+    return " ".join((value or "").strip().strip("\"'").split())
+
+
+def parse_rules(path=SYSCTL_RULES):
+    """
+    Parses 'sysctl -w key=value' (or 'key = value') lines into an ordered
+    {key: value}
+    """
+    rules = collections.OrderedDict()
+    with io.open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("sysctl"):
+                line = line.split(None, 2)[-1]
+            key, _, value = line.partition("=")
+            rules[key.strip()] = normalize(value)
+    return rules
+
+
+def proc_path(key):
+    return "{}/{}".format(PROC_SYS, key.replace(".", "/"))
+
+
+def read_value(key):
+    """
+    Returns the normalized running value, or None if this kernel doesn't
+    have the setting (e.g. tcp_low_latency was removed in 4.14)
+    """
+    value = read_sysfs(proc_path(key))
+    return None if value is None else normalize(value)
+
+
+def write_value(key, value):
+    with io.open(host_path(proc_path(key)), 'w') as f:
+        f.write(value)
+
+
+def apply(settings):
+    """
+    Writes every changed setting through /proc/sys as one batch and
+    re-reads them to verify.  If any write or verification fails, all
+    settings written so far are restored and SysctlError is raised.
+    Returns {key: (old, new)} for the settings that changed
+    """
+    changed = collections.OrderedDict()
+    try:
+        for key, value in settings.items():
+            old = read_value(key)
+            if old is None:
+                vprint("Skipping {}, not supported by this kernel".format(
+                    key))
+                continue
+            if old == value:
+                continue
+            vprint("Setting {} = {} (was {})".format(key, value, old))
+            changed[key] = (old, value)
+            write_value(key, value)
+        bad = [key for key, (_, value) in changed.items()
+               if read_value(key) != value]
+        if bad:
+            raise SysctlError("Settings did not take effect: {}".format(
+                ", ".join(bad)))
+    except (IOError, OSError) as e:
+        rollback(changed)
+        if isinstance(e, SysctlError):
+            raise
+        raise SysctlError("Applying sysctl settings failed: {}".format(e))
+    return changed
+
+
+def rollback(changed):
+    for key, (old, _) in reversed(list(changed.items())):
+        vprint("Restoring {} = {}".format(key, old))
+        try:
+            write_value(key, old)
+        except (IOError, OSError):
+            vprint("Could not restore {}".format(key))
+
+
+def write_dropin(settings, path=SYSCTL_DROPIN):
+    """
+    Persists settings as a sysctl.d drop-in, keeping the settings an
+    earlier fix wrote there.  The file is written next to the target and
+    renamed into place so it is never left half written
+    """
+    merged = collections.OrderedDict()
+    if os.path.exists(host_path(path)):
+        merged.update(parse_rules(host_path(path)))
+    merged.update(settings)
+    lines = ["# Generated by ddct from {}".format(
+        os.path.basename(SYSCTL_RULES)), "# Do not edit, changes will be "
+        "overwritten the next time ddct fixes sysctl settings"]
+    lines.extend("{} = {}".format(key, value)
+                 for key, value in merged.items())
+    tmp = "{}.ddct.tmp".format(host_path(path))
+    with io.open(tmp, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    os.rename(tmp, host_path(path))
+
+
+def fix_codes(codes, path=SYSCTL_DROPIN):
+    """
+    Applies the rules for codes (every rule if codes is None) that this
+    kernel supports at runtime and persists them.  If the drop-in can't be
+    written the runtime changes are rolled back as well
+    """
+    keys = set(key for key, code in CODES.items()
+               if codes is None or code in codes)
+    rules = collections.OrderedDict(
+        (key, value) for key, value in parse_rules().items()
+        if key in keys and read_value(key) is not None)
+    changed = apply(rules)
+    try:
+        write_dropin(rules, path)
+    except (IOError, OSError) as e:
+        rollback(changed)
+        raise SysctlError("Could not write {}: {}".format(path, e))
+    return changed
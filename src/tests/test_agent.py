@@ -0,0 +1,39 @@
+from __future__ import (print_function, unicode_literals, division,
+                        absolute_import)
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRC)
+
+import agent  # noqa
+
+
+class FakeState(agent.AgentState):
+    """
+    Agent state that never authenticates with a cluster
+    """
+
+    def get_config(self, refresh=False):
+        return {}
+
+
+def test_unknown_plugin_is_an_error_event():
+    tmpdir = tempfile.mkdtemp(prefix="ddct-")
+    path = os.path.join(tmpdir, "agent.sock")
+    server = agent.AgentServer(path, FakeState())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        events = list(agent.request(path, cmd="check", plugins=["nosuch"]))
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    assert [e["event"] for e in events] == ["error"]
+    assert "nosuch" in events[0]["error"]